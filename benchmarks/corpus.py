@@ -0,0 +1,240 @@
+"""Seeded synthetic NewsAPI corpus, laid out like the crawl: `<root>/<YYYY-MM-DD>/<HH>/articles.json`.
+
+Every partition holds the JSON lines NewsAPI returns (`source`, `author`, `title`,
+`description`, `url`, `urlToImage`, `publishedAt`, `content`) with French text drawn from a
+Zipf distribution over a French vocabulary. Duplicates follow what the crawler sees:
+
+- re-crawls: an article of a previous hour crawled again, identical (same `article_id`);
+- wire copies: an agency story republished by another source, lightly edited.
+
+The same arguments always generate the same files.
+"""
+
+import datetime
+import json
+import os
+import random
+import shutil
+import time
+from typing import Dict, Iterator, List
+
+import numpy as np
+import typer
+
+SOURCES = [
+    "Le Monde",
+    "Libération",
+    "Le Figaro",
+    "BFMTV",
+    "Ouest-France",
+    "20 Minutes",
+    "France 24",
+    "Les Echos",
+    "L'Express",
+    "Le Parisien",
+    "franceinfo",
+    "Mediapart",
+]
+WORDS = """
+le la les un une des de du et à en au aux pour par sur dans avec sans sous entre vers
+chez contre après avant pendant depuis selon mais ou donc car ni que qui dont où ce cette
+ces son sa ses leur leurs notre nos votre vos il elle ils elles on nous vous est sont a ont
+était été être avoir fait faire dit dire peut doit va vont plus moins très aussi encore
+déjà toujours jamais bien mal tout tous toute toutes autre autres même premier première
+dernier dernière nouveau nouvelle grand grande petit petite gouvernement président ministre
+assemblée sénat élection élections campagne candidat vote loi projet réforme budget
+économie croissance inflation chômage emploi entreprise entreprises salariés grève syndicat
+retraite retraites santé hôpital vaccin vaccination épidémie covid confinement
+couvre-feu école éducation université étudiants police justice tribunal procès enquête
+affaire victime sécurité attentat guerre paix armée europe européen européenne france
+français française paris lyon marseille bordeaux lille toulouse nantes région ville
+commune maire conseil département climat environnement énergie nucléaire pétrole électricité
+prix marché bourse banque euros millions milliards hausse baisse record année mois semaine
+jour jours heure heures hier aujourd'hui demain matin soir week-end football match équipe
+joueur victoire défaite championnat coupe tour cyclisme tennis rugby culture cinéma film
+festival musique livre exposition théâtre série télévision radio presse journal réseaux
+sociaux internet numérique données technologie intelligence artificielle téléphone
+manifestation manifestants rassemblement décision annonce mesure mesures plan crise
+situation pays monde international états-unis chine russie allemagne italie espagne
+royaume-uni afrique washington pékin moscou berlin bruxelles londres accord négociations
+sommet rencontre visite discours déclaration interview selon source sources rapport étude
+chiffres population habitants famille enfants femmes hommes jeunes personnes citoyens
+""".split()
+FIRST_NAMES = [
+    "Emmanuel",
+    "Jean",
+    "Marine",
+    "Anne",
+    "Olivier",
+    "Valérie",
+    "Gérald",
+    "Agnès",
+]
+LAST_NAMES = ["Macron", "Castex", "Le Pen", "Hidalgo", "Véran", "Pécresse", "Darmanin"]
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class _Text:
+    """Zipf-distributed French words, drawn by blocks of numpy samples."""
+
+    def __init__(self, rng: np.random.Generator, block_size: int = 1_000_000):
+        self.rng = rng
+        self.block_size = block_size
+        ranks = np.arange(1, len(WORDS) + 1)
+        self.probabilities = 1 / ranks / (1 / ranks).sum()
+        self.words = np.array(WORDS, dtype=object)
+        self._block: List[str] = []
+        self._position = 0
+
+    def draw(self, n_words: int) -> List[str]:
+        if self._position + n_words > len(self._block):
+            self._block = self.words[
+                self.rng.choice(len(WORDS), self.block_size, p=self.probabilities)
+            ].tolist()
+            self._position = 0
+        words = self._block[self._position : self._position + n_words]
+        self._position += n_words
+        return words
+
+    def sentence(self, n_words: int) -> str:
+        words = self.draw(n_words)
+        return (" ".join(words)).capitalize()
+
+
+def _edit(text: str, rng: random.Random, rate: float) -> str:
+    words = text.split(" ")
+    return " ".join(
+        rng.choice(WORDS) if rng.random() < rate else word for word in words
+    )
+
+
+def iter_articles(
+    n_articles: int,
+    start: datetime.datetime,
+    articles_per_hour: int,
+    recrawl_rate: float,
+    wire_rate: float,
+    seed: int,
+) -> Iterator[Dict]:
+    """Yields `n_articles` NewsAPI articles, with their crawl hour in `_crawled_at`."""
+    rng = random.Random(seed)
+    text = _Text(np.random.default_rng(seed))
+    recent: List[Dict] = []
+    for i in range(n_articles):
+        crawled_at = start + datetime.timedelta(hours=i // articles_per_hour)
+        draw = rng.random()
+        if recent and draw < recrawl_rate:
+            article = dict(rng.choice(recent))
+        elif recent and draw < recrawl_rate + wire_rate:
+            origin = rng.choice(recent)
+            source = rng.choice(SOURCES)
+            article = dict(
+                origin,
+                source={"id": None, "name": source},
+                author="AFP",
+                description=_edit(origin["description"], rng, 0.05),
+                content=_edit(origin["content"], rng, 0.05),
+                url=f"https://example.fr/{source.lower().replace(' ', '-')}/{i}",
+            )
+        else:
+            published_at = crawled_at + datetime.timedelta(seconds=rng.randrange(3600))
+            source = rng.choice(SOURCES)
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            article = {
+                "source": {"id": None, "name": source},
+                "author": name if rng.random() < 0.7 else None,
+                "title": f"{text.sentence(rng.randint(6, 14))} : {name}",
+                "description": text.sentence(rng.randint(20, 40)) + ".",
+                "url": f"https://example.fr/{source.lower().replace(' ', '-')}/{i}",
+                "urlToImage": (
+                    f"https://example.fr/images/{i}.jpg" if rng.random() < 0.8 else None
+                ),
+                "publishedAt": published_at.strftime(DATE_FORMAT),
+                "content": text.sentence(rng.randint(30, 60))
+                + f"… [+{rng.randint(500, 9000)} chars]",
+            }
+        recent.append(article)
+        if len(recent) > 5 * articles_per_hour:
+            recent.pop(rng.randrange(len(recent)))
+        yield dict(article, _crawled_at=crawled_at)
+
+
+def generate(
+    root: str,
+    n_articles: int,
+    start: datetime.datetime = datetime.datetime(2021, 3, 1),
+    articles_per_hour: int = 500,
+    recrawl_rate: float = 0.15,
+    wire_rate: float = 0.05,
+    seed: int = 42,
+) -> List[str]:
+    """Writes the corpus under `root`, unless it is already there, and returns its partitions.
+
+    A `corpus.json` file records the arguments, so that a corpus generated with other
+    arguments is rewritten.
+    """
+    params = {
+        "n_articles": n_articles,
+        "start": start.isoformat(),
+        "articles_per_hour": articles_per_hour,
+        "recrawl_rate": recrawl_rate,
+        "wire_rate": wire_rate,
+        "seed": seed,
+    }
+    meta_path = os.path.join(root, "corpus.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        if meta["params"] == params:
+            return [os.path.join(root, path) for path in meta["partitions"]]
+        # only a directory written by `generate` is deleted
+        shutil.rmtree(root)
+
+    partitions, fh, hour = [], None, None
+    for article in iter_articles(
+        n_articles, start, articles_per_hour, recrawl_rate, wire_rate, seed
+    ):
+        crawled_at = article.pop("_crawled_at")
+        if crawled_at != hour:
+            if fh:
+                fh.close()
+            hour = crawled_at
+            path = os.path.join(f"{hour:%Y-%m-%d}", f"{hour:%H}", "articles.json")
+            os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+            fh = open(os.path.join(root, path), "w", encoding="utf-8")
+            partitions.append(path)
+        fh.write(json.dumps(article, ensure_ascii=False) + "\n")
+    if fh:
+        fh.close()
+
+    with open(meta_path, "w") as fh:
+        json.dump({"params": params, "partitions": partitions}, fh)
+    return [os.path.join(root, path) for path in partitions]
+
+
+def main(
+    root: str = "data/bench/newsapi",
+    n_articles: int = 10_000,
+    articles_per_hour: int = 500,
+    recrawl_rate: float = 0.15,
+    wire_rate: float = 0.05,
+    seed: int = 42,
+):
+    """Generate a synthetic NewsAPI corpus."""
+    start = time.perf_counter()
+    partitions = generate(
+        root,
+        n_articles,
+        articles_per_hour=articles_per_hour,
+        recrawl_rate=recrawl_rate,
+        wire_rate=wire_rate,
+        seed=seed,
+    )
+    typer.echo(
+        f"{n_articles} articles in {len(partitions)} partitions of {root}"
+        f" ({time.perf_counter() - start:.1f}s)"
+    )
+
+
+if __name__ == "__main__":
+    typer.run(main)
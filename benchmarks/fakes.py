@@ -0,0 +1,222 @@
+"""In-memory fakes of the external services, to run the pipelines locally."""
+
+import copy
+import itertools
+import json
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Connection
+from elasticsearch.exceptions import RequestError
+
+
+class FakeSearchIndex:
+    """In-memory Algolia `SearchIndex`, recording the requests and operations it receives.
+
+    Arguments:
+        latency: seconds slept per request, to simulate the network.
+    """
+
+    def __init__(self, name: str = "articles", latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.objects: Dict[str, Dict] = {}
+        self.settings: Dict = {}
+        self.requests = 0
+        self.operations = 0
+        self._lock = threading.Lock()
+
+    def _request(self, operations: int) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            self.operations += operations
+
+    def save_objects(self, objects: List[Dict], request_options=None):
+        self._request(len(objects))
+        with self._lock:
+            for obj in objects:
+                self.objects[obj["objectID"]] = copy.deepcopy(obj)
+
+    def delete_objects(self, object_ids: List[str], request_options=None):
+        self._request(len(object_ids))
+        with self._lock:
+            for object_id in object_ids:
+                self.objects.pop(object_id, None)
+
+    def get_settings(self, request_options=None) -> Dict:
+        self._request(0)
+        return copy.deepcopy(self.settings)
+
+    def set_settings(self, settings: Dict, request_options=None):
+        self._request(1)
+        self.settings.update(copy.deepcopy(settings))
+
+
+class FakeSearchClient:
+    """In-memory Algolia `SearchClient`."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.indices: Dict[str, FakeSearchIndex] = {}
+
+    @classmethod
+    def create(cls, app_id: str = None, api_key: str = None, latency: float = 0.0):
+        return cls(latency)
+
+    def init_index(self, name: str) -> FakeSearchIndex:
+        if name not in self.indices:
+            self.indices[name] = FakeSearchIndex(name, self.latency)
+        return self.indices[name]
+
+
+class StubStore:
+    """Documents of the ElasticSearch indices served by `StubConnection`."""
+
+    def __init__(self):
+        self.indices: Dict[str, Dict[str, Dict]] = {}
+        self.scrolls: Dict[str, Tuple[List, int]] = {}
+        self._lock = threading.Lock()
+        self._scroll_ids = itertools.count()
+
+    def hits(self, index: str) -> List[Dict]:
+        return [
+            {"_index": name, "_id": _id, "_score": 1.0, "_source": source}
+            for name, documents in self.indices.items()
+            if index in (None, "_all", name)
+            for _id, source in documents.items()
+        ]
+
+
+class StubConnection(Connection):
+    """ElasticSearch transport answering in memory, to benchmark the client side of a stage.
+
+    Responses have the shape of ES 7.x responses: `_bulk` stores the documents in a
+    `StubStore`, and `_search` (with or without scroll), `_search/scroll` and `_count`
+    return every document of the index (of the slice), whatever the query, and `_mget`
+    returns whole documents. Other requests are acknowledged.
+
+    Arguments:
+        store: documents shared by the connections of a client.
+        latency: seconds slept per request, to simulate the network.
+    """
+
+    def __init__(self, store: StubStore = None, latency: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store if store is not None else StubStore()
+        self.latency = latency
+
+    def _bulk(self, index: str, body: str) -> Dict:
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items, position = [], 0
+        with self.store._lock:
+            while position < len(lines):
+                ((op_type, meta),) = lines[position].items()
+                documents = self.store.indices.setdefault(meta.get("_index", index), {})
+                if op_type == "delete":
+                    documents.pop(meta["_id"], None)
+                    position += 1
+                else:
+                    source = lines[position + 1]
+                    if op_type == "update":
+                        source = dict(documents.get(meta["_id"], {}), **source["doc"])
+                    documents[meta["_id"]] = source
+                    position += 2
+                items.append({op_type: {"_id": meta["_id"], "status": 200}})
+        return {"took": 1, "errors": False, "items": items}
+
+    def _page(self, hits: List[Dict], size: int, scroll_id: str = None) -> Dict:
+        response = {
+            "took": 1,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(hits), "relation": "eq"},
+                "max_score": 1.0,
+                "hits": hits[:size],
+            },
+        }
+        if scroll_id is not None:
+            response["_scroll_id"] = scroll_id
+            self.store.scrolls[scroll_id] = (hits, size)
+        return response
+
+    def _search(self, index: str, params: Dict, body: Dict) -> Dict:
+        size = int(params.get("size", body.get("size", 10)))
+        hits = self.store.hits(index)
+        if "slice" in body:
+            slice_id, n_slices = body["slice"]["id"], body["slice"]["max"]
+            if n_slices <= 1:
+                raise RequestError(
+                    400, "illegal_argument_exception", "max must be greater than 1"
+                )
+            hits = hits[slice_id::n_slices]
+        if "scroll" in params:
+            return self._page(hits, size, str(next(self.store._scroll_ids)))
+        return self._page(hits, size)
+
+    def _scroll(self, body: Dict) -> Dict:
+        hits, size = self.store.scrolls.pop(body["scroll_id"])
+        return self._page(hits[size:], size, body["scroll_id"])
+
+    def _mget(self, index: str, body: Dict) -> Dict:
+        documents = self.store.indices.get(index, {})
+        return {
+            "docs": [
+                (
+                    {
+                        "_index": index,
+                        "_id": _id,
+                        "found": True,
+                        "_source": documents[_id],
+                    }
+                    if _id in documents
+                    else {"_index": index, "_id": _id, "found": False}
+                )
+                for _id in body["ids"]
+            ]
+        }
+
+    def perform_request(
+        self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None
+    ):
+        start = time.time()
+        time.sleep(self.latency)
+        params = params or {}
+        path = url.split("?")[0].strip("/").split("/")
+        index = path[0] if path and not path[0].startswith("_") else None
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        endpoint = "/".join(path[1:] if index else path)
+        if endpoint == "_bulk":
+            response = self._bulk(index, body)
+        elif endpoint == "_search/scroll" and method == "DELETE":
+            for scroll_id in json.loads(body or "{}").get("scroll_id", []):
+                self.store.scrolls.pop(scroll_id, None)
+            response = {"succeeded": True, "num_freed": 1}
+        elif endpoint == "_search/scroll":
+            response = self._scroll(json.loads(body))
+        elif endpoint == "_search":
+            response = self._search(index, params, json.loads(body or "{}"))
+        elif endpoint == "_mget":
+            response = self._mget(index, json.loads(body))
+        elif endpoint == "_count":
+            response = {"count": len(self.store.hits(index))}
+        else:
+            response = {"acknowledged": True}
+        raw_data = json.dumps(response)
+        self.log_request_success(
+            method, url, url, body, 200, raw_data, time.time() - start
+        )
+        return 200, {"content-type": "application/json"}, raw_data
+
+
+def get_stub_client(store: StubStore = None, latency: float = 0.0) -> Elasticsearch:
+    """`Elasticsearch` client whose requests are answered by a `StubConnection`."""
+    return Elasticsearch(
+        connection_class=StubConnection,
+        store=store if store is not None else StubStore(),
+        latency=latency,
+    )
@@ -0,0 +1,115 @@
+"""Benchmark the near-duplicate stage of `station.dedup` against exact deduplication.
+
+Synthetic articles are generated with known duplicates: exact re-crawls, wire copies
+rewritten by other sources and edited titles. Each method marks articles as duplicates of
+another one; precision is the share of marks that are true duplicates and recall the share
+of true duplicates that are marked.
+"""
+
+import random
+import time
+from typing import List, Tuple
+
+import pandas as pd
+import typer
+
+from station.dedup import mark_near_duplicates, NearDuplicateIndex
+from station.utils import _get_surrogate_keys
+
+SOURCES = ["Le Monde", "Libération", "Le Figaro", "BFMTV", "Ouest-France", "20 Minutes"]
+
+
+def _make_articles(n_articles: int, duplicate_rate: float, seed: int) -> pd.DataFrame:
+    rng = random.Random(seed)
+    vocabulary = [
+        "".join(rng.choices("abcdefghijklmnopqrstuvwxyzéèà", k=rng.randint(2, 9)))
+        for _ in range(20_000)
+    ]
+
+    def _words(k: int) -> List[str]:
+        return rng.choices(vocabulary, k=k)
+
+    def _edit(words: List[str], rate: float) -> List[str]:
+        return [rng.choice(vocabulary) if rng.random() < rate else w for w in words]
+
+    rows: List[Tuple] = []
+    for i in range(n_articles):
+        if rows and rng.random() < duplicate_rate:
+            origin = rng.randrange(len(rows))
+            cluster, title, description, content, source = rows[origin][1:6]
+            kind = rng.choice(["exact", "wire", "title"])
+            if kind == "wire":
+                source = rng.choice(SOURCES)
+                description = " ".join(_edit(description.split(), 0.05))
+                content = " ".join(_edit(content.split(), 0.05))
+            elif kind == "title":
+                title = " ".join(_edit(title.split(), 0.2))
+        else:
+            cluster = i
+            title = " ".join(_words(10))
+            description = " ".join(_words(30))
+            content = " ".join(_words(40))
+            source = rng.choice(SOURCES)
+        rows.append((i, cluster, title, description, content, source))
+    articles_df = pd.DataFrame(
+        rows,
+        columns=[
+            "position",
+            "cluster",
+            "title",
+            "description",
+            "content",
+            "source_name",
+        ],
+    )
+    return articles_df.assign(article_id=lambda d: d.position.astype(str))
+
+
+def _score(articles_df: pd.DataFrame, marked: pd.Series) -> Tuple[float, float]:
+    """Precision and recall of duplicate marks (`marked` holds the position of the original)."""
+    is_duplicate = articles_df.cluster != articles_df.position
+    is_marked = marked.notna()
+    true_marks = is_marked & (
+        articles_df.cluster
+        == articles_df.cluster.reindex(marked.fillna(-1).astype(int)).values
+    )
+    precision = true_marks.sum() / max(is_marked.sum(), 1)
+    recall = (true_marks & is_duplicate).sum() / max(is_duplicate.sum(), 1)
+    return precision, recall
+
+
+def main(
+    n_articles: int = 50_000,
+    duplicate_rate: float = 0.2,
+    threshold: float = 0.7,
+    n_jobs: int = 1,
+    seed: int = 42,
+):
+    """Compare exact and MinHash-LSH deduplication on synthetic articles."""
+    articles_df = _make_articles(n_articles, duplicate_rate, seed)
+
+    start = time.perf_counter()
+    keys = _get_surrogate_keys(articles_df, ["title", "source_name"])
+    first = articles_df.groupby(keys).position.transform("min")
+    exact = first.where(first != articles_df.position)
+    exact_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = NearDuplicateIndex(threshold=threshold, n_jobs=n_jobs)
+    marked = mark_near_duplicates(articles_df, index).duplicate_of
+    near = marked.map(lambda article_id: article_id and int(article_id))
+    near_seconds = time.perf_counter() - start
+
+    for name, marks, seconds in [
+        ("exact", exact, exact_seconds),
+        ("minhash-lsh", near.astype(float), near_seconds),
+    ]:
+        precision, recall = _score(articles_df, marks)
+        typer.echo(
+            f"{name:>12}: precision {precision:.3f}, recall {recall:.3f},"
+            f" {n_articles / seconds:,.0f} articles/sec"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
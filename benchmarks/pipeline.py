@@ -0,0 +1,226 @@
+"""Benchmark every stage of the station pipeline on synthetic corpora.
+
+Corpora of `benchmarks.corpus` are generated once per size under `<root>/<size>/newsapi`.
+Each stage runs in its own fresh process, so that its peak RSS is its own:
+
+- `load_data` and `iter_data` of `station.utils`;
+- `documents`: `_document_generator` of `station.management.es`, in stream mode;
+- `bulk`: `BulkIndexer` indexing the documents;
+- `dataset`: `DatasetBase` iterating over the indexed documents (indexing is not timed);
+- `cooccurrence`: `CooccurrenceModel.fit` on the titles and descriptions.
+
+Stages that touch ElasticSearch use the in-memory `StubConnection`, which measures the
+client side only, unless --es-url points to a local single-node cluster
+(`docker-compose up`). Every run is appended to the --history JSON file and compared with
+the previous run of the same stage, size and transport.
+"""
+
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from elasticsearch import Elasticsearch
+from elasticsearch_dsl import connections, Q
+import typer
+
+from benchmarks.corpus import generate
+from benchmarks.fakes import get_stub_client, StubStore
+from station.bulk import BulkIndexer
+from station.constants import ES_MAPPING, ES_SETTINGS
+from station.cooccurrence import CooccurrenceModel
+from station.dataset import DatasetBase
+from station.management.es import _document_generator
+from station.utils import iter_data, load_data
+
+BENCH_INDEX = "bench_articles"
+
+
+def _get_client(es_url: Optional[str]) -> Elasticsearch:
+    if es_url is None:
+        return get_stub_client(StubStore())
+    client = Elasticsearch(hosts=[es_url])
+    client.indices.delete(index=BENCH_INDEX, ignore=[404])
+    client.indices.create(
+        index=BENCH_INDEX, body={"settings": ES_SETTINGS, "mappings": ES_MAPPING}
+    )
+    return client
+
+
+def _load_data(paths: List[str], es_url: str) -> Callable[[], int]:
+    return lambda: len(load_data(paths))
+
+
+def _iter_data(paths: List[str], es_url: str) -> Callable[[], int]:
+    return lambda: sum(len(batch) for batch in iter_data(paths))
+
+
+def _documents(paths: List[str], es_url: str) -> Callable[[], int]:
+    return lambda: sum(1 for _ in _document_generator(paths, stream=True))
+
+
+def _bulk(paths: List[str], es_url: str) -> Callable[[], int]:
+    indexer = BulkIndexer(_get_client(es_url), index=BENCH_INDEX)
+    return lambda: indexer.bulk(_document_generator(paths, stream=True)).succeeded
+
+
+def _dataset(paths: List[str], es_url: str) -> Callable[[], int]:
+    client = _get_client(es_url)
+    BulkIndexer(client, index=BENCH_INDEX).bulk(_document_generator(paths, stream=True))
+    client.indices.refresh(index=BENCH_INDEX)
+    connections.add_connection("default", client)
+    dataset = DatasetBase(query=Q("match_all"))
+    dataset.search = dataset.search.index(BENCH_INDEX)
+    return lambda: sum(1 for _ in dataset)
+
+
+def _cooccurrence(paths: List[str], es_url: str) -> Callable[[], int]:
+    articles_df = load_data(paths)
+    docs = (articles_df.title + " " + articles_df.description.fillna("")).tolist()
+
+    def _fit() -> int:
+        CooccurrenceModel.fit(docs, min_count=5)
+        return len(docs)
+
+    return _fit
+
+
+STAGES = {
+    "load_data": _load_data,
+    "iter_data": _iter_data,
+    "documents": _documents,
+    "bulk": _bulk,
+    "dataset": _dataset,
+    "cooccurrence": _cooccurrence,
+}
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _run_stage(stage: str, paths: List[str], es_url: str) -> Dict:
+    """Runs in a fresh process: the setup of the stage, then the timed stage."""
+    run = STAGES[stage](paths, es_url)
+    start = time.perf_counter()
+    rows = run()
+    seconds = time.perf_counter() - start
+    return {"rows": rows, "seconds": seconds, "peak_rss_mb": _peak_rss_mb()}
+
+
+def _measure(stage: str, paths: List[str], es_url: str, repeat: int) -> Dict:
+    """Best time of `repeat` runs, each in a new process."""
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        with context.Pool(1) as pool:
+            runs.append(pool.apply(_run_stage, (stage, paths, es_url)))
+    best = min(runs, key=lambda run: run["seconds"])
+    return dict(
+        best,
+        rows_per_sec=best["rows"] / best["seconds"] if best["seconds"] else 0.0,
+        peak_rss_mb=max(run["peak_rss_mb"] for run in runs),
+    )
+
+
+def _get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _find_previous(history: List[Dict], result: Dict) -> Optional[Dict]:
+    for run in reversed(history):
+        for previous in run["results"]:
+            if all(
+                previous[name] == result[name]
+                for name in ("stage", "n_articles", "transport")
+            ):
+                return previous
+    return None
+
+
+def _delta(value: float, previous: Optional[float]) -> str:
+    if not previous:
+        return ""
+    return f" ({(value - previous) / previous:+.0%})"
+
+
+def main(
+    sizes: List[int] = typer.Option([10_000, 100_000, 1_000_000]),
+    stages: List[str] = typer.Option(list(STAGES)),
+    root: str = "data/bench",
+    history: str = "data/bench/history.json",
+    es_url: str = None,
+    repeat: int = 1,
+    seed: int = 42,
+):
+    """Benchmark the throughput and peak RSS of each stage, for each corpus size."""
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise typer.BadParameter(f"unknown stages {unknown}, use {list(STAGES)}")
+    runs = []
+    if os.path.exists(history):
+        with open(history) as fh:
+            runs = json.load(fh)
+
+    results = []
+    for n_articles in sizes:
+        start = time.perf_counter()
+        paths = generate(
+            os.path.join(root, str(n_articles), "newsapi"), n_articles, seed=seed
+        )
+        typer.echo(
+            f"Corpus of {n_articles:,} articles ({len(paths)} partitions)"
+            f" ready in {time.perf_counter() - start:.1f}s"
+        )
+        for stage in stages:
+            result = {
+                "stage": stage,
+                "n_articles": n_articles,
+                "transport": "es" if es_url else "stub",
+                **_measure(stage, paths, es_url, repeat),
+            }
+            previous = _find_previous(runs, result) or {}
+            typer.echo(
+                f"{stage:>14} {n_articles:>9,}: {result['rows']:>9,} rows in"
+                f" {result['seconds']:.2f}s, {result['rows_per_sec']:,.0f} rows/sec"
+                f"{_delta(result['rows_per_sec'], previous.get('rows_per_sec'))},"
+                f" peak RSS {result['peak_rss_mb']:,.0f} MiB"
+                f"{_delta(result['peak_rss_mb'], previous.get('peak_rss_mb'))}"
+            )
+            results.append(result)
+
+    runs.append(
+        {
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "commit": _get_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": seed,
+            "results": results,
+        }
+    )
+    os.makedirs(os.path.dirname(history) or ".", exist_ok=True)
+    with open(history, "w") as fh:
+        json.dump(runs, fh, indent=2)
+    typer.echo(f"Results appended to {history}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
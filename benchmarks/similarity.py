@@ -0,0 +1,92 @@
+"""Benchmark `station.similarity` against ES `more_like_this`.
+
+For random seed articles, the top-k similar articles are computed by `MLTDataset` (first
+page), by the brute-force path and by the IVF index of `SimilarityIndex`. Latencies are
+reported with the overlap of the top-k with MLT's, and the recall of IVF against the brute
+force. Requires the vectors of `make vectorize similarity` and, unless --no-mlt, the
+ElasticSearch index of `make ingest`.
+"""
+
+import time
+from typing import Callable, Dict, List
+
+from elasticsearch_dsl import connections
+import numpy as np
+import typer
+
+from station.constants import ES_INDEX
+from station.dataset import MLTDataset
+from station.similarity import SimilarityIndex
+
+
+def _timed(search: Callable[[str], List[str]], seeds: List[str]) -> Dict:
+    latencies, results = [], []
+    for seed in seeds:
+        start = time.perf_counter()
+        results.append(search(seed))
+        latencies.append(time.perf_counter() - start)
+    return {"latencies": np.array(latencies) * 1000, "results": results}
+
+
+def _overlap(results: List[List[str]], reference: List[List[str]], k: int) -> float:
+    return float(
+        np.mean([len(set(r) & set(ref)) / k for r, ref in zip(results, reference)])
+    )
+
+
+def main(
+    directory: str = "data/similarity",
+    n_queries: int = 100,
+    k: int = 10,
+    n_probe: int = 8,
+    mlt: bool = True,
+    seed: int = 42,
+):
+    """Compare the latency and overlap of local similarity and MLT."""
+    index = SimilarityIndex(directory)
+    rng = np.random.default_rng(seed)
+    seeds = rng.choice(index.ids, size=min(n_queries, index.n_documents), replace=False)
+    seeds = seeds.tolist()
+
+    methods = {
+        "brute-force": lambda seed: [
+            article_id
+            for article_id, _ in index.search({"_id": seed}, k=k, approximate=False)
+        ],
+        f"ivf (n_probe={n_probe})": lambda seed: [
+            article_id
+            for article_id, _ in index.search({"_id": seed}, k=k, n_probe=n_probe)
+        ],
+    }
+    if mlt:
+        connections.create_connection(hosts=["localhost:9200"])
+        methods["more_like_this"] = lambda seed: [
+            hit.meta.id
+            for hit in MLTDataset(like=[{"_id": seed, "_index": ES_INDEX}])
+            .search.extra(size=k)
+            .execute()
+        ]
+
+    # warm up the memory map and the inverted lists
+    for search in methods.values():
+        search(seeds[0])
+    runs = {name: _timed(search, seeds) for name, search in methods.items()}
+
+    typer.echo(f"{index.n_documents} documents, {len(seeds)} queries, top {k}")
+    for name, run in runs.items():
+        latencies = run["latencies"]
+        line = (
+            f"{name:>20}: p50 {np.percentile(latencies, 50):.2f}ms,"
+            f" p95 {np.percentile(latencies, 95):.2f}ms"
+        )
+        if name != "brute-force":
+            recall = _overlap(run["results"], runs["brute-force"]["results"], k)
+            line += f", overlap with brute-force {recall:.2f}"
+        if mlt and name != "more_like_this":
+            overlap = _overlap(run["results"], runs["more_like_this"]["results"], k)
+            line += f", overlap with MLT {overlap:.2f}"
+        typer.echo(line)
+
+
+if __name__ == "__main__":
+    typer.run(main)
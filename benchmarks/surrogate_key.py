@@ -0,0 +1,69 @@
+"""Benchmark the article_id generation of `station.utils.load_data`."""
+
+import random
+import string
+import time
+
+import pandas as pd
+import typer
+
+from station.utils import _get_surrogate_key, _get_surrogate_keys
+
+COLS = ["title", "source_name"]
+
+
+def _make_frame(n_rows: int, seed: int = 42) -> pd.DataFrame:
+    rng = random.Random(seed)
+    sources = ["Le Monde", "Libération", "Le Figaro", "BFMTV", None]
+    titles = [
+        " ".join(
+            "".join(rng.choices(string.ascii_lowercase + "éèà", k=rng.randint(2, 10)))
+            for _ in range(rng.randint(5, 15))
+        )
+        for _ in range(min(n_rows, 50_000))
+    ]
+    return pd.DataFrame(
+        {
+            "title": [
+                rng.choice(titles) if rng.random() > 0.01 else None
+                for _ in range(n_rows)
+            ],
+            "source_name": [rng.choice(sources) for _ in range(n_rows)],
+        }
+    )
+
+
+def _timeit(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main(n_rows: int = 200_000, n_jobs: int = 4):
+    """Compare the row-wise and vectorized surrogate key engines."""
+    df = _make_frame(n_rows)
+
+    rowwise = df.apply(_get_surrogate_key, args=(COLS,), axis=1)
+    vectorized = _get_surrogate_keys(df, COLS)
+    assert rowwise.equals(vectorized), "vectorized keys differ from row-wise keys"
+
+    timings = {
+        "apply(axis=1)": _timeit(
+            lambda: df.apply(_get_surrogate_key, args=(COLS,), axis=1)
+        ),
+        "vectorized": _timeit(lambda: _get_surrogate_keys(df, COLS)),
+        f"vectorized n_jobs={n_jobs}": _timeit(
+            lambda: _get_surrogate_keys(
+                df, COLS, n_jobs=n_jobs, chunksize=n_rows // n_jobs
+            )
+        ),
+    }
+    baseline = timings["apply(axis=1)"]
+    for name, seconds in timings.items():
+        typer.echo(
+            f"{name:>25}: {n_rows / seconds:>12,.0f} rows/sec ({baseline / seconds:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
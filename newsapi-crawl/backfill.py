@@ -1,17 +1,188 @@
-import logging
+"""Backfill the NewsAPI partitions missing from S3.
+
+The missing `newsapi/YYYY-MM-DD/HH` partitions are planned from a single paginated listing
+of the bucket, then crawled by a pool of workers sized after the remaining API budget.
+Progress is persisted in a state file after each partition, so that a killed run resumes
+where it left off, and partitions without any article are not crawled again.
+
+Usage:
+    python backfill.py --start 2021-04-01 --end 2021-04-11
+    S3_ENDPOINT_URL=http://localhost:9000 python backfill.py ...  # e.g. MinIO
+"""
+
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import as_completed, ThreadPoolExecutor
 import datetime
-import pandas as pd
-from tqdm import tqdm
-from handler import main
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Set
+
+from handler import (
+    get_s3,
+    get_s3_prefix,
+    LIMITER,
+    main,
+    MAX_API_CALLS,
+    S3_BUCKET,
+)
 
-logger = logging.getLogger('handler')
+logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger("handler")
 logger.setLevel(logging.INFO)
 
-backfill_range = pd.date_range(
-    start=datetime.datetime(2021, 4, 11, 0),
-    end=datetime.datetime(2021, 4, 11, 0),
-    freq="D",
-)
 
-for date in tqdm(backfill_range):
-    main(date, n_hours_delta=24)
+class BackfillState:
+    """Status of the backfilled partitions, persisted as JSON in `path`."""
+
+    def __init__(self, path: str = "./backfill.json"):
+        self.path = path
+        self.partitions: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, "r") as fh:
+                self.partitions = json.load(fh)["partitions"]
+        self._lock = threading.Lock()
+
+    def record(self, prefix: str, **status) -> None:
+        with self._lock:
+            self.partitions[prefix] = status
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as fh:
+                json.dump({"partitions": self.partitions}, fh, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def list_partitions(s3, start: datetime.datetime) -> Dict[str, Set[str]]:
+    """File names of each S3 partition from `start`, listed 1000 keys per request."""
+    paginator = s3.meta.client.get_paginator("list_objects_v2")
+    partitions = defaultdict(set)
+    for page in paginator.paginate(
+        Bucket=S3_BUCKET,
+        Prefix="newsapi/",
+        StartAfter=get_s3_prefix(start).rsplit("/", 1)[0],
+    ):
+        for obj in page.get("Contents", []):
+            prefix, name = obj["Key"].rsplit("/", 1)
+            partitions[prefix].add(name)
+    return partitions
+
+
+def plan(
+    dates: List[datetime.datetime],
+    partitions: Dict[str, Set[str]],
+    state: BackfillState,
+    refill_gaps: bool = False,
+) -> List[datetime.datetime]:
+    """Dates whose partition is missing, or incomplete if `refill_gaps`."""
+    missing = []
+    for date in dates:
+        prefix = get_s3_prefix(date)
+        names = partitions.get(prefix, set())
+        has_articles = any(name.startswith("articles.json") for name in names)
+        if has_articles and not (refill_gaps and "gaps.json" in names):
+            continue
+        if (
+            not has_articles
+            and state.partitions.get(prefix, {}).get("status") == "empty"
+        ):
+            continue
+        missing.append(date)
+    return missing
+
+
+def _fill(date: datetime.datetime, n_hours_delta: int, concurrency: int) -> Dict:
+    if not LIMITER.remaining:
+        return {"status": "skipped"}
+    try:
+        report = main(date, n_hours_delta=n_hours_delta, concurrency=concurrency)
+    except Exception as exception:
+        logger.exception(f"Failed to backfill {date}")
+        return {"status": "failed", "error": repr(exception)}
+    if not report.articles and report.complete:
+        status = "empty"
+    else:
+        status = "done" if report.complete else "partial"
+    return {
+        "status": status,
+        "articles": len(report.articles),
+        "api_calls": report.api_calls,
+        "gaps": [gap.to_dict() for gap in report.gaps],
+    }
+
+
+def backfill(
+    start: datetime.datetime,
+    end: datetime.datetime,
+    n_hours_delta: int = 24,
+    workers: int = 4,
+    concurrency: int = 2,
+    state_path: str = "./backfill.json",
+    refill_gaps: bool = False,
+) -> Counter:
+    """Crawls the partitions from `start` to `end` (inclusive) that are missing from S3.
+
+    Returns:
+        the number of partitions per status: done, partial (with coverage gaps), empty,
+        failed or skipped (the API budget was exhausted).
+    """
+    state = BackfillState(state_path)
+    dates = []
+    while start <= end:
+        dates.append(start)
+        start += datetime.timedelta(hours=n_hours_delta)
+    missing = plan(dates, list_partitions(get_s3(), dates[0]), state, refill_gaps)
+    logger.info(f"{len(missing)} partitions to backfill out of {len(dates)}")
+
+    # more workers than the budget of that many partitions would only leave them partial
+    workers = max(1, min(workers, LIMITER.remaining // MAX_API_CALLS, len(missing)))
+    summary = Counter()
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(_fill, date, n_hours_delta, concurrency): date
+            for date in missing
+        }
+        for future in as_completed(futures):
+            prefix = get_s3_prefix(futures[future])
+            status = future.result()
+            summary[status["status"]] += 1
+            if status["status"] != "skipped":
+                state.record(prefix, **status)
+            logger.info(
+                f"{prefix}: {status['status']} ({sum(summary.values())}/{len(missing)})"
+            )
+
+    for prefix, status in sorted(state.partitions.items()):
+        if status["status"] in ("failed", "partial"):
+            logger.warning(
+                f"{prefix}: {status['status']} {status.get('error') or status['gaps']}"
+            )
+    counts = ", ".join(f"{count} {status}" for status, count in sorted(summary.items()))
+    logger.info(
+        f"Backfill summary: {counts or 'nothing to backfill'},"
+        f" {LIMITER.remaining} API calls left today"
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--start", default="2021-04-11T00:00:00")
+    parser.add_argument("--end", default="2021-04-11T00:00:00")
+    parser.add_argument("--hours-delta", type=int, default=24)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--state", default="./backfill.json")
+    parser.add_argument("--refill-gaps", action="store_true")
+    args = parser.parse_args()
+
+    backfill(
+        datetime.datetime.fromisoformat(args.start),
+        datetime.datetime.fromisoformat(args.end),
+        n_hours_delta=args.hours_delta,
+        workers=args.workers,
+        concurrency=args.concurrency,
+        state_path=args.state,
+        refill_gaps=args.refill_gaps,
+    )
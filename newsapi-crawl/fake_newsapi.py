@@ -0,0 +1,114 @@
+"""Local fake of the NewsAPI /v2/everything endpoint, to test the crawler without credits.
+
+Serves seeded random articles with the limits of the developer plan: a single page of up to
+`pageSize` articles sorted by `publishedAt`, and a daily request quota.
+
+Usage:
+    python fake_newsapi.py --port 8765 --n-articles 5000
+    NEWSAPI_URL=http://localhost:8765/v2/ NEWSAPI_KEY=fake python -c "..."
+"""
+
+import argparse
+import bisect
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+from typing import Any, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+PUBLISHED_AT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def make_articles(
+    start: datetime.datetime, hours: int = 24, n_articles: int = 5000, seed: int = 42
+) -> List[Dict[str, Any]]:
+    """Random articles, denser in the morning, and a burst published in the same second."""
+    rng = random.Random(seed)
+    seconds = hours * 3600
+    offsets = [int(rng.triangular(0, seconds, seconds / 3)) for _ in range(n_articles)]
+    # wire stories pushed by many sources at once
+    burst = rng.randrange(seconds)
+    offsets += [burst] * (n_articles // 100)
+    articles = []
+    for i, offset in enumerate(sorted(offsets)):
+        source = rng.choice(["Le Monde", "Libération", "Le Figaro", "BFMTV"])
+        articles.append(
+            {
+                "source": {"id": None, "name": source},
+                "author": None,
+                "title": f"Article {i}",
+                "description": f"Description {i}",
+                "url": f"https://example.com/{i}",
+                "urlToImage": None,
+                "publishedAt": (start + datetime.timedelta(seconds=offset)).strftime(
+                    PUBLISHED_AT_FORMAT
+                ),
+                "content": f"Contenu {i}",
+            }
+        )
+    return articles
+
+
+class FakeNewsAPI(ThreadingHTTPServer):
+    def __init__(self, address, articles: List[Dict[str, Any]], daily_quota: int = 100):
+        self.articles = sorted(articles, key=lambda article: article["publishedAt"])
+        self.published = [article["publishedAt"] for article in self.articles]
+        self.daily_quota = daily_quota
+        self.requests = 0
+        self.lock = threading.Lock()
+        super().__init__(address, _Handler)
+
+    def everything(self, params: Dict[str, str]) -> Dict[str, Any]:
+        # bounds are inclusive, at the second
+        left = bisect.bisect_left(self.published, params["from"] + "Z")
+        right = bisect.bisect_right(self.published, params["to"] + "Z")
+        matches = self.articles[left:right]
+        page_size = int(params.get("pageSize", 100))
+        return {
+            "status": "ok",
+            "totalResults": len(matches),
+            "articles": matches[::-1][:page_size],
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        with self.server.lock:
+            self.server.requests += 1
+            over_quota = self.server.requests > self.server.daily_quota
+        if not url.path.endswith("/everything"):
+            status, body = 404, {"status": "error", "code": "notFound"}
+        elif over_quota:
+            status, body = 429, {"status": "error", "code": "rateLimited"}
+        else:
+            status, body = 200, self.server.everything(params)
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--start", default="2021-04-11T00:00:00")
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--n-articles", type=int, default=5000)
+    parser.add_argument("--daily-quota", type=int, default=100)
+    args = parser.parse_args()
+
+    articles = make_articles(
+        datetime.datetime.fromisoformat(args.start), args.hours, args.n_articles
+    )
+    server = FakeNewsAPI(("localhost", args.port), articles, args.daily_quota)
+    print(f"Serving {len(articles)} articles on http://localhost:{args.port}/v2/")
+    server.serve_forever()
@@ -2,12 +2,18 @@ import datetime
 import json
 import logging
 import os
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterable, List
 import urllib
+import zlib
 
 import pytz
 import boto3
-from newsapi import NewsApiClient
+from newsapi import const, NewsApiClient
+import requests
+import zstandard
+
+from metrics import RunMetrics
+from scheduler import crawl, CrawlReport, RateLimiter, Window
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -15,6 +21,132 @@ logger.setLevel(logging.INFO)
 
 newsapi_key = os.environ["NEWSAPI_KEY"]
 MAX_API_CALLS = 40
+# the developer plan allows 100 requests per day, shared by all the crawls of the process
+LIMITER = RateLimiter(
+    rate=float(os.environ.get("NEWSAPI_RATE", 5)),
+    daily_budget=int(os.environ.get("NEWSAPI_DAILY_BUDGET", 100)),
+)
+
+S3_BUCKET = os.environ.get("S3_BUCKET", "articles-louisguitton")
+# e.g. S3_ENDPOINT_URL=http://localhost:9000 to write to a local MinIO
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+# gzip, zstd or none; the readers of `station` detect the compression of the partitions
+S3_COMPRESSION = os.environ.get("S3_COMPRESSION", "gzip")
+S3_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+# the minimum size of a multipart upload part is 5MB
+S3_PART_SIZE = 8 * 1024 * 1024
+
+# e.g. NEWSAPI_URL=http://localhost:8765/v2/ to crawl the local fake_newsapi.py server
+if "NEWSAPI_URL" in os.environ:
+    const.TOP_HEADLINES_URL = os.environ["NEWSAPI_URL"] + "top-headlines"
+    const.EVERYTHING_URL = os.environ["NEWSAPI_URL"] + "everything"
+    const.SOURCES_URL = os.environ["NEWSAPI_URL"] + "sources"
+
+
+def get_s3_prefix(execution_date: datetime.datetime) -> str:
+    """S3 "folder" of the articles crawled from `execution_date`."""
+    return f"newsapi/{execution_date.strftime('%Y-%m-%d/%H')}"
+
+
+def get_s3(metrics: RunMetrics = None):
+    # one session per call, as boto3 sessions can't be shared between threads
+    s3 = boto3.session.Session().resource("s3", endpoint_url=S3_ENDPOINT_URL)
+    if metrics is not None:
+        metrics.hook_boto3(s3.meta.client)
+    return s3
+
+
+def _get_compressor(compression: str):
+    if compression == "gzip":
+        return zlib.compressobj(wbits=31)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
+def write_jsonl(
+    s3,
+    bucket: str,
+    key: str,
+    records: Iterable[Dict[str, Any]],
+    compression: str = S3_COMPRESSION,
+) -> int:
+    """Stream `records` as JSON lines to `s3://<bucket>/<key>`.
+
+    Lines are compressed as they are serialized and sent in parts of `S3_PART_SIZE`
+    with a multipart upload, so the body is never held in memory. Small bodies are sent
+    with a single `put`.
+
+    Returns:
+        the number of bytes written.
+    """
+    client = s3.meta.client
+    compressor = _get_compressor(compression)
+    buffer = bytearray()
+    parts: List[Dict[str, Any]] = []
+    upload_id = None
+    size = 0
+
+    def _upload_part() -> None:
+        nonlocal upload_id
+        if upload_id is None:
+            upload_id = client.create_multipart_upload(
+                Bucket=bucket, Key=key, ContentType="application/x-ndjson"
+            )["UploadId"]
+        part_number = len(parts) + 1
+        response = client.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=bytes(buffer),
+        )
+        parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        buffer.clear()
+
+    try:
+        for i, record in enumerate(records):
+            line = ("\n" if i else "") + json.dumps(record)
+            data = line.encode("UTF-8")
+            buffer += compressor.compress(data) if compressor else data
+            if len(buffer) >= S3_PART_SIZE:
+                size += len(buffer)
+                _upload_part()
+        if compressor:
+            buffer += compressor.flush()
+        size += len(buffer)
+        if upload_id is None:
+            client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=bytes(buffer),
+                ContentType="application/x-ndjson",
+            )
+        else:
+            if buffer:
+                _upload_part()
+            client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+    except Exception:
+        if upload_id is not None:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return size
+
+
+def get_client(concurrency: int = 4, metrics: RunMetrics = None) -> NewsApiClient:
+    """NewsAPI client keeping `concurrency` connections alive."""
+    session = requests.Session()
+    if metrics is not None:
+        metrics.hook_session(session)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return NewsApiClient(api_key=newsapi_key, session=session)
 
 
 def _extract_sources(articles: List[Dict]) -> Dict[str, str]:
@@ -76,19 +208,25 @@ def get_news(
     newsapi: NewsApiClient,
     execution_date: datetime.datetime,
     n_hours_delta: int = 1,
+    concurrency: int = 4,
+    limiter: RateLimiter = LIMITER,
+    max_api_calls: int = MAX_API_CALLS,
     **newsapi_params,
-) -> List[Dict[str, Any]]:
+) -> CrawlReport:
     """Get NewsAPI news for a given timeframe.
 
-    This method paginates the requests to accomodate for the Developer plan of NewsAPI.
-    In that plan, only 1 page of up to 100 articles can be queried at once.
-    Therefore, we're using a while loop to paginate through the articles, and still be able
-    to get all articles published between `execution_date` and `exection_date` + `n_hours_delta` * hours.
+    In the Developer plan of NewsAPI, only 1 page of up to 100 articles can be queried at once.
+    Therefore, the timeframe is split into sub-windows of less than 100 articles, crawled
+    concurrently (see `scheduler.crawl`), to get all articles published between
+    `execution_date` and `exection_date` + `n_hours_delta` * hours.
 
     Arguments:
         newsapi: NewsAPI python client. See <https://newsapi.org/docs/client-libraries/python> for more documentation.
         execution_date: datetime marking the left bound of the time interval for which we want to crawl news
         n_hours_delta: number of hours after the execution_date marking the right bound of the time interval for which we want to crawl news
+        concurrency: number of API calls sent at the same time.
+        limiter: rate and daily budget of API calls.
+        max_api_calls: budget of API calls of this timeframe.
         q: Keywords or a phrase to search for in the article title and body.  See the official News API
             `documentation <https://newsapi.org/docs/endpoints/everything>`_ for search syntax and examples.
         qintitle: Keywords or a phrase to search for in the article title and body.  See the official News API
@@ -102,78 +240,59 @@ def get_news(
             to remove from the results.
         language: The 2-letter ISO-639-1 code of the language you want to get headlines for.
             See :data:`newsapi.const.languages` for the set of allowed values.
-        sort_by: The order to sort articles in.
-            See :data:`newsapi.const.sort_method` for the set of allowed values.
 
     Returns:
-        List of all articles published between `execution_date` and `exection_date` + `n_hours_delta` * hours.
+        the articles published between `execution_date` and `exection_date` + `n_hours_delta` * hours,
+        and the time windows that could not be crawled.
     """
     logger.info("Getting articles for " + str(execution_date))
-    left_bound: str = execution_date.strftime("%Y-%m-%dT%H:%M:%S")
-
-    # initialise the loop
-    records: List[Dict[str, Any]] = []
-    has_more_articles = True
-    min_published_at: datetime = execution_date + datetime.timedelta(
-        hours=n_hours_delta
-    )
-    api_calls: int = 0
-
-    def _get_right_bound(min_published_at: datetime) -> str:
-        # we have to remove 1 second for the midnight query because newsapi right bound is inclusive
-        right_bound = (min_published_at - datetime.timedelta(seconds=1)).strftime(
-            "%Y-%m-%dT%H:%M:%S"
-        )
-        return right_bound
-
-    while has_more_articles:
-        if api_calls >= MAX_API_CALLS:
-            logger.info("Stopping because of too many API calls")
-            break
-        logger.info("Querying for news published until " + str(min_published_at))
-        resp: Dict[str, Any] = newsapi.get_everything(
-            from_param=left_bound,
-            to=_get_right_bound(min_published_at),
+    # the bounds are sent without timezone, as before
+    start = execution_date.replace(tzinfo=None)
+    page_size = newsapi_params.pop("page_size", 100)
+    newsapi_params.pop("sort_by", None)
+
+    def _fetch(window: Window) -> Dict[str, Any]:
+        # the scheduler relies on the most recent articles being returned first
+        return newsapi.get_everything(
+            **window.params(),
+            sort_by="publishedAt",
+            page_size=page_size,
             **newsapi_params,
         )
-        api_calls += 1
-        new_records: List[Dict[str, Any]] = resp["articles"]
-        records += new_records
-        # NewsAPI free license limits to 100 results per API call
-        # If there were more articles during that time, split the API calls to return all articles from that hour
-        has_more_articles = len(new_records) == 100
-
-        if not len(records):
-            raise ValueError(f"No news found for {execution_date}")
-        min_published_at: datetime = datetime.datetime.strptime(
-            min(r["publishedAt"] for r in records), "%Y-%m-%dT%H:%M:%SZ"
-        )
-
-    logger.info(f"Done. Spent {api_calls} NewsAPI calls")
 
-    # Our assumption is that articles returned are from 1 given hour only, if that is not the case, raise an exception
-    max_published_at: datetime = datetime.datetime.strptime(
-        max(r["publishedAt"] for r in records), "%Y-%m-%dT%H:%M:%SZ"
+    report = crawl(
+        _fetch,
+        start,
+        start + datetime.timedelta(hours=n_hours_delta),
+        limiter=limiter,
+        max_api_calls=max_api_calls,
+        concurrency=concurrency,
+        page_size=page_size,
     )
-    if max_published_at - min_published_at > datetime.timedelta(hours=n_hours_delta):
-        raise ValueError(
-            f"The span of publish dates of the crawled articles is more than {n_hours_delta} hours."
-        )
-
-    return records
+    logger.info(f"Done. {report.summary()}")
+    for gap in report.gaps:
+        logger.warning(f"Coverage gap: {gap.to_dict()}")
+    return report
 
 
 def main(
     execution_date: datetime.datetime,
     n_hours_delta: int = 1,
     refresh_sources: bool = False,
-) -> None:
-    """Get all french articles for a given timeframe and store them to S3."""
+    concurrency: int = 4,
+) -> CrawlReport:
+    """Get all french articles for a given timeframe and store them to S3.
+
+    The wall time of the crawl and of the upload, and the latencies of the NewsAPI and S3
+    requests, are logged as a structured JSON line at the end (see `metrics.RunMetrics`).
+    """
+    metrics = RunMetrics()
     # before using any API credits, check S3 credentials
-    sts = boto3.client("sts")
-    sts.get_caller_identity()
+    if S3_ENDPOINT_URL is None:
+        sts = boto3.session.Session().client("sts")
+        sts.get_caller_identity()
 
-    newsapi = NewsApiClient(api_key=newsapi_key)
+    newsapi = get_client(concurrency, metrics)
 
     # using the `sources` param of /v2/everything endpoint is useful only if the sources are officially supported by NewsAPI.
     # for French, NewsAPI has only 5 sources that you can pass to `sources`, which is only a fraction of the articles you can get.
@@ -193,23 +312,51 @@ def main(
         sort_by="publishedAt",
         page_size=100,
     )
-    articles = get_news(
-        newsapi,
-        execution_date=execution_date,
-        n_hours_delta=n_hours_delta,
-        **newsapi_params,
-    )
+    with metrics.stage("crawl") as span:
+        report = get_news(
+            newsapi,
+            execution_date=execution_date,
+            n_hours_delta=n_hours_delta,
+            concurrency=concurrency,
+            **newsapi_params,
+        )
+        span.rows = len(report.articles)
+    articles = report.articles
 
+    s3_bucket = S3_BUCKET
+    s3_prefix = get_s3_prefix(execution_date)
+    s3 = get_s3(metrics)
     if len(articles):
-        s3_bucket = "articles-louisguitton"
-        s3_key = f"newsapi/{execution_date.strftime('%Y-%m-%d/%H')}/articles.json"
+        s3_key = f"{s3_prefix}/articles.json{S3_EXTENSIONS[S3_COMPRESSION]}"
         logger.info(f"Writing to s3://{s3_bucket}/{s3_key}")
-        s3 = boto3.resource("s3")
-        s3object = s3.Object(s3_bucket, s3_key)
-        jsonline_body = "\n".join([json.dumps(a) for a in articles])
-        s3object.put(Body=(bytes(jsonline_body.encode("UTF-8"))))
+        with metrics.stage("write_s3", rows=len(articles)):
+            size = write_jsonl(s3, s3_bucket, s3_key, articles)
+        logger.info(f"Wrote {size / 1024:,.0f}KB ({S3_COMPRESSION})")
+        # remove the partition written by a previous crawl with another compression
+        for extension in S3_EXTENSIONS.values():
+            if f"{s3_prefix}/articles.json{extension}" != s3_key:
+                s3.Object(s3_bucket, f"{s3_prefix}/articles.json{extension}").delete()
     else:
         logger.info("No articles to write to S3")
+    if report.gaps:
+        # keep track of the missing time windows, to crawl them again later
+        s3_key = f"{s3_prefix}/gaps.json"
+        logger.info(
+            f"Writing {len(report.gaps)} coverage gaps to s3://{s3_bucket}/{s3_key}"
+        )
+        s3.Object(s3_bucket, s3_key).put(
+            Body=json.dumps([gap.to_dict() for gap in report.gaps]).encode("UTF-8")
+        )
+    else:
+        # the gaps of a previous crawl are filled
+        s3.Object(s3_bucket, f"{s3_prefix}/gaps.json").delete()
+    metrics.log(
+        logger,
+        execution_date=execution_date.isoformat(),
+        api_calls=report.api_calls,
+        gaps=len(report.gaps),
+    )
+    return report
 
 
 def run(event, context) -> None:
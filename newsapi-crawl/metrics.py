@@ -0,0 +1,98 @@
+"""Metrics of a crawl, logged as one structured JSON line.
+
+The crawler is deployed on its own, so it can't use `station.instrument`: this is the same
+idea, sized for a Lambda. Stages record wall time, rows and the peak memory of the process,
+and the latencies of the NewsAPI and S3 requests are hooked on the `requests` session and
+on the boto3 client events. CloudWatch Logs Insights can then query the fields, e.g.
+`filter message = "metrics" | stats max(stages.crawl.seconds) by bin(1d)`.
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List
+
+import requests
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class _Span:
+    def __init__(self, rows: int = 0):
+        self.rows = rows
+
+
+class RunMetrics:
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.latencies: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0) -> Iterator[_Span]:
+        """Records the wall time of the block; set `rows` on the yielded span."""
+        span = _Span(rows)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.stages[name] = {
+                "seconds": round(time.perf_counter() - start, 3),
+                "rows": span.rows,
+                "peak_rss_mb": round(_peak_rss_mb(), 1),
+            }
+
+    def observe(self, service: str, seconds: float) -> None:
+        with self._lock:
+            self.latencies.setdefault(service, []).append(seconds * 1000)
+
+    def hook_session(self, session: requests.Session, service: str = "newsapi") -> None:
+        """Records the latency of the responses of `session`."""
+
+        def _on_response(response: requests.Response, *args, **kwargs):
+            self.observe(service, response.elapsed.total_seconds())
+
+        session.hooks["response"].append(_on_response)
+
+    def hook_boto3(self, client, service: str = "s3") -> None:
+        """Records the latency of the calls of a boto3 client, by operation."""
+
+        def _before_call(context: Dict, **kwargs):
+            context["metrics_start"] = time.perf_counter()
+
+        def _after_call(model, context: Dict, **kwargs):
+            if "metrics_start" in context:
+                seconds = time.perf_counter() - context["metrics_start"]
+                self.observe(f"{service}.{model.name}", seconds)
+
+        client.meta.events.register(f"before-call.{service}", _before_call)
+        client.meta.events.register(f"after-call.{service}", _after_call)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            summary = {
+                service: {
+                    "count": len(latencies),
+                    "p50_ms": round(_percentile(latencies, 0.5), 1),
+                    "p95_ms": round(_percentile(latencies, 0.95), 1),
+                    "max_ms": round(max(latencies), 1),
+                }
+                for service, latencies in sorted(self.latencies.items())
+            }
+        return {"stages": self.stages, "requests": summary}
+
+    def log(self, logger: logging.Logger, **fields) -> None:
+        logger.info(json.dumps({"message": "metrics", **fields, **self.to_dict()}))
@@ -0,0 +1,256 @@
+"""Adaptive, concurrent crawl of a NewsAPI time window.
+
+The NewsAPI developer plan only returns the first page (up to 100 articles) of a query, so a
+busy time window has to be split into sub-windows that each fit in one page. Pages are
+sorted by `publishedAt`, newest first: a full page covers the window from its oldest article
+to the right bound, and the rest of the window is bisected into sub-windows sized after the
+`totalResults` of the response. Sub-windows are independent, so they are fetched
+concurrently, under a `RateLimiter`.
+
+Windows that cannot be crawled (budget exhausted, failed requests, more than a page of
+articles published in the same second) are reported as `Gap`s instead of being dropped.
+"""
+
+import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import logging
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+PUBLISHED_AT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+ONE_SECOND = datetime.timedelta(seconds=1)
+
+
+class RateLimiter:
+    """Allows `rate` requests per second, and `daily_budget` requests per UTC day.
+
+    Share one limiter between crawls (e.g. the days of a backfill) to respect the daily
+    quota of the NewsAPI plan.
+    """
+
+    def __init__(self, rate: float = 5.0, daily_budget: int = 100):
+        self.rate = rate
+        self.daily_budget = daily_budget
+        self.used = 0
+        self._day: Optional[datetime.date] = None
+        self._next_request = 0.0
+        self._lock = threading.Lock()
+
+    def _roll_day(self) -> None:
+        today = datetime.datetime.utcnow().date()
+        if today != self._day:
+            self._day, self.used = today, 0
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            self._roll_day()
+            return self.daily_budget - self.used
+
+    def acquire(self) -> bool:
+        """Waits for the next request slot, or returns False if the daily budget is spent."""
+        with self._lock:
+            self._roll_day()
+            if self.used >= self.daily_budget:
+                return False
+            self.used += 1
+            now = time.monotonic()
+            delay = max(0.0, self._next_request - now)
+            self._next_request = max(now, self._next_request) + 1 / self.rate
+        if delay:
+            time.sleep(delay)
+        return True
+
+
+@dataclass(frozen=True)
+class Window:
+    """Time window, both bounds inclusive like the `from` and `to` params of NewsAPI."""
+
+    start: datetime.datetime
+    end: datetime.datetime
+
+    @property
+    def seconds(self) -> int:
+        return int((self.end - self.start).total_seconds()) + 1
+
+    def params(self) -> Dict[str, str]:
+        return {
+            "from_param": self.start.strftime(DATETIME_FORMAT),
+            "to": self.end.strftime(DATETIME_FORMAT),
+        }
+
+    def split(self, n_parts: int) -> List["Window"]:
+        """Splits into at most `n_parts` consecutive windows of whole seconds."""
+        n_parts = max(1, min(n_parts, self.seconds))
+        bounds = [
+            self.start + i * self.seconds // n_parts * ONE_SECOND
+            for i in range(n_parts + 1)
+        ]
+        return [
+            Window(left, right - ONE_SECOND) for left, right in zip(bounds, bounds[1:])
+        ]
+
+
+@dataclass
+class Gap:
+    """Time window whose articles could not all be crawled."""
+
+    window: Window
+    reason: str
+
+    def to_dict(self) -> Dict[str, str]:
+        return {
+            "from": self.window.start.strftime(DATETIME_FORMAT),
+            "to": self.window.end.strftime(DATETIME_FORMAT),
+            "reason": self.reason,
+        }
+
+
+@dataclass
+class CrawlReport:
+    articles: List[Dict[str, Any]] = field(default_factory=list)
+    api_calls: int = 0
+    gaps: List[Gap] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def complete(self) -> bool:
+        return not self.gaps
+
+    def summary(self) -> str:
+        gaps = ", ".join(
+            f"{gap.window.start:%H:%M:%S}-{gap.window.end:%H:%M:%S} ({gap.reason})"
+            for gap in self.gaps
+        )
+        return (
+            f"{len(self.articles)} articles in {self.api_calls} API calls and"
+            f" {self.elapsed:.1f}s, {len(self.gaps)} coverage gaps"
+            + (f": {gaps}" if gaps else "")
+        )
+
+
+def _merge(gaps: List[Gap]) -> List[Gap]:
+    """Merges consecutive gaps of the same reason."""
+    merged: List[Gap] = []
+    for gap in sorted(gaps, key=lambda gap: gap.window.start):
+        previous = merged[-1] if merged else None
+        if (
+            previous
+            and previous.reason == gap.reason
+            and previous.window.end + ONE_SECOND >= gap.window.start
+        ):
+            end = max(previous.window.end, gap.window.end)
+            merged[-1] = Gap(Window(previous.window.start, end), gap.reason)
+        else:
+            merged.append(gap)
+    return merged
+
+
+def _get_published_at(article: Dict[str, Any]) -> datetime.datetime:
+    return datetime.datetime.strptime(article["publishedAt"], PUBLISHED_AT_FORMAT)
+
+
+def _plan(
+    window: Window, response: Dict[str, Any], page_size: int, max_splits: int
+) -> Tuple[List[Window], List[Gap]]:
+    """Sub-windows left to crawl after a full page, and the window it cannot split."""
+    articles = response["articles"]
+    # the frontier of this window only depends on its own page
+    oldest = min(_get_published_at(article) for article in articles)
+    if oldest >= window.end:
+        # a full page published in the last second: it can't be paginated any further
+        gaps = [Gap(Window(window.end, window.end), f"more than {page_size} articles")]
+        if window.start >= window.end:
+            return [], gaps
+        return [Window(window.start, window.end - ONE_SECOND)], gaps
+
+    # the articles published at `oldest` may be truncated, so they are fetched again
+    rest = Window(window.start, oldest)
+    newer = sum(_get_published_at(article) > oldest for article in articles)
+    expected = response.get("totalResults", len(articles)) - newer
+    n_parts = math.ceil(1.25 * expected / page_size)
+    return rest.split(max(2, min(n_parts, max_splits))), []
+
+
+def crawl(
+    fetch: Callable[[Window], Dict[str, Any]],
+    start: datetime.datetime,
+    end: datetime.datetime,
+    limiter: RateLimiter = None,
+    max_api_calls: int = None,
+    concurrency: int = 4,
+    page_size: int = 100,
+    max_splits: int = 8,
+) -> CrawlReport:
+    """Crawls all the articles published from `start` (inclusive) to `end` (exclusive).
+
+    Arguments:
+        fetch: sends the NewsAPI request of a window, sorted by `publishedAt`.
+        start: left bound of the time window.
+        end: right bound of the time window.
+        limiter: rate and daily budget of the requests.
+        max_api_calls: budget of this crawl.
+        concurrency: number of windows fetched at the same time.
+        page_size: number of articles of a full page.
+        max_splits: maximum number of sub-windows a window is split into.
+
+    Returns:
+        the articles, deduplicated, and the windows that could not be crawled.
+    """
+    limiter = limiter or RateLimiter()
+    report = CrawlReport()
+    articles: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    frontier = [Window(start, end - ONE_SECOND)]
+    exhausted = False
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        pending = {}
+        while frontier or pending:
+            while frontier and len(pending) < concurrency and not exhausted:
+                exhausted = (
+                    max_api_calls is not None and report.api_calls >= max_api_calls
+                ) or not limiter.acquire()
+                if not exhausted:
+                    window = frontier.pop()
+                    logger.info(
+                        f"Querying for news published from {window.start} to {window.end}"
+                    )
+                    pending[executor.submit(fetch, window)] = window
+                    report.api_calls += 1
+            if exhausted:
+                report.gaps.extend(
+                    Gap(window, "API budget exhausted") for window in frontier
+                )
+                frontier = []
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                window = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as exception:
+                    logger.warning(f"Failed to crawl {window}: {exception}")
+                    report.gaps.append(Gap(window, f"request failed: {exception}"))
+                    continue
+                for article in response["articles"]:
+                    articles[(article["url"], article["publishedAt"])] = article
+                if len(response["articles"]) >= page_size:
+                    windows, gaps = _plan(window, response, page_size, max_splits)
+                    frontier.extend(windows)
+                    report.gaps.extend(gaps)
+
+    report.articles = sorted(
+        articles.values(), key=lambda article: article["publishedAt"], reverse=True
+    )
+    report.gaps = _merge(report.gaps)
+    report.elapsed = time.perf_counter() - started
+    return report
@@ -0,0 +1,98 @@
+"""Async access to the datasets, on a pooled `AsyncElasticsearch` client.
+
+Requires `elasticsearch[async]` (aiohttp).
+"""
+
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_scan
+from elasticsearch_dsl.response import Hit, Response
+
+from station.dataset import DatasetBase, msearch_body, parse_msearch
+
+_clients: Dict[Tuple[str, ...], AsyncElasticsearch] = {}
+
+
+def get_async_client(
+    hosts: List[str] = ["localhost:9200"], maxsize: int = 25
+) -> AsyncElasticsearch:
+    """Return the client of `hosts`, created once per process.
+
+    Each client keeps a pool of up to `maxsize` HTTP connections per node.
+    """
+    key = tuple(hosts)
+    if key not in _clients:
+        _clients[key] = AsyncElasticsearch(hosts=hosts, maxsize=maxsize)
+    return _clients[key]
+
+
+async def close_async_clients() -> None:
+    while _clients:
+        _, client = _clients.popitem()
+        await client.close()
+
+
+class AsyncDataset:
+    """Async counterpart of a dataset: `async for hit in AsyncDataset(Dataset(...))`."""
+
+    def __init__(self, dataset: DatasetBase, client: AsyncElasticsearch = None):
+        self.dataset = dataset
+        self.client = client or get_async_client()
+
+    @property
+    def search(self):
+        return self.dataset.search
+
+    async def __aiter__(self) -> AsyncIterator[Hit]:
+        async for hit in async_scan(
+            self.client,
+            query=self.search.to_dict(),
+            index=self.search._index,
+            size=self.dataset.page_size,
+            **self.search._params,
+        ):
+            yield self.search._get_result(hit)
+
+    async def count(self) -> int:
+        response = await self.client.count(
+            index=self.search._index, body=self.search.to_dict(count=True)
+        )
+        return response["count"]
+
+    async def execute(self, size: int = 10) -> Response:
+        """First page of hits."""
+        search = self.search.extra(size=size)
+        raw = await self.client.search(
+            index=search._index, body=search.to_dict(), **search._params
+        )
+        return Response(search, raw)
+
+
+async def execute_batch(
+    datasets: List[DatasetBase],
+    size: int = 10,
+    max_searches: int = 100,
+    client: AsyncElasticsearch = None,
+    raise_on_error: bool = True,
+) -> List[Optional[Response]]:
+    """Async `DatasetBatch.execute`: the `_msearch` requests are sent concurrently.
+
+    Like `MultiSearch.execute`, a failed search raises a `TransportError`, or is returned as
+    None when `raise_on_error` is False.
+    """
+    client = client or get_async_client()
+
+    async def _msearch(chunk: List[DatasetBase]) -> List[Optional[Response]]:
+        searches = [dataset.search.extra(size=size) for dataset in chunk]
+        raw = await client.msearch(body=msearch_body(searches))
+        return parse_msearch(searches, raw, raise_on_error)
+
+    chunks = await asyncio.gather(
+        *(
+            _msearch(datasets[start : start + max_searches])
+            for start in range(0, len(datasets), max_searches)
+        )
+    )
+    return [response for chunk in chunks for response in chunk]
@@ -1,46 +1,265 @@
-import json
+"""Sync the articles to Algolia.
 
+Only the differences with the last sync are sent: a local snapshot keeps the content hash of
+each `objectID` pushed to the index, so that unchanged records are skipped, and records that
+disappeared from the corpus are deleted. Records are sent in batches bounded by count and
+size, over concurrent requests.
+"""
 
-from algoliasearch.search_client import SearchClient
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from hashlib import md5
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
+from algoliasearch.search_client import SearchClient
+import typer
 
 from station.config import Settings
-from station.utils import load_data
+from station.constants import (
+    ALGOLIA_INDEX,
+    ALGOLIA_SETTINGS,
+    ALGOLIA_SNAPSHOT_PATH,
+    DEDUP_INDEX_PATH,
+)
+from station.dedup import mark_near_duplicates, NearDuplicateIndex
+from station import instrument
+from station.utils import iter_data, load_data, records_from_frame
 
-settings = Settings()
 
+def _get_record_hash(record: Dict) -> str:
+    return md5(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
 
-def main():
-    articles_df = load_data()
 
-    # load data to Algolia
+@dataclass
+class SyncStats:
+    added: int = 0
+    changed: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+    requests: int = 0
+    settings_applied: bool = False
+    elapsed: float = 0.0
+
+    @property
+    def operations(self) -> int:
+        """Algolia operations spent, one per record sent or deleted and per settings update."""
+        return self.added + self.changed + self.deleted + int(self.settings_applied)
+
+    @property
+    def operations_saved(self) -> int:
+        """Operations saved over pushing all the records and the settings."""
+        return self.unchanged + int(not self.settings_applied)
+
+    def summary(self) -> str:
+        return (
+            f"{self.added} added, {self.changed} changed, {self.deleted} deleted,"
+            f" {self.unchanged} unchanged in {self.requests} requests and"
+            f" {self.elapsed:.1f}s; settings {'applied' if self.settings_applied else 'unchanged'};"
+            f" {self.operations} operations spent, {self.operations_saved} saved"
+        )
+
+
+class AlgoliaSync:
+    """Pushes the differences between the records and the last sync to an Algolia index.
+
+    Arguments:
+        index: Algolia `SearchIndex`, or anything with the same `save_objects`,
+            `delete_objects`, `get_settings` and `set_settings` methods.
+        snapshot_path: JSON file of the content hash of each synced `objectID`.
+        max_batch_size: maximum number of records per request.
+        max_batch_bytes: maximum size of the records of a request.
+        concurrency: number of requests sent at the same time.
+    """
+
+    def __init__(
+        self,
+        index,
+        snapshot_path: str = ALGOLIA_SNAPSHOT_PATH,
+        max_batch_size: int = 1000,
+        max_batch_bytes: int = 5 * 1024 * 1024,
+        concurrency: int = 4,
+    ):
+        self.index = index
+        self.snapshot_path = snapshot_path
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.concurrency = concurrency
+        self.snapshot: Dict[str, str] = {}
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "r") as fh:
+                self.snapshot = json.load(fh)["objects"]
+        self.stats = SyncStats()
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def _diff(self, records: Iterable[Dict]) -> Iterator[Tuple[Dict, str]]:
+        """Added and changed records, with their hash."""
+        for record in records:
+            object_id = record["objectID"]
+            self._seen.add(object_id)
+            record_hash = _get_record_hash(record)
+            previous = self.snapshot.get(object_id)
+            if previous == record_hash:
+                self.stats.unchanged += 1
+                continue
+            if previous is None:
+                self.stats.added += 1
+            else:
+                self.stats.changed += 1
+            yield record, record_hash
+
+    def _batches(self, items: Iterable) -> Iterator[List]:
+        batch, batch_bytes = [], 0
+        for item in items:
+            size = len(json.dumps(item[0] if isinstance(item, tuple) else item))
+            if batch and (
+                len(batch) >= self.max_batch_size
+                or batch_bytes + size > self.max_batch_bytes
+            ):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(item)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def _save_batch(self, batch: List) -> None:
+        with instrument.request("algolia.save_objects"):
+            self.index.save_objects([record for record, _ in batch])
+        with self._lock:
+            self.stats.requests += 1
+            for record, record_hash in batch:
+                self.snapshot[record["objectID"]] = record_hash
+
+    def _delete_batch(self, object_ids: List[str]) -> None:
+        with instrument.request("algolia.delete_objects"):
+            self.index.delete_objects(object_ids)
+        with self._lock:
+            self.stats.requests += 1
+            for object_id in object_ids:
+                self.snapshot.pop(object_id, None)
+
+    def _run(self, send: Callable[[List], None], batches: Iterator[List]) -> None:
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            futures = []
+            for batch in batches:
+                futures.append(executor.submit(send, batch))
+                # bound the records held in memory by the pending requests
+                if len(futures) >= 2 * self.concurrency:
+                    futures.pop(0).result()
+            for future in futures:
+                future.result()
+
+    def push(self, records: Iterable[Dict]) -> None:
+        """Sends the records that were added or changed since the last sync."""
+        self._run(self._save_batch, self._batches(self._diff(records)))
+
+    def delete_missing(self) -> None:
+        """Deletes the records of the last sync that were not pushed in this one."""
+        missing = [
+            object_id for object_id in self.snapshot if object_id not in self._seen
+        ]
+        self.stats.deleted += len(missing)
+        self._run(self._delete_batch, self._batches(missing))
+
+    def apply_settings(self, settings: Dict) -> None:
+        """Sets the index settings, only if they differ from the current ones."""
+        with instrument.request("algolia.get_settings"):
+            current = self.index.get_settings()
+        self.stats.requests += 1
+        if any(current.get(name) != value for name, value in settings.items()):
+            with instrument.request("algolia.set_settings"):
+                self.index.set_settings(settings)
+            self.stats.requests += 1
+            self.stats.settings_applied = True
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump({"objects": self.snapshot}, fh)
+        os.replace(tmp_path, self.snapshot_path)
+
+
+def _get_index():
+    settings = Settings()
     client = SearchClient.create(
         settings.algolia_application_id, settings.algolia_admin_api_key
     )
-    index = client.init_index("articles")
-    records = json.loads(
-        articles_df
-        .rename(columns={"article_id": "objectID"})
-        .to_json(orient="records")
+    return client.init_index(ALGOLIA_INDEX)
+
+
+def sync(
+    stream: bool = False,
+    near_dedup: str = None,
+    concurrency: int = 4,
+    max_batch_size: int = 1000,
+    snapshot_path: str = ALGOLIA_SNAPSHOT_PATH,
+    index=None,
+) -> SyncStats:
+    """Syncs the articles to the Algolia `index`, only sending what changed since the last sync.
+
+    `index` defaults to the index of the Algolia application of the settings, pass a fake
+    `SearchIndex` to sync locally.
+    """
+    # in stream mode, only one partition of articles is held in memory at a time
+    batches = iter_data() if stream else [load_data()]
+    # near_dedup="mark" sets `duplicate_of` on near-duplicates, "collapse" skips them
+    near_duplicates = NearDuplicateIndex.load(DEDUP_INDEX_PATH) if near_dedup else None
+
+    # load data to Algolia
+    algolia_sync = AlgoliaSync(
+        index if index is not None else _get_index(),
+        snapshot_path=snapshot_path,
+        max_batch_size=max_batch_size,
+        concurrency=concurrency,
     )
-    index.save_objects(records)
+    start = time.perf_counter()
+    try:
+        for articles_df in batches:
+            if near_duplicates is not None:
+                articles_df = mark_near_duplicates(
+                    articles_df, near_duplicates, collapse=near_dedup == "collapse"
+                )
+            with instrument.stage("algolia.push", rows=len(articles_df)):
+                algolia_sync.push(
+                    records_from_frame(
+                        articles_df.rename(columns={"article_id": "objectID"})
+                    )
+                )
+        with instrument.stage("algolia.delete_missing"):
+            algolia_sync.delete_missing()
+    finally:
+        # the records sent before a failure are not sent again
+        algolia_sync.save()
+    if near_duplicates is not None:
+        near_duplicates.save(DEDUP_INDEX_PATH)
 
     # configure Algolia
-    index.set_settings(
-        {
-            "searchableAttributes": ["content", "description", "title"],
-            "ranking": [
-                "desc(publishedAt)",
-                "typo",
-                "geo",
-                "words",
-                "filters",
-                "proximity",
-                "attribute",
-                "exact",
-                "custom",
-            ],
-            "indexLanguages": ["fr"],
-            "attributesForFaceting": ["source_name"],
-        }
+    algolia_sync.apply_settings(ALGOLIA_SETTINGS)
+    algolia_sync.stats.elapsed = time.perf_counter() - start
+    return algolia_sync.stats
+
+
+def main(
+    stream: bool = False,
+    near_dedup: str = None,
+    concurrency: int = 4,
+    max_batch_size: int = 1000,
+):
+    """Syncs the articles to Algolia, only sending what changed since the last sync."""
+    stats = sync(
+        stream=stream,
+        near_dedup=near_dedup,
+        concurrency=concurrency,
+        max_batch_size=max_batch_size,
     )
+    typer.echo(stats.summary())
+
+
+if __name__ == "__main__":
+    instrument.run(main)
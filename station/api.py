@@ -0,0 +1,331 @@
+"""HTTP search service over `ArticleSearch`.
+
+Run it with `uvicorn station.api:app`. Responses are cached in memory (TTL + LRU) under a
+normalized key of the query, filters and page, and identical requests in flight share a
+single ElasticSearch round-trip, so that popular facet pages are served from memory.
+Facets without full-text query are answered from the rollups of `station.rollups`.
+Per-endpoint latency histograms are exposed on `/metrics`.
+
+Reference:
+    - [FastAPI](https://fastapi.tiangolo.com/)
+    - [Request coalescing](https://en.wikipedia.org/wiki/Cache_stampede)
+"""
+
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import datetime
+import json
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch_dsl import A, Q
+from elasticsearch_dsl.faceted_search import FacetedResponse
+from fastapi import Depends, FastAPI, Query, Request
+
+from station import rollups
+from station.aio import AsyncDataset, close_async_clients, get_async_client
+from station.constants import ES_INDEX, ES_ROLLUP_INDEX
+from station.dataset import MLTDataset
+from station.instrument import LatencyHistogram
+from station.search import ArticleSearch
+
+
+class ResponseCache:
+    """Least-recently-used cache whose entries expire after `ttl` seconds.
+
+    `get_or_fetch` also coalesces concurrent misses of the same key into one fetch.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @classmethod
+    def _normalize(cls, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {
+                name: cls._normalize(v)
+                for name, v in value.items()
+                if v is not None and v != []
+            }
+        if isinstance(value, (list, tuple)):
+            return sorted((cls._normalize(v) for v in value), key=str)
+        return value
+
+    @classmethod
+    def make_key(cls, endpoint: str, **params) -> str:
+        """Key of a request, independent of the case and spacing of the query and of the
+        order of the filters.
+
+        Filter values and ids are kept verbatim: keyword filters are case-sensitive.
+        """
+        if isinstance(params.get("q"), str):
+            params["q"] = re.sub(r"\s+", " ", params["q"].strip().lower())
+        return json.dumps(
+            [endpoint, cls._normalize(params)], sort_keys=True, default=str
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+
+            def _done(task: asyncio.Future) -> None:
+                self._inflight.pop(key, None)
+                if not task.cancelled() and task.exception() is None:
+                    self.set(key, task.result())
+
+            task.add_done_callback(_done)
+        else:
+            self.coalesced += 1
+        # a client disconnecting must not cancel the fetch other requests wait for
+        return await asyncio.shield(task)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_async_clients()
+
+
+app = FastAPI(title="station", lifespan=lifespan)
+cache = ResponseCache()
+histograms: Dict[str, LatencyHistogram] = {}
+
+
+def get_client() -> AsyncElasticsearch:
+    return get_async_client()
+
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    milliseconds = (time.perf_counter() - start) * 1000
+    route = request.scope.get("route")
+    endpoint = route.path if route else "unmatched"
+    histograms.setdefault(endpoint, LatencyHistogram()).observe(milliseconds)
+    response.headers["Server-Timing"] = f"app;dur={milliseconds:.1f}"
+    return response
+
+
+def _get_filters(
+    source_name: List[str], week: Optional[datetime.date]
+) -> Dict[str, Any]:
+    filters = {}
+    if source_name:
+        filters["source_name"] = source_name
+    if week:
+        filters["publishing_frequency"] = datetime.datetime.combine(
+            week, datetime.time()
+        )
+    return filters
+
+
+def _serialize_facets(facets: Dict[str, List]) -> Dict[str, List[Dict]]:
+    return {
+        name: [
+            {"value": value, "count": count, "selected": selected}
+            for value, count, selected in facet
+        ]
+        for name, facet in facets.items()
+    }
+
+
+def _serialize_hit(hit) -> Dict[str, Any]:
+    document = hit.to_dict()
+    document.pop("content_hash", None)
+    return {"id": hit.meta.id, "score": hit.meta.score, **document}
+
+
+async def _faceted_search(
+    client: AsyncElasticsearch,
+    q: str,
+    filters: Dict[str, Any],
+    start: int,
+    size: int,
+) -> FacetedResponse:
+    faceted = ArticleSearch(query=q or None, filters=filters)[start : start + size]
+    search = faceted._s
+    raw = await client.search(
+        index=search._index or [ES_INDEX], body=search.to_dict(), **search._params
+    )
+    response = FacetedResponse(search, raw)
+    response._faceted_search = faceted
+    return response
+
+
+@app.get("/search")
+async def search(
+    q: str = "",
+    source_name: List[str] = Query([]),
+    week: datetime.date = None,
+    page: int = Query(1, ge=1),
+    size: int = Query(10, ge=0, le=100),
+    client: AsyncElasticsearch = Depends(get_client),
+):
+    """Articles matching `q`, with the facets of the results."""
+    filters = _get_filters(source_name, week)
+
+    async def _fetch() -> Dict[str, Any]:
+        response = await _faceted_search(client, q, filters, (page - 1) * size, size)
+        return {
+            "total": response.hits.total.value,
+            "hits": [_serialize_hit(hit) for hit in response],
+            "facets": _serialize_facets(response.facets.to_dict()),
+        }
+
+    key = cache.make_key("search", q=q, filters=filters, page=page, size=size)
+    return await cache.get_or_fetch(key, _fetch)
+
+
+@app.get("/facets")
+async def facets(
+    q: str = "",
+    source_name: List[str] = Query([]),
+    week: datetime.date = None,
+    client: AsyncElasticsearch = Depends(get_client),
+):
+    """Facets of the articles matching `q`, without the hits."""
+    filters = _get_filters(source_name, week)
+
+    async def _fetch() -> Dict[str, Any]:
+        if not q.strip():
+            raw = await client.search(
+                index=ES_ROLLUP_INDEX, body=rollups.facets_body(filters)
+            )
+            response = rollups.parse_facets(raw, filters)
+            return {
+                "total": response["total"],
+                "facets": _serialize_facets(response["facets"]),
+            }
+        response = await _faceted_search(client, q, filters, 0, 0)
+        return {
+            "total": response.hits.total.value,
+            "facets": _serialize_facets(response.facets.to_dict()),
+        }
+
+    key = cache.make_key("facets", q=q, filters=filters)
+    return await cache.get_or_fetch(key, _fetch)
+
+
+@app.get("/entities")
+async def entities(
+    q: str = "",
+    source_name: List[str] = Query([]),
+    week: datetime.date = None,
+    fact: str = None,
+    size: int = Query(5, ge=1, le=100),
+    client: AsyncElasticsearch = Depends(get_client),
+):
+    """Most frequent entities (of type `fact`, e.g. ORG) of the articles matching `q`."""
+    filters = _get_filters(source_name, week)
+
+    async def _fetch() -> Dict[str, Any]:
+        if not q.strip():
+            raw = await client.search(
+                index=ES_ROLLUP_INDEX, body=rollups.entities_body(filters, fact, size)
+            )
+            return {
+                "entities": [
+                    {"value": value, "count": count}
+                    for value, count in rollups.parse_entities(raw)
+                ]
+            }
+        faceted = ArticleSearch(query=q, filters=filters)
+        # facet filters narrow the aggregations too, unlike the post_filter of facets
+        search = faceted.query(faceted.search(), q)
+        for facet_filter in faceted._filters.values():
+            search = search.filter(facet_filter)
+        search = search.extra(size=0)
+        nested = search.aggs.bucket("texta_facts", "nested", path="texta_facts")
+        if fact:
+            nested = nested.bucket("fact", "filter", Q("term", texta_facts__fact=fact))
+        nested.bucket(
+            "related_entities",
+            A(
+                "terms",
+                field="texta_facts.str_val",
+                size=size,
+                order=[{"_count": "desc"}, {"_key": "asc"}],
+            ),
+        )
+        raw = await client.search(index=ES_INDEX, body=search.to_dict())
+        aggregation = raw["aggregations"]["texta_facts"]
+        buckets = (aggregation["fact"] if fact else aggregation)["related_entities"]
+        return {
+            "entities": [
+                {"value": bucket["key"], "count": bucket["doc_count"]}
+                for bucket in buckets["buckets"]
+            ]
+        }
+
+    key = cache.make_key("entities", q=q, filters=filters, fact=fact, size=size)
+    return await cache.get_or_fetch(key, _fetch)
+
+
+@app.get("/similar/{article_id}")
+async def similar(
+    article_id: str,
+    size: int = Query(10, ge=1, le=100),
+    client: AsyncElasticsearch = Depends(get_client),
+):
+    """Articles like `article_id`, with ES `more_like_this`."""
+
+    async def _fetch() -> Dict[str, Any]:
+        dataset = MLTDataset(like=[{"_id": article_id, "_index": ES_INDEX}])
+        dataset.search = dataset.search.index(ES_INDEX)
+        response = await AsyncDataset(dataset, client).execute(size=size)
+        return {"hits": [_serialize_hit(hit) for hit in response]}
+
+    key = cache.make_key("similar", article_id=article_id, size=size)
+    return await cache.get_or_fetch(key, _fetch)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Latency histograms per endpoint, and the statistics of the response cache."""
+    return {
+        "latency": {
+            endpoint: histogram.to_dict()
+            for endpoint, histogram in sorted(histograms.items())
+        },
+        "cache": cache.stats,
+    }
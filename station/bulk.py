@@ -0,0 +1,208 @@
+"""Parallel, back-pressured bulk indexing engine for ElasticSearch."""
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import json
+import logging
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import BulkIndexError, expand_action
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = 429
+RETRYABLE_ERROR_TYPES = {"cluster_block_exception", "es_rejected_execution_exception"}
+
+
+def _dumps(data) -> str:
+    # same settings as elasticsearch.serializer.JSONSerializer
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+@dataclass
+class ChunkStats:
+    docs: int
+    bytes: int
+    latency: float
+    retries: int = 0
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.docs / self.latency if self.latency else float("inf")
+
+
+@dataclass
+class BulkStats:
+    succeeded: int = 0
+    failed: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+    chunks: List[ChunkStats] = field(default_factory=list)
+
+    @property
+    def docs_per_sec(self) -> float:
+        return self.succeeded / self.elapsed if self.elapsed else 0.0
+
+    def latency_percentile(self, q: float) -> float:
+        if not self.chunks:
+            return 0.0
+        return float(np.percentile([c.latency for c in self.chunks], q))
+
+    def summary(self) -> str:
+        return (
+            f"{self.succeeded} docs in {self.elapsed:.1f}s ({self.docs_per_sec:,.0f} docs/sec), "
+            f"{len(self.chunks)} chunks (p50 {self.latency_percentile(50) * 1000:.0f}ms, "
+            f"p95 {self.latency_percentile(95) * 1000:.0f}ms), {self.retries} retries, "
+            f"{self.failed} failed"
+        )
+
+
+def _is_retryable(item: Dict) -> bool:
+    error = item.get("error") or {}
+    return item.get("status") == RETRYABLE_STATUS or (
+        isinstance(error, dict) and error.get("type") in RETRYABLE_ERROR_TYPES
+    )
+
+
+class BulkIndexer:
+    """Index documents with a pool of threads sending bulk requests.
+
+    Actions are expanded like `elasticsearch.helpers.bulk` does (`_id`, `_op_type`, ...),
+    serialized once, and grouped in chunks bounded both by document count and by bytes.
+    At most `thread_count * queue_factor` chunks are in flight, so a fast producer cannot
+    buffer the whole corpus in memory.
+    Documents rejected with a 429 or a `cluster_block_exception` are retried with an
+    exponential backoff; other errors are collected and raised as a `BulkIndexError`.
+
+    The client only needs a `bulk(body=..., index=...)` method, so any stub transport works.
+    """
+
+    def __init__(
+        self,
+        client,
+        index: str = None,
+        thread_count: int = 4,
+        chunk_size: int = 500,
+        max_chunk_bytes: int = 10 * 1024 * 1024,
+        max_retries: int = 5,
+        initial_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        queue_factor: int = 2,
+        on_chunk: Callable[[ChunkStats], None] = None,
+    ):
+        self.client = client
+        self.index = index
+        self.thread_count = thread_count
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.max_in_flight = thread_count * queue_factor
+        self.on_chunk = on_chunk
+
+    def _chunk_actions(self, actions: Iterable) -> Iterator[List[Tuple[str, str]]]:
+        chunk, chunk_bytes = [], 0
+        for action in actions:
+            meta, data = expand_action(action)
+            lines = (
+                _dumps(meta) if isinstance(meta, dict) else meta,
+                None if data is None else _dumps(data),
+            )
+            # +1 per line for the newline
+            size = sum(len(line.encode("utf-8")) + 1 for line in lines if line)
+            if chunk and (
+                len(chunk) == self.chunk_size
+                or chunk_bytes + size > self.max_chunk_bytes
+            ):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(lines)
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.max_backoff, self.initial_backoff * 2**attempt)
+
+    def _send_chunk(self, chunk: List[Tuple[str, str]]) -> Tuple[ChunkStats, int, List]:
+        start = time.perf_counter()
+        retries, succeeded, errors = 0, 0, []
+        body_bytes = 0
+        for attempt in range(self.max_retries + 1):
+            body = "".join(
+                line + "\n" for lines in chunk for line in lines if line is not None
+            )
+            body_bytes = body_bytes or len(body.encode("utf-8"))
+            try:
+                response = self.client.bulk(body=body, index=self.index)
+            except TransportError as exception:
+                retryable = exception.status_code == RETRYABLE_STATUS or (
+                    exception.error in RETRYABLE_ERROR_TYPES
+                )
+                if not retryable or attempt == self.max_retries:
+                    raise
+                retries += 1
+                time.sleep(self._backoff(attempt))
+                continue
+
+            to_retry = []
+            for lines, item in zip(chunk, response["items"]):
+                op_type, result = item.popitem()
+                if 200 <= result.get("status", 500) < 300:
+                    succeeded += 1
+                elif _is_retryable(result) and attempt < self.max_retries:
+                    to_retry.append(lines)
+                else:
+                    errors.append({op_type: result})
+            if not to_retry:
+                break
+            retries += 1
+            chunk = to_retry
+            time.sleep(self._backoff(attempt))
+
+        stats = ChunkStats(
+            docs=succeeded + len(errors),
+            bytes=body_bytes,
+            latency=time.perf_counter() - start,
+            retries=retries,
+        )
+        return stats, succeeded, errors
+
+    def bulk(self, actions: Iterable) -> BulkStats:
+        """Index `actions` and return the indexing statistics."""
+        stats = BulkStats()
+        errors = []
+        start = time.perf_counter()
+
+        def _collect(done: Set[Future]):
+            for future in done:
+                chunk_stats, succeeded, chunk_errors = future.result()
+                stats.chunks.append(chunk_stats)
+                stats.succeeded += succeeded
+                stats.failed += len(chunk_errors)
+                stats.retries += chunk_stats.retries
+                errors.extend(chunk_errors)
+                logger.debug(
+                    f"Indexed chunk of {chunk_stats.docs} docs in {chunk_stats.latency:.3f}s"
+                    f" ({chunk_stats.docs_per_sec:,.0f} docs/sec)"
+                )
+                if self.on_chunk:
+                    self.on_chunk(chunk_stats)
+
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            in_flight: Set[Future] = set()
+            for chunk in self._chunk_actions(actions):
+                if len(in_flight) >= self.max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    _collect(done)
+                in_flight.add(executor.submit(self._send_chunk, chunk))
+            _collect(wait(in_flight).done)
+
+        stats.elapsed = time.perf_counter() - start
+        if errors:
+            raise BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+        return stats
@@ -0,0 +1,111 @@
+"""Result cache for `station.dataset` queries."""
+
+from collections import OrderedDict
+from hashlib import sha256
+import json
+import os
+from typing import Any, Dict, Optional
+
+
+class ResultCache:
+    """Least-recently-used cache of JSON-serializable query results.
+
+    Entries are kept in memory up to `max_memory_bytes` and persisted as JSON files in
+    `directory` up to `max_disk_bytes`; the least recently used entries are evicted first.
+    Results are keyed by the query and the index generation, so that re-ingesting the
+    index invalidates them.
+
+    Reference:
+        - [functools.lru_cache](https://docs.python.org/3/library/functools.html#functools.lru_cache)
+    """
+
+    def __init__(
+        self,
+        directory: str = "data/cache/datasets",
+        max_memory_bytes: int = 256 * 1024 * 1024,
+        max_disk_bytes: int = 2 * 1024 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._memory_sizes: Dict[str, int] = {}
+        self._memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        return sha256(
+            json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+        path = self._path(key)
+        if os.path.exists(path):
+            with open(path, "r") as fh:
+                value = json.load(fh)
+            # refresh the access time used by the disk eviction
+            os.utime(path)
+            self._set_memory(key, value, os.path.getsize(path))
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        with open(f"{path}.tmp", "w") as fh:
+            json.dump(value, fh)
+        os.replace(f"{path}.tmp", path)
+        self._set_memory(key, value, os.path.getsize(path))
+        self._evict_disk()
+
+    def _set_memory(self, key: str, value: Any, size: int) -> None:
+        if size > self.max_memory_bytes:
+            return
+        self._memory_bytes += size - self._memory_sizes.get(key, 0)
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        self._memory_sizes[key] = size
+        while self._memory_bytes > self.max_memory_bytes:
+            evicted, _ = self._memory.popitem(last=False)
+            self._memory_bytes -= self._memory_sizes.pop(evicted)
+
+    def _evict_disk(self) -> None:
+        entries = [
+            entry
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".json")
+        ]
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= self.max_disk_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def clear(self) -> None:
+        self._memory.clear()
+        self._memory_sizes.clear()
+        self._memory_bytes = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                os.remove(entry.path)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+        }
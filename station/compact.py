@@ -0,0 +1,90 @@
+"""Compacts the raw JSONL partitions into a partitioned Parquet dataset.
+
+The dataset is laid out as `<destination>/date=<YYYY-MM-DD>/hour=<HH>/articles.parquet`
+and read back by `station.utils.load_data(<destination>, start_date=..., sources=...)`.
+"""
+
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import typer
+
+from station import instrument
+from station.constants import PARQUET_PATH
+from station.utils import _get_partition_date, _read_partition, list_partitions
+
+ARTICLES_SCHEMA = pa.schema(
+    [
+        ("author", pa.dictionary(pa.int32(), pa.string())),
+        ("title", pa.string()),
+        ("description", pa.string()),
+        ("url", pa.string()),
+        ("urlToImage", pa.string()),
+        ("publishedAt", pa.timestamp("ms", tz="UTC")),
+        ("content", pa.string()),
+        ("source_id", pa.string()),
+        ("source_name", pa.dictionary(pa.int32(), pa.string())),
+        ("article_id", pa.string()),
+    ]
+)
+
+
+def _to_table(articles_df: pd.DataFrame) -> pa.Table:
+    columns = {}
+    for field in ARTICLES_SCHEMA:
+        if field.name in articles_df:
+            values = articles_df[field.name]
+        else:
+            values = pd.Series(None, index=articles_df.index, dtype=object)
+        if not pa.types.is_timestamp(field.type):
+            # columns that are null in a whole partition are parsed as float NaN
+            values = values.astype(object).where(values.notna(), None)
+        columns[field.name] = pa.array(values, type=field.type, from_pandas=True)
+    return pa.table(columns, schema=ARTICLES_SCHEMA)
+
+
+def _get_destination(path: str, destination: str) -> str:
+    hour = os.path.basename(os.path.dirname(path))
+    return os.path.join(
+        destination,
+        f"date={_get_partition_date(path)}",
+        f"hour={hour}",
+        "articles.parquet",
+    )
+
+
+def main(
+    source: str = "data/newsapi/*/*/articles.json*",
+    destination: str = PARQUET_PATH,
+    force: bool = False,
+    row_group_size: int = 10_000,
+):
+    """Compacts the JSONL partitions into a Parquet dataset.
+
+    Only the partitions that are new or modified since their last compaction are converted,
+    unless --force is used.
+    """
+    compacted = 0
+    for path in list_partitions(source):
+        output = _get_destination(path, destination)
+        if (
+            not force
+            and os.path.exists(output)
+            and os.path.getmtime(output) >= os.path.getmtime(path)
+        ):
+            continue
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        pq.write_table(
+            _to_table(_read_partition(path)),
+            output,
+            row_group_size=row_group_size,
+            compression="zstd",
+        )
+        compacted += 1
+    typer.echo(f'Compacted {compacted} partitions into "{destination}"')
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -1,4 +1,67 @@
+import copy
+
+# Parquet dataset written by station.compact
+PARQUET_PATH = "data/parquet/articles"
+
+# MinHash-LSH index of station.dedup, shared by the ES and Algolia ingests
+DEDUP_INDEX_PATH = "data/dedup/index.pkl"
+
+# ids of the articles exported by station.management.label_studio
+LABEL_STUDIO_LEDGER_PATH = "data/manifests/label_studio.txt"
+
+ALGOLIA_INDEX = "articles"
+# content hash of each record pushed to Algolia, to only send the differences
+ALGOLIA_SNAPSHOT_PATH = "data/manifests/algolia.json"
+ALGOLIA_SETTINGS = {
+    "searchableAttributes": ["content", "description", "title"],
+    "ranking": [
+        "desc(publishedAt)",
+        "typo",
+        "geo",
+        "words",
+        "filters",
+        "proximity",
+        "attribute",
+        "exact",
+        "custom",
+    ],
+    "indexLanguages": ["fr"],
+    "attributesForFaceting": ["source_name"],
+}
+
+# alias pointing to the live versioned index, "articles_v{n}"
 ES_INDEX = "articles"
+ES_MANIFEST_PATH = "data/manifests/es.json"
+
+ES_SETTINGS = {
+    "number_of_shards": 1,
+    "number_of_replicas": 0,
+    # TODO:
+    # "index": {
+    #     "analysis": analysis_settings
+    # }
+}
+# settings applied while a new version is bulk-loaded, then replaced by ES_SEARCH_SETTINGS
+ES_BULK_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+ES_SEARCH_SETTINGS = {
+    "refresh_interval": None,
+    "number_of_replicas": ES_SETTINGS["number_of_replicas"],
+}
+
+# counts per (source, day) and (source, day, entity) answering the facets, see station.rollups
+ES_ROLLUP_INDEX = "articles_rollups"
+ES_ROLLUP_MAPPING = {
+    "dynamic": "strict",
+    "properties": {
+        "kind": {"type": "keyword"},
+        "source_name": {"type": "keyword"},
+        "day": {"type": "date", "format": "strict_date_optional_time||epoch_millis"},
+        "fact": {"type": "keyword"},
+        "str_val": {"type": "keyword"},
+        "count": {"type": "long"},
+        "generation": {"type": "keyword"},
+    },
+}
 
 ES_ALL_FIELD = "all_text"
 ES_MAPPING = {
@@ -25,9 +88,73 @@ ES_MAPPING = {
         "published_at": {"type": "date"},
         "url": {"type": "keyword"},
         "url_to_image": {"type": "keyword"},
+        # _id of the first article of a near-duplicate cluster, see station.dedup
+        "duplicate_of": {"type": "keyword"},
+        # md5 of the document, used by incremental ingests to skip unchanged documents
+        "content_hash": {"type": "keyword", "index": False},
         ES_ALL_FIELD: {
             "type": "text",
             "store": True,
         },
+        # named entities written by station.management.ner, in the texta-rest format
+        "texta_facts": {
+            "type": "nested",
+            "properties": {
+                "doc_path": {"type": "keyword"},
+                "fact": {"type": "keyword"},
+                "str_val": {"type": "keyword"},
+                "spans": {"type": "keyword", "index": False},
+            },
+        },
+        # spaCy model used to enrich the document, missing until it is enriched
+        "ner_model": {"type": "keyword"},
+    },
+}
+
+# fields whose values are copied to ES_ALL_FIELD, in the order of the documents
+ES_ALL_FIELD_SOURCES = ["title", "description", "content"]
+
+
+def _override_fields(mapping: dict, overrides: dict) -> dict:
+    mapping = copy.deepcopy(mapping)
+    for name, options in overrides.items():
+        mapping["properties"][name].update(options)
+    return mapping
+
+
+# settings and mappings of the indices created by station.management.es --mapping-profile,
+# compared by `python -m station.management.profiles`
+ES_MAPPING_PROFILES = {
+    "default": {"settings": ES_SETTINGS, "mappings": ES_MAPPING},
+    # smallest on disk: DEFLATE instead of LZ4 for stored fields, no stored copy of the text
+    # (`Dataset` rebuilds it from `_source`; `more_like_this` of indexed documents reads its
+    # term vectors, without positions), no positions for the long text fields (no phrase
+    # queries on them), unindexed urls
+    "compact": {
+        "settings": dict(ES_SETTINGS, codec="best_compression"),
+        "mappings": _override_fields(
+            ES_MAPPING,
+            {
+                "description": {"index_options": "freqs"},
+                "content": {"index_options": "freqs"},
+                ES_ALL_FIELD: {
+                    "store": False,
+                    "index_options": "freqs",
+                    "term_vector": "yes",
+                },
+                "url": {"index": False},
+                "url_to_image": {"index": False, "doc_values": False},
+            },
+        ),
+    },
+    # fastest to read: the stored text is exported by `Dataset` without parsing `_source`,
+    # term vectors serve `more_like_this` without re-analyzing the documents, and the terms
+    # dictionaries, norms and doc values are preloaded in the filesystem cache
+    "fast-read": {
+        "settings": dict(ES_SETTINGS, **{"store.preload": ["nvd", "dvd", "tim"]}),
+        "mappings": _override_fields(
+            ES_MAPPING, {ES_ALL_FIELD: {"term_vector": "with_positions"}}
+        ),
     },
 }
+ES_MAPPING_PROFILE = "default"
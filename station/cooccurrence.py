@@ -0,0 +1,215 @@
+"""Sparse word co-occurrence / association model.
+
+Reference:
+    - [Word-word co-occurrence matrix with sklearn](https://stackoverflow.com/a/37822989)
+"""
+
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import json
+import os
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+
+
+def _chunks(docs: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    chunk = []
+    for doc in docs:
+        chunk.append(doc or "")
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _count_document_frequencies(chunk: List[str], vectorizer_params: Dict) -> Counter:
+    vectorizer = CountVectorizer(binary=True, **vectorizer_params)
+    try:
+        X = vectorizer.fit_transform(chunk)
+    except ValueError:
+        # empty vocabulary, e.g. a chunk of empty documents
+        return Counter()
+    counts = np.asarray(X.sum(axis=0)).ravel()
+    return Counter(dict(zip(vectorizer.get_feature_names_out(), counts.tolist())))
+
+
+_vectorizer: CountVectorizer = None
+
+
+def _init_vectorizer(vocabulary: Dict[str, int], binary: bool, vectorizer_params: Dict):
+    global _vectorizer
+    _vectorizer = CountVectorizer(
+        vocabulary=vocabulary, binary=binary, **vectorizer_params
+    )
+
+
+def _cooccurrence_chunk(chunk: List[str]) -> sp.csr_matrix:
+    X = _vectorizer.transform(chunk)
+    return (X.T @ X).tocsr()
+
+
+def _map(fn, iterable, n_jobs: int, initializer=None, initargs=()):
+    if n_jobs == 1:
+        if initializer:
+            initializer(*initargs)
+        yield from map(fn, iterable)
+        return
+    with ProcessPoolExecutor(
+        max_workers=n_jobs, initializer=initializer, initargs=initargs
+    ) as executor:
+        yield from executor.map(fn, iterable)
+
+
+class _Terms(Sequence):
+    """Sorted terms stored as one UTF-8 buffer and offsets, so that it can be memory-mapped."""
+
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, terms: List[str]) -> "_Terms":
+        encoded = [term.encode("utf-8") for term in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.buffer[start:end].tobytes().decode("utf-8")
+
+    def index(self, term: str) -> int:
+        # UTF-8 byte order is code point order, so the buffer is sorted like Python strings
+        position = bisect_left(self, term)
+        if position == len(self) or self[position] != term:
+            raise KeyError(term)
+        return position
+
+
+class CooccurrenceModel:
+    """Word associations: P(word | term), from document co-occurrence counts.
+
+    Row `i` of the matrix holds the co-occurrence counts of term `i` with every other term,
+    normalized by the count of term `i` (the diagonal), like:
+    `Xc = X.T * X; Xc_norm = diags(1 / Xc.diagonal()) * Xc; Xc_norm.setdiag(0)`.
+    Everything is kept in CSR, and `save` writes the arrays as `.npy` files that `load`
+    memory-maps, so that lookups are instant after a restart.
+    """
+
+    def __init__(
+        self,
+        terms: _Terms,
+        data: np.ndarray,
+        indices: np.ndarray,
+        indptr: np.ndarray,
+    ):
+        self.terms = terms
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+
+    @classmethod
+    def fit(
+        cls,
+        docs: Iterable[str],
+        min_count: int = 5,
+        chunk_size: int = 10_000,
+        n_jobs: int = 1,
+        binary: bool = False,
+        **vectorizer_params,
+    ) -> "CooccurrenceModel":
+        """Build the model in document chunks.
+
+        Arguments:
+            docs: the documents; iterated twice (vocabulary, then co-occurrences),
+                so it has to be a re-iterable like a list or a dataframe column.
+            min_count: minimum number of documents a term has to appear in to be kept.
+            chunk_size: number of documents vectorized at once.
+            n_jobs: number of processes vectorizing chunks; 1 runs in the current process.
+            binary: count a term once per document instead of once per occurrence.
+            vectorizer_params: passed to `CountVectorizer`, e.g. `stop_words`.
+        """
+        document_frequencies = Counter()
+        for counts in _map(
+            partial(_count_document_frequencies, vectorizer_params=vectorizer_params),
+            _chunks(docs, chunk_size),
+            n_jobs,
+        ):
+            document_frequencies.update(counts)
+        terms = sorted(t for t, n in document_frequencies.items() if n >= min_count)
+        vocabulary = {term: i for i, term in enumerate(terms)}
+
+        Xc = sp.csr_matrix((len(terms), len(terms)), dtype=np.float64)
+        for chunk_cooccurrences in _map(
+            _cooccurrence_chunk,
+            _chunks(docs, chunk_size),
+            n_jobs,
+            initializer=_init_vectorizer,
+            initargs=(vocabulary, binary, vectorizer_params),
+        ):
+            Xc = Xc + chunk_cooccurrences
+
+        diagonal = Xc.diagonal()
+        with np.errstate(divide="ignore"):
+            g = sp.diags(np.where(diagonal > 0, 1.0 / diagonal, 0.0))
+        Xc_norm = (g @ Xc).tocsr()
+        Xc_norm.setdiag(0)
+        Xc_norm.eliminate_zeros()
+        Xc_norm.sort_indices()
+        return cls(
+            _Terms.from_list(terms),
+            Xc_norm.data.astype(np.float32),
+            Xc_norm.indices.astype(np.int32),
+            Xc_norm.indptr.astype(np.int64),
+        )
+
+    @property
+    def matrix(self) -> sp.csr_matrix:
+        n_terms = len(self.terms)
+        return sp.csr_matrix(
+            (self.data, self.indices, self.indptr), shape=(n_terms, n_terms), copy=False
+        )
+
+    def top_associated(self, term: str, k: int = 20) -> List[Tuple[str, float]]:
+        """Top `k` terms associated with `term`, with their scores, highest first."""
+        i = self.terms.index(term)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        scores = np.asarray(self.data[start:end])
+        columns = np.asarray(self.indices[start:end])
+        if len(scores) > k:
+            top = np.argpartition(scores, -k)[-k:]
+            scores, columns = scores[top], columns[top]
+        order = np.argsort(-scores, kind="stable")
+        return [(self.terms[columns[j]], float(scores[j])) for j in order]
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        np.save(os.path.join(directory, "term_buffer.npy"), self.terms.buffer)
+        np.save(os.path.join(directory, "term_offsets.npy"), self.terms.offsets)
+        with open(os.path.join(directory, "meta.json"), "w") as fh:
+            json.dump({"n_terms": len(self.terms), "nnz": int(len(self.data))}, fh)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "CooccurrenceModel":
+        mmap_mode = "r" if mmap else None
+
+        def _load(name: str) -> np.ndarray:
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        return cls(
+            _Terms(_load("term_buffer"), _load("term_offsets")),
+            _load("data"),
+            _load("indices"),
+            _load("indptr"),
+        )
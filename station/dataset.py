@@ -1,31 +1,367 @@
-from typing import List, Dict, Union
+import copy
+from queue import Full, Queue
+from threading import Event, Thread
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Union
 
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import scan
 from elasticsearch_dsl import connections, Search, Q
+from elasticsearch_dsl.response import Response
 from elasticsearch_dsl.query import MoreLikeThis
+import numpy as np
+import pandas as pd
+import pyarrow as pa
 
-from station.constants import ES_ALL_FIELD
+from station.cache import ResultCache
+from station.constants import ES_ALL_FIELD, ES_ALL_FIELD_SOURCES
+
+PAGINATIONS = ("scroll", "sliced", "search_after")
+# Arrow types of the mapped types whose `_source` values always convert the same way; other
+# fields (dates, objects, ...) get the type inferred from their first non-null batch
+ARROW_TYPES = {
+    "text": pa.string(),
+    "keyword": pa.string(),
+    "long": pa.int64(),
+    "integer": pa.int64(),
+    "short": pa.int64(),
+    "byte": pa.int64(),
+    "double": pa.float64(),
+    "float": pa.float64(),
+    "half_float": pa.float64(),
+    "boolean": pa.bool_(),
+}
 
 
 class DatasetBase:
+    """Iterable over the hits of an ElasticSearch query.
+
+    Arguments:
+        query: the query to run.
+        date_field: sort the hits by this field, most recent first.
+        stored_fields: stored fields to return with each hit.
+        cache: cache the hits and count of the query.
+        pagination: how to go through all the hits:
+            "scroll" uses a single scroll,
+            "sliced" runs `slices` scrolls concurrently and merges them (in no particular order),
+            a single scroll when `slices` is 1,
+            "search_after" pages through a point in time, keeping the relevance order.
+        slices: number of concurrent scrolls of the "sliced" pagination.
+        page_size: number of hits fetched per request.
+    """
+
     def __init__(
         self,
         query: Q,
         date_field: str = None,
         stored_fields: str = None,
+        cache: ResultCache = None,
+        pagination: str = "scroll",
+        slices: int = 4,
+        page_size: int = 1000,
     ):
+        if pagination not in PAGINATIONS:
+            raise ValueError(f"pagination must be one of {PAGINATIONS}")
+        if slices < 1:
+            raise ValueError("slices must be at least 1")
+        self.pagination = pagination
+        self.slices = slices
+        self.page_size = page_size
+        self.throughput: Dict[str, float] = {}
         self.search = Search()
         if date_field:
             self.search = self.search.sort(f"-{date_field}")
         if stored_fields:
             self.search = self.search.params(stored_fields=stored_fields)
         self.search = self.search.query(query)
+        self.cache = cache
+
+    @property
+    def _client(self):
+        return connections.get_connection(self.search._using)
+
+    def _get_generation(self) -> List[str]:
+        """Index generation marker, bumped by `station.management.es` on every ingest."""
+        mappings = self._client.indices.get_mapping(index=self.search._index or "_all")
+        return sorted(
+            f'{index}:{mapping["mappings"].get("_meta", {}).get("generation")}'
+            for index, mapping in mappings.items()
+        )
+
+    def _cached(self, kind: str, fetch: Callable):
+        if self.cache is None:
+            return fetch()
+        key = self.cache.make_key(
+            kind=kind,
+            pagination=self.pagination,
+            index=self.search._index,
+            body=self.search.to_dict(),
+            params=self.search._params,
+            generation=self._get_generation(),
+        )
+        value = self.cache.get(key)
+        if value is None:
+            value = fetch()
+            self.cache.set(key, value)
+        return value
+
+    def _scroll(self, **query) -> Iterator[Dict]:
+        """Raw hits, like `Search.scan` gets them.
+
+        ref: https://elasticsearch-dsl.readthedocs.io/en/latest/search_dsl.html?highlight=scroll#pagination
+        """
+        return scan(
+            self._client,
+            query=dict(self.search.to_dict(), **query),
+            index=self.search._index,
+            size=self.page_size,
+            **self.search._params,
+        )
+
+    def _sliced_scroll(self) -> Iterator[Dict]:
+        """ref: https://www.elastic.co/guide/en/elasticsearch/reference/7.x/paginate-search-results.html#slice-scroll"""
+        if self.slices == 1:
+            # ES rejects a slice whose max is not greater than 1
+            yield from self._scroll()
+            return
+        done = object()
+        stop = Event()
+        hits: Queue = Queue(maxsize=self.slices * self.page_size)
+
+        def _put(item) -> bool:
+            # gives up once the consumer stopped, instead of blocking on a full queue
+            while not stop.is_set():
+                try:
+                    hits.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def _worker(slice_id: int):
+            scroll = self._scroll(slice={"id": slice_id, "max": self.slices})
+            try:
+                for hit in scroll:
+                    if not _put(hit):
+                        break
+            except Exception as exception:
+                _put(exception)
+            finally:
+                # closing `scan` clears the scroll context of the slice
+                scroll.close()
+                _put(done)
+
+        for slice_id in range(self.slices):
+            Thread(target=_worker, args=(slice_id,), daemon=True).start()
+
+        running = self.slices
+        try:
+            while running:
+                hit = hits.get()
+                if hit is done:
+                    running -= 1
+                elif isinstance(hit, Exception):
+                    raise hit
+                else:
+                    yield hit
+        finally:
+            stop.set()
+
+    def _search_after(self) -> Iterator[Dict]:
+        """ref: https://www.elastic.co/guide/en/elasticsearch/reference/7.x/paginate-search-results.html#search-after"""
+        keep_alive = "1m"
+        pit_id = self._client.open_point_in_time(
+            index=self.search._index or "_all", keep_alive=keep_alive
+        )["id"]
+        body = self.search.extra(size=self.page_size).to_dict()
+        # _shard_doc is a cheap unique tiebreaker, hits with equal sort values are not lost
+        body["sort"] = body.get("sort", ["_score"]) + [{"_shard_doc": "asc"}]
+        try:
+            while True:
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                response = self._client.search(body=body, **self.search._params)
+                pit_id = response.get("pit_id", pit_id)
+                page = response["hits"]["hits"]
+                yield from page
+                if len(page) < self.page_size:
+                    break
+                body["search_after"] = page[-1]["sort"]
+        finally:
+            self._client.close_point_in_time(body={"id": pit_id})
+
+    def _fetch_hits(self) -> Iterator[Dict]:
+        fetch = {
+            "scroll": self._scroll,
+            "sliced": self._sliced_scroll,
+            "search_after": self._search_after,
+        }[self.pagination]
+        start, n_hits = time.perf_counter(), 0
+        for hit in fetch():
+            n_hits += 1
+            yield hit
+        elapsed = time.perf_counter() - start
+        self.throughput = {
+            "hits": n_hits,
+            "seconds": elapsed,
+            "hits_per_sec": n_hits / elapsed if elapsed else 0.0,
+        }
 
     def __iter__(self):
-        """ref: https://elasticsearch-dsl.readthedocs.io/en/latest/search_dsl.html?highlight=scroll#pagination"""
-        return self.search.scan()
+        if self.cache is None:
+            hits = self._fetch_hits()
+        else:
+            hits = self._cached("hits", lambda: list(self._fetch_hits()))
+        return (self.search._get_result(hit) for hit in hits)
 
     def __len__(self):
-        return self.search.count()
+        return self._cached("count", self.search.count)
+
+    def _is_stored(self, field: str) -> bool:
+        """Whether `field` is stored in every index searched, see ES_MAPPING_PROFILES."""
+        response = self._client.indices.get_field_mapping(
+            fields=field, index=self.search._index or "_all"
+        )
+        return all(
+            mapping["mappings"].get(field, {}).get("mapping", {}).get(field, {})
+            # `store` is only returned when it is set
+            .get("store", False)
+            for mapping in response.values()
+        )
+
+    def _field_types(self, fields: List[str]) -> Dict[str, pa.DataType]:
+        """Arrow types of the `fields` mapped with a type of ARROW_TYPES."""
+        if not fields:
+            return {}
+        response = self._client.indices.get_field_mapping(
+            fields=",".join(fields), index=self.search._index or "_all"
+        )
+        types = {}
+        for mapping in response.values():
+            for name, field in mapping["mappings"].items():
+                es_type = field.get("mapping", {}).get(name, {}).get("type")
+                if name in fields and es_type in ARROW_TYPES:
+                    types.setdefault(name, ARROW_TYPES[es_type])
+        return types
+
+    def _iter_columns(
+        self, batch_size: int, fields: List[str], stored_fields: List[str]
+    ) -> Iterator[Dict[str, list]]:
+        fields, stored_fields = fields or [], stored_fields or []
+        # copy_to fields that are not stored (e.g. the "compact" profile) are rebuilt from
+        # the `_source` of the fields copied to them, in the same order
+        rebuilt = [
+            name
+            for name in stored_fields
+            if name == ES_ALL_FIELD and not self._is_stored(name)
+        ]
+        sources = [*fields, *(ES_ALL_FIELD_SOURCES if rebuilt else [])]
+        params = [name for name in stored_fields if name not in rebuilt]
+
+        dataset = copy.copy(self)
+        dataset.search = (
+            self.search.source(includes=sources) if sources else self.search
+        )
+        if params:
+            dataset.search = dataset.search.params(stored_fields=",".join(params))
+            if not sources:
+                dataset.search = dataset.search.source(False)
+
+        columns = {name: [] for name in ["_id", *fields, *stored_fields]}
+        for hit in dataset._fetch_hits():
+            columns["_id"].append(hit["_id"])
+            source = hit.get("_source", {})
+            for name in fields:
+                columns[name].append(source.get(name))
+            for name in stored_fields:
+                if name in rebuilt:
+                    values = [source.get(f) for f in ES_ALL_FIELD_SOURCES]
+                    values = [value for value in values if value is not None]
+                else:
+                    # stored fields are returned as lists, e.g. one value per copy_to source
+                    values = hit.get("fields", {}).get(name)
+                columns[name].append("\n".join(map(str, values)) if values else None)
+            if len(columns["_id"]) == batch_size:
+                yield columns
+                columns = {name: [] for name in columns}
+        if columns["_id"]:
+            yield columns
+        self.throughput = dataset.throughput
+
+    def to_batches(
+        self,
+        batch_size: int = 1000,
+        fields: List[str] = None,
+        stored_fields: List[str] = None,
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """Yield the hits as columns of `batch_size` rows.
+
+        Only `fields` (from `_source`) and `stored_fields` are fetched, and no `Hit` object is
+        built, so that text can be fed to `CountVectorizer` or `nlp.pipe` batch by batch.
+
+        Arguments:
+            batch_size: number of rows per batch, the last batch can be smaller.
+            fields: `_source` fields to fetch, e.g. ["title", "published_at"].
+            stored_fields: stored fields to fetch, e.g. ["all_text"]; multiple values are
+                joined with a newline.
+
+        Yields:
+            a dictionary of column name to array, always including "_id".
+        """
+        for columns in self._iter_columns(batch_size, fields, stored_fields):
+            yield {
+                name: np.array(values, dtype=object) for name, values in columns.items()
+            }
+
+    def to_arrow(
+        self,
+        batch_size: int = 10_000,
+        fields: List[str] = None,
+        stored_fields: List[str] = None,
+    ) -> pa.Table:
+        """Collect the hits in an Arrow table, see `to_batches`.
+
+        Every batch is built with the same schema: `_id` and the stored fields are strings,
+        mapped fields get their Arrow type, so that a column which is null in a whole batch
+        (e.g. `author`) does not change the schema of that batch.
+        """
+        fields, stored_fields = fields or [], stored_fields or []
+        names = ["_id", *fields, *stored_fields]
+        types = {name: pa.string() for name in ["_id", *stored_fields]}
+        types.update(self._field_types(fields))
+        batches = [
+            {
+                name: pa.array(values, type=types.get(name))
+                for name, values in columns.items()
+            }
+            for columns in self._iter_columns(batch_size, fields, stored_fields)
+        ]
+        for name in names:
+            if name not in types:
+                inferred = [
+                    batch[name].type
+                    for batch in batches
+                    if batch[name].type != pa.null()
+                ]
+                types[name] = inferred[0] if inferred else pa.string()
+        schema = pa.schema([(name, types[name]) for name in names])
+        return pa.Table.from_batches(
+            [
+                pa.RecordBatch.from_arrays(
+                    [batch[name].cast(types[name]) for name in names], schema=schema
+                )
+                for batch in batches
+            ],
+            schema=schema,
+        )
+
+    def to_pandas(
+        self,
+        batch_size: int = 10_000,
+        fields: List[str] = None,
+        stored_fields: List[str] = None,
+    ) -> pd.DataFrame:
+        """Collect the hits in a dataframe, see `to_batches`."""
+        return self.to_arrow(batch_size, fields, stored_fields).to_pandas()
 
 
 class Dataset(DatasetBase):
@@ -35,16 +371,32 @@ class Dataset(DatasetBase):
         match_fields: List[str] = [ES_ALL_FIELD],
         date_field: str = None,
         stored_fields: str = None,
+        cache: ResultCache = None,
+        pagination: str = "scroll",
+        slices: int = 4,
+        page_size: int = 1000,
     ):
         # multi_match is ElasticSearch's Swiss Army knife for constructing queries across multiple fields.
         query = Q("multi_match", query=query, fields=match_fields)
         super().__init__(
-            query=query, date_field=date_field, stored_fields=stored_fields
+            query=query,
+            date_field=date_field,
+            stored_fields=stored_fields,
+            cache=cache,
+            pagination=pagination,
+            slices=slices,
+            page_size=page_size,
         )
 
 
 class MLTDataset(DatasetBase):
-    """ref: https://www.elastic.co/guide/en/elasticsearch/reference/master/query-dsl-mlt-query.html"""
+    """ref: https://www.elastic.co/guide/en/elasticsearch/reference/master/query-dsl-mlt-query.html
+
+    Defaults to the "search_after" pagination, which returns the full result set in relevance order.
+    I don't have the explanation yet but when running .scan() for MLT queries,
+    I was getting the following error:
+    `ScanError: Scroll request has only succeeded on 1 (+0 skipped) shards out of 7.`
+    """
 
     def __init__(
         self,
@@ -60,6 +412,10 @@ class MLTDataset(DatasetBase):
         match_fields: List[str] = [ES_ALL_FIELD],
         date_field: str = None,
         stored_fields: str = None,
+        cache: ResultCache = None,
+        pagination: str = "search_after",
+        slices: int = 4,
+        page_size: int = 1000,
     ):
         query = MoreLikeThis(
             like=like,
@@ -72,27 +428,116 @@ class MLTDataset(DatasetBase):
             max_word_length=max_word_length,
             stop_words=stop_words,
         )
-        super().__init__(query, date_field=date_field, stored_fields=stored_fields)
+        super().__init__(
+            query,
+            date_field=date_field,
+            stored_fields=stored_fields,
+            cache=cache,
+            pagination=pagination,
+            slices=slices,
+            page_size=page_size,
+        )
         self.search: Search = self.search.exclude("ids", values=exclude)
 
-    def __iter__(self):
-        """Use execute instead of scan for MLT query.
 
-        I don't have the explanation yet but when running .scan(),
-        I was getting the following error:
-        `ScanError: Scroll request has only succeeded on 1 (+0 skipped) shards out of 7.`
-        """
-        return (hit for hit in self.search.execute())
+# metadata ES accepts in the header line of a search of `_msearch`, the other params of a
+# search (e.g. `stored_fields`) go in its body
+MSEARCH_HEADER_KEYS = {
+    "index",
+    "routing",
+    "preference",
+    "search_type",
+    "request_cache",
+    "allow_partial_search_results",
+    "expand_wildcards",
+    "ignore_unavailable",
+    "allow_no_indices",
+    "ignore_throttled",
+}
+
+
+def msearch_body(searches: List[Search]) -> List[Dict]:
+    """Header and body lines of `searches`, unlike `MultiSearch` which puts every param of a
+    search in its header."""
+    body = []
+    for search in searches:
+        header = {"index": search._index} if search._index else {}
+        extra = {}
+        for name, value in search._params.items():
+            (header if name in MSEARCH_HEADER_KEYS else extra)[name] = value
+        body += [header, search.extra(**extra).to_dict()]
+    return body
+
+
+def parse_msearch(
+    searches: List[Search], raw: Dict, raise_on_error: bool = True
+) -> List[Optional[Response]]:
+    """Responses of an `_msearch`, failed searches raise or are None like `MultiSearch`."""
+    responses = []
+    for search, response in zip(searches, raw["responses"]):
+        if response.get("error"):
+            if raise_on_error:
+                raise TransportError(
+                    "N/A", response["error"]["type"], response["error"]
+                )
+            responses.append(None)
+        else:
+            responses.append(Response(search, response))
+    return responses
+
+
+class DatasetBatch:
+    """Runs the first page of many datasets in a few `_msearch` requests.
+
+    Fanning out one query per seed article costs `len(datasets) / max_searches` round-trips
+    instead of `len(datasets)`.
+
+    ref: https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-multi-search.html
+    """
+
+    def __init__(
+        self,
+        datasets: List[DatasetBase],
+        size: int = 10,
+        max_searches: int = 100,
+    ):
+        self.datasets = datasets
+        self.size = size
+        self.max_searches = max_searches
+
+    def execute(self, raise_on_error: bool = True) -> List[Optional[Response]]:
+        """Returns one response per dataset, in the same order."""
+        responses = []
+        for start in range(0, len(self.datasets), self.max_searches):
+            searches = [
+                dataset.search.extra(size=self.size)
+                for dataset in self.datasets[start : start + self.max_searches]
+            ]
+            client = connections.get_connection(searches[0]._using)
+            raw = client.msearch(body=msearch_body(searches))
+            responses.extend(parse_msearch(searches, raw, raise_on_error))
+        return responses
+
+    def __iter__(self) -> Iterator[Response]:
+        return iter(self.execute())
 
 
 if __name__ == "__main__":
     connection = connections.create_connection(hosts=["localhost:9200"])
 
+    cache = ResultCache()
     d = Dataset(
         query="sarkozy",
         date_field="published_at",
+        cache=cache,
     )
     list(d)
+    list(d)
+    print(cache.stats)
+    for batch in d.to_batches(
+        batch_size=500, fields=["published_at"], stored_fields=[ES_ALL_FIELD]
+    ):
+        print(len(batch["_id"]), batch[ES_ALL_FIELD][:1])
 
     sarko_vaccin = [
         {"_id": "87f5c158211a6b45d009db6b3a341280", "_index": "articles"},
@@ -102,3 +547,8 @@ if __name__ == "__main__":
     ]
     mlt_d = MLTDataset(like=sarko_vaccin, date_field="published_at")
     list(mlt_d)
+    print(mlt_d.throughput)
+
+    batch = DatasetBatch([MLTDataset(like=[seed]) for seed in sarko_vaccin])
+    for seed, response in zip(sarko_vaccin, batch):
+        print(seed["_id"], [hit.meta.id for hit in response])
@@ -0,0 +1,213 @@
+"""Near-duplicate detection of articles with MinHash and LSH banding.
+
+Exact deduplication on `(title, source_name)` misses wire copies rewritten by each outlet,
+edited titles and re-crawls. Each article is reduced to a MinHash signature of its word
+shingles; signatures are split in bands and articles sharing a band bucket are candidates,
+kept when their estimated Jaccard similarity reaches `threshold`.
+Lookups only touch the buckets of the new articles, so the cost grows linearly with the corpus.
+
+Reference:
+    - [Mining of Massive Datasets, chapter 3](http://www.mmds.org/)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+import os
+import pickle
+import re
+from typing import Dict, List
+import zlib
+
+import numpy as np
+import pandas as pd
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def _permutations(num_perm: int, seed: int) -> np.ndarray:
+    generator = np.random.RandomState(seed)
+    return np.array(
+        [
+            generator.randint(1, 1 << 32, size=num_perm, dtype=np.uint64),
+            generator.randint(0, 1 << 32, size=num_perm, dtype=np.uint64),
+        ]
+    )
+
+
+def _signatures(
+    texts: List[str], num_perm: int, seed: int, shingle_size: int
+) -> np.ndarray:
+    a, b = _permutations(num_perm, seed)
+    signatures = np.full((len(texts), num_perm), MAX_HASH, dtype=np.uint64)
+    for row, text in enumerate(texts):
+        tokens = TOKEN_PATTERN.findall((text or "").lower())
+        shingles = {
+            " ".join(tokens[i : i + shingle_size])
+            for i in range(max(len(tokens) - shingle_size + 1, 1))
+        }
+        hashes = np.array(
+            [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles],
+            dtype=np.uint64,
+        )
+        permuted = (hashes[:, None] * a + b) % MERSENNE_PRIME & MAX_HASH
+        signatures[row] = permuted.min(axis=0)
+    return signatures.astype(np.uint32)
+
+
+def get_text(articles_df: pd.DataFrame) -> pd.Series:
+    return (
+        articles_df.title.fillna("")
+        + "\n"
+        + articles_df.description.fillna("")
+        + "\n"
+        + articles_df.content.fillna("")
+    )
+
+
+class NearDuplicateIndex:
+    """Incremental MinHash-LSH index mapping every article to its cluster representative.
+
+    The representative of a cluster is the first article added to it, so marks are stable
+    when new partitions arrive.
+
+    Arguments:
+        threshold: minimum estimated Jaccard similarity of two duplicates.
+        num_perm: number of MinHash permutations, `bands * rows`.
+        bands: number of LSH bands; more bands find more candidates at lower similarities.
+        shingle_size: number of words per shingle.
+        n_jobs: number of processes computing signatures.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.7,
+        num_perm: int = 128,
+        bands: int = 16,
+        shingle_size: int = 3,
+        seed: int = 1,
+        n_jobs: int = 1,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self.ids: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.representatives: List[int] = []
+        self.signatures = np.empty((0, num_perm), dtype=np.uint32)
+
+    def _compute_signatures(
+        self, texts: List[str], chunk_size: int = 5_000
+    ) -> np.ndarray:
+        params = (self.num_perm, self.seed, self.shingle_size)
+        if self.n_jobs == 1 or len(texts) <= chunk_size:
+            return _signatures(texts, *params)
+        chunks = [texts[i : i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            futures = [executor.submit(_signatures, chunk, *params) for chunk in chunks]
+            return np.concatenate([future.result() for future in futures])
+
+    def _reserve(self, size: int) -> None:
+        # grow the signatures buffer geometrically, to avoid a copy per added batch
+        if size > len(self.signatures):
+            signatures = np.empty(
+                (max(size, 2 * len(self.signatures)), self.num_perm), dtype=np.uint32
+            )
+            signatures[: len(self.ids)] = self.signatures[: len(self.ids)]
+            self.signatures = signatures
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            blake2b(signature[i : i + self.rows].tobytes(), digest_size=8).digest()
+            for i in range(0, self.num_perm, self.rows)
+        ]
+
+    def add(self, ids: List[str], texts: List[str]) -> List[str]:
+        """Add articles to the index.
+
+        Articles already in the index keep their representative, so adding the same partition
+        twice is harmless.
+
+        Returns:
+            for each article, the id of its cluster representative (itself if it is unique).
+        """
+        new = [
+            i for i, article_id in enumerate(ids) if article_id not in self.positions
+        ]
+        new_ids = [ids[i] for i in new]
+        if new:
+            signatures = self._compute_signatures([texts[i] for i in new])
+            offset = len(self.ids)
+            self._reserve(offset + len(new))
+            self.signatures[offset : offset + len(new)] = signatures
+            for position, (article_id, signature) in enumerate(
+                zip(new_ids, signatures), start=offset
+            ):
+                band_keys = self._band_keys(signature)
+                candidates = {
+                    candidate
+                    for band, key in enumerate(band_keys)
+                    for candidate in self.buckets[band].get(key, ())
+                }
+                representative = position
+                if candidates:
+                    candidates = np.array(sorted(candidates))
+                    similarities = (self.signatures[candidates] == signature).mean(
+                        axis=1
+                    )
+                    matches = candidates[similarities >= self.threshold]
+                    if len(matches):
+                        representative = min(self.representatives[m] for m in matches)
+                for band, key in enumerate(band_keys):
+                    self.buckets[band].setdefault(key, []).append(position)
+                self.ids.append(article_id)
+                self.positions[article_id] = position
+                self.representatives.append(representative)
+        return [
+            self.ids[self.representatives[self.positions[article_id]]]
+            for article_id in ids
+        ]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as fh:
+            pickle.dump(self, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: str, **params) -> "NearDuplicateIndex":
+        """Load the index saved at `path`, or create one with `params`."""
+        if not os.path.exists(path):
+            return cls(**params)
+        with open(path, "rb") as fh:
+            return pickle.load(fh)
+
+
+def mark_near_duplicates(
+    articles_df: pd.DataFrame, index: NearDuplicateIndex, collapse: bool = False
+) -> pd.DataFrame:
+    """Add a `duplicate_of` column, the representative `article_id` of near-duplicates.
+
+    Unique articles and representatives have `duplicate_of=None`; with `collapse=True`,
+    near-duplicates are dropped instead.
+    """
+    representatives = index.add(
+        articles_df.article_id.tolist(), get_text(articles_df).tolist()
+    )
+    duplicate_of = [
+        representative if representative != article_id else None
+        for article_id, representative in zip(articles_df.article_id, representatives)
+    ]
+    articles_df = articles_df.assign(duplicate_of=duplicate_of)
+    if collapse:
+        articles_df = articles_df[articles_df.duplicate_of.isna()].drop(
+            columns="duplicate_of"
+        )
+    return articles_df
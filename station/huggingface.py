@@ -4,9 +4,8 @@ import glob
 import datasets
 from datasets import load_dataset
 from elasticsearch import Elasticsearch
-import numpy as np
-import scipy.sparse as sp
-from sklearn.feature_extraction.text import CountVectorizer
+
+from station.cooccurrence import CooccurrenceModel
 
 # Copy S3 files locally
 s3 = datasets.filesystems.S3FileSystem()
@@ -14,7 +13,8 @@ s3.get("articles-louisguitton/newsapi/", "data/", recursive=True)
 
 # Process dataset
 dataset = (
-    load_dataset("json", data_files=glob.glob("data/newsapi/*/00/articles.json"))
+    # compressed partitions are decompressed according to their extension
+    load_dataset("json", data_files=glob.glob("data/newsapi/*/00/articles.json*"))
     .rename_column("publishedAt", "published_at")
     .flatten()
     # TODO: process better to clean cases when description and content are the same
@@ -67,16 +67,10 @@ scores, retrieved_examples = dataset["train"].get_nearest_examples("text", query
 retrieved_examples["title"][0]
 
 # KG generation with co-occuring words
-count_model = CountVectorizer(ngram_range=(1, 1))
-X = count_model.fit_transform(df.text)
-Xc = X.T * X
-g = sp.diags(1.0 / Xc.diagonal())
-Xc_norm = g * Xc
-Xc_norm.setdiag(0)
+model = CooccurrenceModel.fit(df.text.tolist(), min_count=5, n_jobs=4)
+model.save("data/cooccurrence")
+
 
 def get_top_associated_words(of: str = "sarkozy"):
-    v = Xc_norm[count_model.vocabulary_[of]].todense()
-    A = np.squeeze(np.asarray(v))
-    top = np.argpartition(A, -20)[-20:]
     # TODO: remove stopwords
-    return [k for k, vv in count_model.vocabulary_.items() if vv in top]
+    return [word for word, _ in model.top_associated(of, k=20)]
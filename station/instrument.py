@@ -0,0 +1,333 @@
+"""Lightweight instrumentation of the pipeline stages.
+
+`stage("load_data.read_json")` records the wall time, the rows processed and the peak
+memory of a block, aggregated by stage name; `observe("es.bulk", seconds)` records the
+latency of a request to an external service (ElasticSearch, Algolia, ...) in a histogram.
+The recorded metrics are written as JSON, or as a Prometheus textfile for the node exporter
+when the path ends with `.prom`.
+
+Peak memory is the resident set size high-water mark of the process: on Linux it is reset
+when a stage starts, so that it is the peak of the stage (and of the stages it contains);
+elsewhere it is the peak of the process so far.
+
+Entry points run with `instrument.run(main)` instead of `typer.run(main)` get two options:
+--metrics PATH writes the metrics of the run, and --profile PATH dumps a cProfile report
+(`.prof`, open it with `snakeviz` or `pstats`), or a pyinstrument report (`.html`).
+"""
+
+import bisect
+from contextlib import contextmanager
+import cProfile
+from dataclasses import asdict, dataclass
+import functools
+import inspect
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import typer
+
+# upper bounds of the latency buckets, in milliseconds
+LATENCY_BUCKETS = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf")]
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram, in the style of Prometheus."""
+
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, milliseconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+        self.count += 1
+        self.sum += milliseconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+        return {"count": self.count, "sum_ms": round(self.sum, 3), "buckets": buckets}
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.0
+    rows: int = 0
+    peak_rss_mb: float = 0.0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class _Span:
+    """A running stage; set `rows` to the number of rows it processed."""
+
+    def __init__(self, name: str, rows: int = 0):
+        self.name = name
+        self.rows = rows
+        self.peak_kb = 0
+
+
+def _read_peak_kb() -> int:
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _reset_peak() -> None:
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+class Recorder:
+    """Stage and request metrics of a run, safe to update from several threads."""
+
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {}
+        self.requests: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def _stack(self) -> List[_Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages.clear()
+            self.requests.clear()
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0) -> Iterator[_Span]:
+        """Records the wall time, rows and peak memory of the block under `name`."""
+        stack = self._stack
+        if stack:
+            # the peak of the parent stage so far, before the child resets it
+            stack[-1].peak_kb = max(stack[-1].peak_kb, _read_peak_kb())
+        _reset_peak()
+        span = _Span(name, rows)
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            span.peak_kb = max(span.peak_kb, _read_peak_kb())
+            if stack:
+                stack[-1].peak_kb = max(stack[-1].peak_kb, span.peak_kb)
+            with self._lock:
+                stats = self.stages.setdefault(name, StageStats())
+                stats.calls += 1
+                stats.seconds += seconds
+                stats.rows += span.rows
+                stats.peak_rss_mb = max(stats.peak_rss_mb, span.peak_kb / 1024)
+
+    def observe(self, service: str, seconds: float) -> None:
+        """Records the latency of a request to `service`, e.g. "es.bulk"."""
+        with self._lock:
+            histogram = self.requests.setdefault(service, LatencyHistogram())
+            histogram.observe(seconds * 1000)
+
+    @contextmanager
+    def request(self, service: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(service, time.perf_counter() - start)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "stages": {
+                    name: dict(
+                        asdict(stats),
+                        seconds=round(stats.seconds, 6),
+                        rows_per_sec=round(stats.rows_per_sec, 1),
+                    )
+                    for name, stats in self.stages.items()
+                },
+                "requests": {
+                    service: histogram.to_dict()
+                    for service, histogram in sorted(self.requests.items())
+                },
+            }
+
+    def to_prometheus(self, prefix: str = "station") -> str:
+        """Metrics in the Prometheus text exposition format."""
+        metrics = self.to_dict()
+        lines = []
+        for field, help_text in [
+            ("seconds", "Wall time spent in the stage."),
+            ("rows", "Rows processed by the stage."),
+            ("calls", "Number of times the stage ran."),
+            ("peak_rss_mb", "Peak resident memory of the stage, in MiB."),
+        ]:
+            lines += [
+                f"# HELP {prefix}_stage_{field} {help_text}",
+                f"# TYPE {prefix}_stage_{field} gauge",
+            ]
+            lines += [
+                f'{prefix}_stage_{field}{{stage="{name}"}} {stats[field]}'
+                for name, stats in metrics["stages"].items()
+            ]
+        name = f"{prefix}_request_duration_milliseconds"
+        lines += [
+            f"# HELP {name} Latency of the requests to external services.",
+            f"# TYPE {name} histogram",
+        ]
+        for service, histogram in metrics["requests"].items():
+            lines += [
+                f'{name}_bucket{{service="{service}",le="{bound}"}} {count}'
+                for bound, count in histogram["buckets"].items()
+            ]
+            lines += [
+                f'{name}_sum{{service="{service}"}} {histogram["sum_ms"]}',
+                f'{name}_count{{service="{service}"}} {histogram["count"]}',
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Writes the metrics to `path`, as a Prometheus textfile if it ends with `.prom`."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # written then renamed, so that the node exporter never reads a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fh:
+            if path.endswith(".prom"):
+                fh.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), fh, indent=2)
+        os.replace(tmp_path, path)
+
+
+recorder = Recorder()
+stage = recorder.stage
+observe = recorder.observe
+request = recorder.request
+
+
+def instrument_elasticsearch(client, recorder: Recorder = recorder):
+    """Records the latency of every request of an `Elasticsearch` client, by endpoint.
+
+    The endpoint is the last `_`-prefixed part of the path, e.g. "es.bulk" or "es.search".
+    """
+    transport = client.transport
+    if getattr(transport, "_instrumented", False):
+        return client
+    perform_request = transport.perform_request
+
+    @functools.wraps(perform_request)
+    def _perform_request(method, url, *args, **kwargs):
+        parts = [part for part in url.split("?")[0].split("/") if part.startswith("_")]
+        service = f"es.{parts[-1][1:] if parts else method.lower()}"
+        with recorder.request(service):
+            return perform_request(method, url, *args, **kwargs)
+
+    transport.perform_request = _perform_request
+    transport._instrumented = True
+    return client
+
+
+@contextmanager
+def profile(path: str) -> Iterator[None]:
+    """Profiles the block with pyinstrument if `path` ends with `.html`, else with cProfile."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if path.endswith(".html"):
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise typer.BadParameter("pyinstrument is required for .html profiles")
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path, "w") as fh:
+                fh.write(profiler.output_html())
+            typer.echo(f"Profile written to {path}", err=True)
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats("cumulative").print_stats(25)
+        typer.echo(f"Profile written to {path}", err=True)
+
+
+def with_options(function: Callable) -> Callable:
+    """Adds the --metrics and --profile options to a typer command."""
+
+    @functools.wraps(function)
+    def wrapper(*args, metrics: str = None, profile_path: str = None, **kwargs):
+        recorder.reset()
+        try:
+            with stage("total"):
+                if profile_path:
+                    with profile(profile_path):
+                        return function(*args, **kwargs)
+                return function(*args, **kwargs)
+        finally:
+            if metrics:
+                recorder.write(metrics)
+                typer.echo(f"Metrics written to {metrics}", err=True)
+
+    signature = inspect.signature(function)
+    options = [
+        inspect.Parameter(
+            "metrics",
+            inspect.Parameter.KEYWORD_ONLY,
+            default=typer.Option(
+                None, help="Write the metrics of the run (JSON, or .prom textfile)."
+            ),
+            annotation=Optional[str],
+        ),
+        inspect.Parameter(
+            "profile_path",
+            inspect.Parameter.KEYWORD_ONLY,
+            default=typer.Option(
+                None,
+                "--profile",
+                help="Dump a cProfile (.prof) or pyinstrument (.html) report.",
+            ),
+            annotation=Optional[str],
+        ),
+    ]
+    wrapper.__signature__ = signature.replace(
+        parameters=[*signature.parameters.values(), *options]
+    )
+    return wrapper
+
+
+def run(function: Callable) -> None:
+    """Like `typer.run`, with the --metrics and --profile options."""
+    typer.run(with_options(function))
@@ -1,80 +1,401 @@
 """Updates the ElasticSearch index."""
+
+import datetime
+from hashlib import md5
 import json
-from pprint import pprint
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
 from elasticsearch_dsl import connections
-from elasticsearch.helpers import bulk, BulkIndexError
+from elasticsearch.helpers import BulkIndexError
 import typer
 
 
-from station.constants import ES_INDEX, ES_MAPPING
-from station.utils import load_data
+from station.bulk import BulkIndexer, ChunkStats
+from station.constants import (
+    DEDUP_INDEX_PATH,
+    ES_BULK_SETTINGS,
+    ES_INDEX,
+    ES_MANIFEST_PATH,
+    ES_MAPPING_PROFILE,
+    ES_MAPPING_PROFILES,
+    ES_SEARCH_SETTINGS,
+)
+from station.dedup import mark_near_duplicates, NearDuplicateIndex
+from station import instrument
+from station.manifest import PartitionManifest
+from station import rollups
+from station.utils import iter_data, list_partitions, load_data, records_from_frame
+
 
+def _get_content_hash(record: Dict) -> str:
+    content = {k: v for k, v in record.items() if k not in ("_id", "content_hash")}
+    return md5(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
 
-def _document_generator():
-    articles_df = (
-        load_data()
-        .rename(
+
+def _document_generator(
+    partitions: List[str] = None,
+    stream: bool = False,
+    near_duplicates: NearDuplicateIndex = None,
+    collapse: bool = False,
+):
+    partitions = list_partitions() if partitions is None else partitions
+    # in stream mode, only one partition of articles is held in memory at a time
+    batches = iter_data(partitions) if stream else [load_data(partitions)]
+    for articles_df in batches:
+        if near_duplicates is not None:
+            articles_df = mark_near_duplicates(articles_df, near_duplicates, collapse)
+        articles_df = articles_df.rename(
             columns={
                 "publishedAt": "published_at",
                 "article_id": "_id",
                 "urlToImage": "url_to_image",
             }
+        ).drop("source_id", axis=1)
+        for record in records_from_frame(articles_df):
+            record["content_hash"] = _get_content_hash(record)
+            yield record
+
+
+def _skip_unchanged(
+    connection,
+    actions: Iterable[Dict],
+    stats: Dict,
+    days: Set[Optional[int]],
+    chunk_size: int = 500,
+    skip: bool = True,
+) -> Iterator[Dict]:
+    """Drop the documents whose content hash matches the one already indexed (if `skip`).
+
+    The days of the indexed copies of the documents sent are added to `days`: a document
+    whose `published_at` changed moves out of the rollups of its previous day.
+    """
+
+    def _filter(chunk: List[Dict]) -> Iterator[Dict]:
+        response = connection.mget(
+            index=ES_INDEX,
+            body={"ids": [action["_id"] for action in chunk]},
+            _source_includes=["content_hash", "published_at"],
+        )
+        indexed = {
+            doc["_id"]: doc["_source"] for doc in response["docs"] if doc.get("found")
+        }
+        for action in chunk:
+            source = indexed.get(action["_id"])
+            if skip and source and source.get("content_hash") == action["content_hash"]:
+                stats["skipped"] += 1
+                continue
+            if source:
+                days.add(rollups.get_day(source.get("published_at")))
+            yield action
+
+    chunk = []
+    for action in actions:
+        chunk.append(action)
+        if len(chunk) == chunk_size:
+            yield from _filter(chunk)
+            chunk = []
+    if chunk:
+        yield from _filter(chunk)
+
+
+def _put_index_template(connection, mapping_profile: str) -> None:
+    """Every versioned index `articles_v{n}` is created from a profile of ES_MAPPING_PROFILES."""
+    connection.indices.put_index_template(
+        name=ES_INDEX,
+        body={
+            "index_patterns": [f"{ES_INDEX}_v*"],
+            "template": ES_MAPPING_PROFILES[mapping_profile],
+        },
+    )
+
+
+def _get_mapping_profile(connection, index: str = ES_INDEX) -> str:
+    """Mapping profile of an existing index, recorded in the `_meta` of its mapping."""
+    mappings = connection.indices.get_mapping(index=index)
+    metas = [mapping["mappings"].get("_meta", {}) for mapping in mappings.values()]
+    return metas[0].get("mapping_profile", "default") if metas else "default"
+
+
+def bump_generation(connection, index: str, mapping_profile: str = None) -> None:
+    """Bumps the `_meta.generation` of `index`, which invalidates the cached results of
+    station.dataset.
+
+    A `_meta` put replaces the whole object, so the mapping profile (by default the current
+    one of `index`) is written again.
+    """
+    if mapping_profile is None:
+        mapping_profile = _get_mapping_profile(connection, index)
+    connection.indices.put_mapping(
+        index=index,
+        body={
+            "_meta": {
+                "generation": datetime.datetime.utcnow().isoformat(),
+                "mapping_profile": mapping_profile,
+            }
+        },
+    )
+
+
+def _get_versions(connection) -> List[int]:
+    indices = connection.indices.get(index=f"{ES_INDEX}_v*", ignore_unavailable=True)
+    return sorted(
+        int(index.rsplit("_v", 1)[1])
+        for index in indices
+        if index.rsplit("_v", 1)[1].isdigit()
+    )
+
+
+def _create_version(connection, settings: Dict = None) -> str:
+    versions = _get_versions(connection)
+    index = f"{ES_INDEX}_v{versions[-1] + 1 if versions else 1}"
+    typer.echo(f'Creating index "{index}"...')
+    connection.indices.create(
+        index=index, body={"settings": settings} if settings else None
+    )
+    typer.echo(f'Index "{index}" created successfully')
+    return index
+
+
+def _swap_alias(connection, index: str) -> None:
+    """Atomically point the `articles` alias to `index`."""
+    actions = [{"add": {"index": index, "alias": ES_INDEX}}]
+    if connection.indices.exists_alias(name=ES_INDEX):
+        for previous in connection.indices.get_alias(name=ES_INDEX):
+            actions.insert(0, {"remove": {"index": previous, "alias": ES_INDEX}})
+    elif connection.indices.exists(index=ES_INDEX):
+        # legacy concrete index named like the alias, removed in the same atomic call
+        actions.insert(0, {"remove_index": {"index": ES_INDEX}})
+    connection.indices.update_aliases(body={"actions": actions})
+    typer.echo(f'Alias "{ES_INDEX}" now points to "{index}"')
+
+
+def _delete_old_versions(connection, keep: int) -> None:
+    """Delete all but the `keep` most recent versions, never the one the alias points to."""
+    live = (
+        set(connection.indices.get_alias(name=ES_INDEX))
+        if connection.indices.exists_alias(name=ES_INDEX)
+        else set()
+    )
+    versions = _get_versions(connection)
+    for version in versions[: max(len(versions) - keep, 0)]:
+        if f"{ES_INDEX}_v{version}" in live:
+            continue
+        connection.indices.delete(index=f"{ES_INDEX}_v{version}")
+        typer.echo(f'Deleted old index "{ES_INDEX}_v{version}"')
+
+
+def _index_documents(
+    connection,
+    index: str,
+    partitions: List[str],
+    document_params: Dict,
+    skip_unchanged: bool,
+    update_existing: bool,
+    thread_count: int,
+    chunk_size: int,
+    max_chunk_bytes: int,
+    verbose: bool,
+    mapping_profile: str = ES_MAPPING_PROFILE,
+) -> Set[int]:
+    """Returns the days (see `rollups.get_day`) of the documents sent to the index, and
+    with `update_existing`, the days of their indexed copies."""
+    typer.echo(f'Bulk updating documents on "{index}" index...')
+    stats = {"skipped": 0}
+    days = set()
+    actions = _document_generator(partitions, **document_params)
+    if update_existing:
+        actions = _skip_unchanged(connection, actions, stats, days, skip=skip_unchanged)
+
+    def _collect_days(actions: Iterable[Dict]) -> Iterator[Dict]:
+        for action in actions:
+            days.add(rollups.get_day(action.get("published_at")))
+            yield action
+
+    def _echo_chunk(chunk: ChunkStats):
+        typer.echo(
+            f"Indexed {chunk.docs} docs ({chunk.bytes / 1024:.0f} KiB) in"
+            f" {chunk.latency * 1000:.0f}ms ({chunk.docs_per_sec:,.0f} docs/sec)"
         )
-        .drop("source_id", axis=1)
+
+    indexer = BulkIndexer(
+        connection,
+        index=index,
+        thread_count=thread_count,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        on_chunk=_echo_chunk if verbose else None,
     )
-    records = json.loads(articles_df.to_json(orient="records"))
-    return records
+    try:
+        with instrument.stage("index_documents") as span:
+            bulk_stats = indexer.bulk(_collect_days(actions))
+            span.rows = bulk_stats.succeeded
+    except BulkIndexError as exception:
+        raise BulkIndexError(
+            "error encountered while indexing",
+            [e["index"]["error"] for e in exception.errors],
+        )
+
+    typer.echo(
+        f'Updated {bulk_stats.succeeded} documents on "{index}" successfully'
+        f' ({stats["skipped"]} unchanged documents skipped)'
+    )
+    typer.echo(f"Bulk stats: {bulk_stats.summary()}")
+
+    bump_generation(connection, index, mapping_profile)
+    return days
 
 
 # TODO: add analyser_settings and mappings_settings as parameters
-# TODO: call it reindex
 # TODO: add type of documents index <> database doc_type <> table
-def main(force: bool = False):
-    """Updates the ElasticSearch index."""
+def main(
+    force: bool = False,
+    reindex: bool = False,
+    stream: bool = False,
+    full: bool = False,
+    keep_versions: int = 2,
+    force_merge: bool = False,
+    near_dedup: str = None,
+    thread_count: int = 4,
+    chunk_size: int = 500,
+    max_chunk_bytes: int = 10 * 1024 * 1024,
+    verbose: bool = False,
+    mapping_profile: str = None,
+):
+    """Updates the ElasticSearch index.
+
+    The "articles" index is an alias to a versioned index "articles_v{n}".
+    By default, only the partitions that are new or changed since the last run are read,
+    and documents whose content is already indexed are skipped.
+    Use --full to read and index every partition, and --stream to read and index
+    the articles one partition at a time.
+    Use --reindex to rebuild a new version without downtime: it is bulk-loaded without
+    refresh nor replicas, optionally force-merged (--force-merge), then the alias is swapped
+    atomically and only the --keep-versions most recent versions are kept.
+    Use --force to delete all versions first.
+    Use --near-dedup mark to set `duplicate_of` on near-duplicate articles, or
+    --near-dedup collapse to skip them.
+    Bulk requests are sent by --thread-count threads, in chunks of at most --chunk-size
+    documents and --max-chunk-bytes bytes; --verbose reports the latency of every chunk.
+    Use --mapping-profile to pick the settings and mappings of the index among
+    ES_MAPPING_PROFILES (default, compact, fast-read); without it, the profile of the live
+    index is kept (ES_MAPPING_PROFILE for a new one). Switching profiles needs --reindex.
+    `python -m station.management.profiles` compares their size, ingest rate and latency.
+    Use --metrics to write the time, rows and memory of each stage and the latencies of the
+    ES requests, and --profile to profile the run.
+    The facet rollups (see station.rollups) of the days of the indexed documents are
+    recomputed at the end, or all of them after a --reindex.
+    """
     connection = connections.create_connection(hosts=["localhost:9200"])
+    instrument.instrument_elasticsearch(connection)
+    manifest = PartitionManifest(ES_MANIFEST_PATH)
+    if near_dedup not in (None, "mark", "collapse"):
+        raise typer.BadParameter("--near-dedup must be 'mark' or 'collapse'")
+    if keep_versions < 1:
+        raise typer.BadParameter("--keep-versions must be at least 1")
+    if mapping_profile is not None and mapping_profile not in ES_MAPPING_PROFILES:
+        raise typer.BadParameter(
+            f"--mapping-profile must be one of {list(ES_MAPPING_PROFILES)}"
+        )
+    near_duplicates = NearDuplicateIndex.load(DEDUP_INDEX_PATH) if near_dedup else None
+    document_params = dict(
+        stream=stream,
+        near_duplicates=near_duplicates,
+        collapse=near_dedup == "collapse",
+    )
+    bulk_params = dict(
+        thread_count=thread_count,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        verbose=verbose,
+    )
 
     if force:
+        connection.indices.delete(index=f"{ES_INDEX}_v*", ignore=[400, 404])
         connection.indices.delete(index=ES_INDEX, ignore=[400, 404])
 
     typer.echo(f'Checking if index "{ES_INDEX}" exists...')
-    if connection.indices.exists(index=ES_INDEX):
+    exists = connection.indices.exists(index=ES_INDEX)
+    current_profile = _get_mapping_profile(connection) if exists else None
+    if not reindex and exists:
         typer.echo(f'Index "{ES_INDEX}" already exists')
+        if mapping_profile not in (None, current_profile):
+            raise typer.BadParameter(
+                f'"{ES_INDEX}" uses the "{current_profile}" mapping profile,'
+                f' use --reindex to switch to "{mapping_profile}"'
+            )
+        mapping_profile = current_profile
         typer.echo(f'Updating mapping on "{ES_INDEX}" index...')
-        connection.indices.put_mapping(index=ES_INDEX, body=ES_MAPPING)
+        connection.indices.put_mapping(
+            index=ES_INDEX, body=ES_MAPPING_PROFILES[mapping_profile]["mappings"]
+        )
         typer.echo(f'Updated mapping on "{ES_INDEX}" successfully')
     else:
-        typer.echo(f'Index "{ES_INDEX}" does not exist')
-        typer.echo(f'Creating index "{ES_INDEX}"...')
-        connection.indices.create(
-            index=ES_INDEX,
-            body={
-                "settings": {
-                    "number_of_shards": 1,
-                    "number_of_replicas": 0,
-                    # TODO:
-                    # "index": {
-                    #     "analysis": analysis_settings
-                    # }
-                },
-                "mappings": ES_MAPPING,
-            },
-        )
-        typer.echo(f'Index "{ES_INDEX}" created successfully')
+        reindex = True
+        mapping_profile = mapping_profile or current_profile or ES_MAPPING_PROFILE
+    bulk_params["mapping_profile"] = mapping_profile
 
-    typer.echo(f'Bulk updating documents on "{ES_INDEX}" index...')
-    try:
-        succeeded, _ = bulk(
-            client=connection, index=ES_INDEX, actions=_document_generator()
+    partitions = changed = list_partitions()
+    if reindex:
+        manifest.reset()
+        # only put once the profile is accepted, the new version is created from it
+        _put_index_template(connection, mapping_profile)
+        index = _create_version(connection, settings=ES_BULK_SETTINGS)
+        _index_documents(
+            connection,
+            index,
+            partitions,
+            document_params=document_params,
+            skip_unchanged=False,
+            update_existing=False,
+            **bulk_params,
         )
-    except BulkIndexError as exception:
-        raise BulkIndexError(
-            "error encountered while indexing",
-            [e["index"]["error"] for e in exception.errors],
+        typer.echo(f'Restoring settings on "{index}"...')
+        connection.indices.put_settings(index=index, body=ES_SEARCH_SETTINGS)
+        connection.indices.refresh(index=index)
+        if force_merge:
+            typer.echo(f'Force merging "{index}"...')
+            connection.indices.forcemerge(
+                index=index, max_num_segments=1, request_timeout=3600
+            )
+        _swap_alias(connection, index)
+        _delete_old_versions(connection, keep=keep_versions)
+        days = None
+    else:
+        if full:
+            manifest.reset()
+        else:
+            changed = manifest.changed(partitions)
+            typer.echo(f"Found {len(changed)} new or changed partitions")
+            if not changed:
+                manifest.save()
+                return
+            # the partitions after the earliest changed one are read again, so that the
+            # last copy of an article wins even when an older hour is rewritten (e.g. by
+            # the crawler's --refill-gaps); their unchanged documents are skipped
+            partitions = partitions[partitions.index(changed[0]) :]
+        days = _index_documents(
+            connection,
+            ES_INDEX,
+            partitions,
+            document_params=document_params,
+            skip_unchanged=not full,
+            update_existing=True,
+            **bulk_params,
         )
 
-    typer.echo(f'Updated {succeeded} documents on "{ES_INDEX}" successfully')
+    typer.echo("Updating the facet rollups...")
+    with instrument.stage("rollups") as span:
+        rollup_stats = rollups.update(connection, days)
+        span.rows = rollup_stats["rollups"]
+    typer.echo(
+        f"Recomputed {rollup_stats['rollups']} rollups of {rollup_stats['days']} days"
+    )
+
+    manifest.update(changed)
+    manifest.save()
+    if near_duplicates is not None:
+        near_duplicates.save(DEDUP_INDEX_PATH)
 
 
 if __name__ == "__main__":
-    typer.run(main)
+    instrument.run(main)
@@ -0,0 +1,227 @@
+"""Exports articles as Label Studio tasks, in shards of bounded size.
+
+Articles are streamed from the index, matching --query (see `Dataset`), or from the raw
+partitions (see `iter_data`) when there is no query. Tasks are written as they come to
+JSON shards `<output>/tasks-<n>.json` of at most --max-shard-tasks tasks and
+--max-shard-bytes bytes, each a list of tasks Label Studio imports as is, so that only the
+shard being written is held in memory.
+
+With --per-stratum N, at most N articles of each (source, day) are exported, sampled
+uniformly over the stream by reservoir sampling: a single pass, holding at most N articles
+per stratum.
+
+The ids of the articles of a shard are appended to the --ledger once the shard is complete,
+and the articles of the ledger are skipped by later runs.
+"""
+
+import datetime
+import glob
+import json
+import os
+import random
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from elasticsearch_dsl import connections
+import pandas as pd
+import typer
+
+from station import instrument
+from station.constants import ES_INDEX, LABEL_STUDIO_LEDGER_PATH
+from station.dataset import Dataset
+from station.rollups import get_day
+from station.utils import iter_data, list_partitions, records_from_frame
+
+FIELDS = [
+    "title",
+    "description",
+    "content",
+    "source_name",
+    "published_at",
+    "url_to_image",
+]
+
+
+def _read_ledger(path: str) -> Set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r") as fh:
+        return {line.strip() for line in fh if line.strip()}
+
+
+def _iter_index(
+    query: str, start_date: datetime.datetime, end_date: datetime.datetime
+) -> Iterator[Dict]:
+    connections.create_connection(hosts=["localhost:9200"])
+    dataset = Dataset(query)
+    dataset.search = dataset.search.index(ES_INDEX)
+    if start_date or end_date:
+        dates = {"gte": start_date, "lte": end_date}
+        dataset.search = dataset.search.filter(
+            "range",
+            published_at={k: v.isoformat() for k, v in dates.items() if v is not None},
+        )
+    for batch in dataset.to_batches(fields=FIELDS):
+        for i, article_id in enumerate(batch["_id"]):
+            yield dict({name: batch[name][i] for name in FIELDS}, article_id=article_id)
+
+
+def _iter_partitions(
+    start_date: datetime.datetime, end_date: datetime.datetime
+) -> Iterator[Dict]:
+    partitions = list_partitions(
+        start_date=start_date and start_date.date(),
+        end_date=end_date and end_date.date(),
+    )
+    for articles_df in iter_data(partitions):
+        articles_df = articles_df.rename(
+            columns={"publishedAt": "published_at", "urlToImage": "url_to_image"}
+        )
+        yield from records_from_frame(articles_df[["article_id", *FIELDS]])
+
+
+def _to_task(article: Dict) -> Dict:
+    published_at = article["published_at"]
+    if published_at is not None:
+        unit = "ms" if isinstance(published_at, (int, float)) else None
+        published_at = pd.Timestamp(published_at, unit=unit).isoformat()
+    return {
+        "data": {
+            "text": "\n".join(
+                str(article[field])
+                for field in ["title", "description", "content"]
+                if article[field] is not None
+            ),
+            "source": article["source_name"],
+            "publishedAt": published_at,
+            "urlToImage": article["url_to_image"],
+            "article_id": article["article_id"],
+        }
+    }
+
+
+def _sample(articles: Iterable[Dict], per_stratum: int, seed: int) -> Iterator[Dict]:
+    """At most `per_stratum` articles of each (source, day), uniformly sampled (algorithm R)."""
+    rng = random.Random(seed)
+    reservoirs: Dict[Tuple[Optional[str], Optional[int]], List[Dict]] = {}
+    seen: Dict[Tuple[Optional[str], Optional[int]], int] = {}
+    for article in articles:
+        stratum = (article["source_name"], get_day(article["published_at"]))
+        reservoir = reservoirs.setdefault(stratum, [])
+        seen[stratum] = seen.get(stratum, 0) + 1
+        if len(reservoir) < per_stratum:
+            reservoir.append(article)
+        else:
+            # the n-th article of the stratum replaces a sampled one with probability k/n
+            position = rng.randrange(seen[stratum])
+            if position < per_stratum:
+                reservoir[position] = article
+    for stratum in sorted(reservoirs, key=lambda s: (s[1] or 0, s[0] or "")):
+        yield from reservoirs[stratum]
+
+
+class ShardWriter:
+    """Writes tasks to JSON shards of at most `max_tasks` tasks and `max_bytes` bytes.
+
+    A shard is written to a temporary file, renamed when it is complete; its article ids
+    are then appended to the ledger. Shards are numbered after the existing ones.
+    """
+
+    def __init__(self, output: str, ledger: str, max_tasks: int, max_bytes: int):
+        self.output = output
+        self.ledger = ledger
+        self.max_tasks = max_tasks
+        self.max_bytes = max_bytes
+        self.shards: List[str] = []
+        self._fh = None
+        self._ids: List[str] = []
+        self._bytes = 0
+        os.makedirs(output, exist_ok=True)
+        os.makedirs(os.path.dirname(ledger) or ".", exist_ok=True)
+        numbers = [
+            int(match.group(1))
+            for path in glob.glob(os.path.join(output, "tasks-*.json"))
+            for match in [re.search(r"tasks-(\d+)\.json$", path)]
+            if match
+        ]
+        self._next = max(numbers, default=-1) + 1
+
+    @property
+    def _path(self) -> str:
+        return os.path.join(self.output, f"tasks-{self._next:05d}.json")
+
+    def write(self, task: Dict) -> None:
+        line = json.dumps(task, ensure_ascii=False).encode("utf-8")
+        if self._fh is not None and (
+            len(self._ids) >= self.max_tasks
+            or self._bytes + len(line) + 2 > self.max_bytes
+        ):
+            self._close_shard()
+        if self._fh is None:
+            self._fh = open(f"{self._path}.tmp", "wb")
+            self._fh.write(b"[\n")
+            self._bytes = len(b"[\n\n]\n")
+        elif self._ids:
+            self._fh.write(b",\n")
+        self._fh.write(line)
+        self._bytes += len(line) + 2
+        self._ids.append(task["data"]["article_id"])
+
+    def _close_shard(self) -> None:
+        self._fh.write(b"\n]\n")
+        self._fh.close()
+        os.replace(f"{self._path}.tmp", self._path)
+        with open(self.ledger, "a") as fh:
+            fh.writelines(f"{article_id}\n" for article_id in self._ids)
+        self.shards.append(self._path)
+        self._fh, self._ids, self._next = None, [], self._next + 1
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._close_shard()
+
+
+def main(
+    query: str = None,
+    output: str = "data/label_studio",
+    ledger: str = LABEL_STUDIO_LEDGER_PATH,
+    start_date: datetime.datetime = None,
+    end_date: datetime.datetime = None,
+    per_stratum: int = None,
+    max_shard_tasks: int = 1000,
+    max_shard_bytes: int = 10 * 1024 * 1024,
+    seed: int = 42,
+):
+    """Export the articles not exported yet as Label Studio tasks.
+
+    Articles come from the index when a --query is given (matched on all_text), else from
+    the raw partitions, published (or crawled) from --start-date to --end-date.
+    --per-stratum samples at most that many articles per source and day.
+    """
+    if query:
+        articles = _iter_index(query, start_date, end_date)
+    else:
+        articles = _iter_partitions(start_date, end_date)
+    exported = _read_ledger(ledger)
+    articles = (
+        article for article in articles if article["article_id"] not in exported
+    )
+    if per_stratum:
+        articles = _sample(articles, per_stratum, seed)
+
+    writer = ShardWriter(output, ledger, max_shard_tasks, max_shard_bytes)
+    with instrument.stage("export") as span:
+        try:
+            for article in articles:
+                writer.write(_to_task(article))
+                span.rows += 1
+        finally:
+            writer.close()
+    typer.echo(
+        f"Exported {span.rows} tasks in {len(writer.shards)} shards of {output}"
+        f" ({len(exported) + span.rows} articles in {ledger})"
+    )
+
+
+if __name__ == "__main__":
+    instrument.run(main)
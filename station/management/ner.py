@@ -0,0 +1,124 @@
+"""Enriches the ElasticSearch index with named entities.
+
+Entities are written in the `texta_facts` nested field, the format of
+[texta-rest](https://github.com/EMBEDDIA/texta-rest) queried by `station.main`:
+`{"doc_path": "title", "fact": "ORG", "str_val": "Magpies", "spans": "[[0, 7]]"}`.
+
+The spaCy model has to be installed locally, e.g. `python -m spacy download fr_core_news_sm`.
+"""
+
+from collections import defaultdict
+import json
+import time
+from typing import Dict, Iterator, List
+
+from elasticsearch.helpers import BulkIndexError
+from elasticsearch_dsl import connections, Q
+import spacy
+import typer
+
+from station import instrument, rollups
+from station.bulk import BulkIndexer
+from station.constants import ES_INDEX
+from station.dataset import DatasetBase
+from station.management.es import bump_generation
+
+TEXT_FIELDS = ["title", "description", "content"]
+
+
+def _get_facts(
+    nlp, batch: Dict, n_process: int, pipe_batch_size: int
+) -> Dict[str, List]:
+    texts = (
+        (text, (article_id, field))
+        for field in TEXT_FIELDS
+        for article_id, text in zip(batch["_id"], batch[field])
+        if text
+    )
+    facts = defaultdict(list)
+    for doc, (article_id, field) in nlp.pipe(
+        texts, as_tuples=True, n_process=n_process, batch_size=pipe_batch_size
+    ):
+        for ent in doc.ents:
+            facts[article_id].append(
+                {
+                    "doc_path": field,
+                    "fact": ent.label_,
+                    "str_val": ent.text,
+                    "spans": json.dumps([[ent.start_char, ent.end_char]]),
+                }
+            )
+    return facts
+
+
+def _update_actions(
+    ids: List[str], facts: Dict[str, List], model: str
+) -> Iterator[Dict]:
+    for article_id in ids:
+        yield {
+            "_op_type": "update",
+            "_id": article_id,
+            "doc": {"texta_facts": facts.get(article_id, []), "ner_model": model},
+        }
+
+
+def main(
+    model: str = "fr_core_news_sm",
+    batch_size: int = 2000,
+    n_process: int = 2,
+    pipe_batch_size: int = 64,
+    thread_count: int = 2,
+):
+    """Runs spaCy NER on the documents that have not been enriched yet.
+
+    Documents are streamed by batches of --batch-size, processed by --n-process workers,
+    and their entities written back with bulk partial updates. The updated documents are
+    marked with `ner_model`, so an interrupted run resumes with the documents still missing
+    it, and re-ingested or reindexed documents, which lose it, are enriched again. The
+    entity rollups of the days of the updated documents (see station.rollups) are
+    recomputed at the end.
+    """
+    connections.create_connection(hosts=["localhost:9200"])
+    nlp = spacy.load(model, exclude=["parser", "lemmatizer", "attribute_ruler"])
+    dataset = DatasetBase(
+        query=Q("bool", must_not=[Q("exists", field="ner_model")]),
+        page_size=batch_size,
+    )
+    dataset.search = dataset.search.index(ES_INDEX)
+    indexer = BulkIndexer(
+        connections.get_connection(), index=ES_INDEX, thread_count=thread_count
+    )
+    typer.echo(f"{len(dataset)} documents to enrich with {model}")
+
+    start, processed, days = time.perf_counter(), 0, set()
+    for batch in dataset.to_batches(batch_size, fields=TEXT_FIELDS + ["published_at"]):
+        ids = batch["_id"].tolist()
+
+        batch_start = time.perf_counter()
+        facts = _get_facts(nlp, batch, n_process, pipe_batch_size)
+        ner_seconds = time.perf_counter() - batch_start
+        try:
+            indexer.bulk(_update_actions(ids, facts, model))
+        except BulkIndexError as exception:
+            raise BulkIndexError(
+                "error encountered while enriching",
+                [e["update"]["error"] for e in exception.errors],
+            )
+        days.update(map(rollups.get_day, batch["published_at"]))
+
+        processed += len(ids)
+        elapsed = time.perf_counter() - start
+        typer.echo(
+            f"Enriched {processed} documents ({processed / elapsed:,.1f} docs/sec,"
+            f" {len(ids) / ner_seconds / n_process:,.1f} docs/sec per worker)"
+        )
+
+    if processed:
+        # the cached results of station.dataset predate the entities
+        bump_generation(connections.get_connection(), ES_INDEX)
+    stats = rollups.update(connections.get_connection(), days)
+    typer.echo(f"Recomputed {stats['rollups']} rollups of {stats['days']} days")
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -0,0 +1,200 @@
+"""Compares the mapping profiles of ES_MAPPING_PROFILES on a sample of the articles.
+
+The first --n-documents documents of the partitions are indexed, for each profile, in a
+temporary `articles_profile_<name>` index, force merged to one segment, then measured:
+
+- ingest: documents per second of the bulk indexing (refresh disabled, like a reindex);
+- size: size of the index on disk, in total and per document;
+- search: p50/p95 latency of `multi_match` queries on `all_text` of words of sampled titles;
+- mlt: p50/p95 latency of `more_like_this` queries of sampled indexed documents;
+- export: documents per second of `Dataset.to_batches` with the `all_text` stored field.
+
+The request cache is disabled so that every query is executed. The indices are deleted
+afterwards, unless --keep.
+"""
+
+import itertools
+import json
+import os
+import random
+import time
+from typing import Callable, Dict, List
+
+from elasticsearch_dsl import connections, Q
+import numpy as np
+import typer
+
+from station import instrument
+from station.bulk import BulkIndexer
+from station.constants import (
+    ES_ALL_FIELD,
+    ES_BULK_SETTINGS,
+    ES_INDEX,
+    ES_MAPPING_PROFILES,
+    ES_SEARCH_SETTINGS,
+)
+from station.dataset import DatasetBase
+from station.management.es import _document_generator
+
+PROFILE_INDEX = f"{ES_INDEX}_profile"
+
+
+def _latencies(search: Callable[[Dict], Dict], bodies: List[Dict]) -> Dict[str, float]:
+    latencies = []
+    for body in bodies:
+        start = time.perf_counter()
+        search(body)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+    }
+
+
+def _queries(documents: List[Dict], index: str, n_queries: int, seed: int) -> Dict:
+    """Search and MLT bodies, the same for every profile."""
+    rng = random.Random(seed)
+    sample = rng.sample(documents, min(n_queries, len(documents)))
+    search = []
+    for document in sample:
+        words = [
+            word for word in (document.get("title") or "").split() if len(word) > 3
+        ]
+        query = " ".join(rng.sample(words, min(3, len(words)))) or "france"
+        search.append(
+            {"size": 10, "query": Q("multi_match", query=query, fields=[ES_ALL_FIELD])}
+        )
+    mlt = [
+        {
+            "size": 10,
+            "query": Q(
+                "more_like_this",
+                fields=[ES_ALL_FIELD],
+                like=[{"_index": index, "_id": document["_id"]}],
+                min_doc_freq=1,
+            ),
+        }
+        for document in sample
+    ]
+    return {
+        kind: [dict(body, query=body["query"].to_dict()) for body in bodies]
+        for kind, bodies in [("search", search), ("mlt", mlt)]
+    }
+
+
+def _index_name(profile: str) -> str:
+    return f"{PROFILE_INDEX}_{profile.replace('-', '_')}"
+
+
+def _measure(
+    connection, name: str, documents: List[Dict], n_queries: int, seed: int
+) -> Dict:
+    index = _index_name(name)
+    profile = ES_MAPPING_PROFILES[name]
+    connection.indices.delete(index=index, ignore=[404])
+    connection.indices.create(
+        index=index,
+        body={
+            "settings": dict(profile["settings"], **ES_BULK_SETTINGS),
+            "mappings": profile["mappings"],
+        },
+    )
+    with instrument.stage(f"{name}.ingest", rows=len(documents)):
+        stats = BulkIndexer(connection, index=index).bulk(iter(documents))
+    connection.indices.put_settings(index=index, body=ES_SEARCH_SETTINGS)
+    connection.indices.refresh(index=index)
+    connection.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+    store = connection.indices.stats(index=index, metric="store")
+    size = store["indices"][index]["primaries"]["store"]["size_in_bytes"]
+
+    queries = _queries(documents, index, n_queries, seed)
+
+    def _search(body: Dict) -> Dict:
+        return connection.search(index=index, body=body, request_cache=False)
+
+    with instrument.stage(f"{name}.search", rows=len(queries["search"])):
+        search = _latencies(_search, queries["search"])
+    with instrument.stage(f"{name}.mlt", rows=len(queries["mlt"])):
+        mlt = _latencies(_search, queries["mlt"])
+
+    dataset = DatasetBase(query=Q("match_all"))
+    dataset.search = dataset.search.using(connection).index(index)
+    start = time.perf_counter()
+    with instrument.stage(f"{name}.export") as span:
+        for batch in dataset.to_batches(fields=["title"], stored_fields=[ES_ALL_FIELD]):
+            span.rows += len(batch["_id"])
+    export_seconds = time.perf_counter() - start
+    return {
+        "profile": name,
+        "index": index,
+        "documents": stats.succeeded,
+        "ingest_docs_per_sec": round(stats.docs_per_sec, 1),
+        "size_bytes": size,
+        "bytes_per_doc": round(size / stats.succeeded, 1) if stats.succeeded else 0.0,
+        "search": search,
+        "mlt": mlt,
+        "export_docs_per_sec": (
+            round(span.rows / export_seconds, 1) if export_seconds else 0.0
+        ),
+    }
+
+
+def _print_report(results: List[Dict]) -> None:
+    typer.echo(
+        f"{'profile':>10} {'docs':>8} {'ingest/s':>9} {'size MiB':>9} {'B/doc':>7}"
+        f" {'search p50/p95 ms':>18} {'mlt p50/p95 ms':>15} {'export/s':>9}"
+    )
+    for result in results:
+        search, mlt = result["search"], result["mlt"]
+        typer.echo(
+            f"{result['profile']:>10} {result['documents']:>8,}"
+            f" {result['ingest_docs_per_sec']:>9,.0f}"
+            f" {result['size_bytes'] / 1024**2:>9,.1f} {result['bytes_per_doc']:>7,.0f}"
+            f" {search['p50_ms']:>8.1f}/{search['p95_ms']:<9.1f}"
+            f" {mlt['p50_ms']:>6.1f}/{mlt['p95_ms']:<8.1f}"
+            f" {result['export_docs_per_sec']:>9,.0f}"
+        )
+
+
+def main(
+    profiles: List[str] = typer.Option(list(ES_MAPPING_PROFILES)),
+    n_documents: int = 20_000,
+    n_queries: int = 200,
+    output: str = None,
+    keep: bool = False,
+    seed: int = 42,
+):
+    """Report the size, ingest rate and query latencies of each mapping profile."""
+    unknown = set(profiles) - set(ES_MAPPING_PROFILES)
+    if unknown:
+        raise typer.BadParameter(
+            f"unknown profiles {unknown}, use {list(ES_MAPPING_PROFILES)}"
+        )
+    connection = connections.create_connection(hosts=["localhost:9200"])
+    instrument.instrument_elasticsearch(connection)
+    with instrument.stage("documents") as span:
+        documents = list(
+            itertools.islice(_document_generator(stream=True), n_documents)
+        )
+        span.rows = len(documents)
+    typer.echo(f"Comparing {len(profiles)} profiles on {len(documents):,} documents")
+
+    results = []
+    try:
+        for name in profiles:
+            typer.echo(f'Measuring the "{name}" profile...')
+            results.append(_measure(connection, name, documents, n_queries, seed))
+    finally:
+        if not keep:
+            for name in profiles:
+                connection.indices.delete(index=_index_name(name), ignore=[404])
+    _print_report(results)
+    if output:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as fh:
+            json.dump(results, fh, indent=2)
+        typer.echo(f"Report written to {output}")
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -0,0 +1,69 @@
+"""Manifest of the raw partitions already processed by a consumer."""
+
+from hashlib import sha256
+import json
+import os
+from typing import Dict, List
+
+
+def _get_file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    file_hash = sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class PartitionManifest:
+    """Records the path, mtime, size and content hash of processed partitions.
+
+    A partition is considered changed when it is not in the manifest, or when its mtime or
+    size moved *and* its content hash differs (a plain `touch` or re-download of the same
+    file does not trigger a reprocessing).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.partitions: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            with open(path, "r") as fh:
+                self.partitions = json.load(fh)["partitions"]
+        self._pending: Dict[str, Dict] = {}
+
+    def _stat(self, partition: str) -> Dict:
+        stat = os.stat(partition)
+        return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+    def changed(self, partitions: List[str]) -> List[str]:
+        """Filter `partitions` down to the ones that are new or changed since the last run."""
+        changed = []
+        for partition in partitions:
+            entry = self.partitions.get(partition)
+            stat = self._stat(partition)
+            if entry and all(entry[k] == v for k, v in stat.items()):
+                continue
+            content_hash = _get_file_hash(partition)
+            self._pending[partition] = dict(stat, content_hash=content_hash)
+            if entry and entry["content_hash"] == content_hash:
+                # same content, only refresh the stat
+                self.partitions[partition].update(stat)
+                continue
+            changed.append(partition)
+        return changed
+
+    def update(self, partitions: List[str]) -> None:
+        """Mark `partitions` as processed."""
+        for partition in partitions:
+            entry = self._pending.pop(partition, None) or dict(
+                self._stat(partition), content_hash=_get_file_hash(partition)
+            )
+            self.partitions[partition] = entry
+
+    def reset(self) -> None:
+        self.partitions = {}
+        self._pending = {}
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w") as fh:
+            json.dump({"partitions": self.partitions}, fh, indent=2, sort_keys=True)
@@ -0,0 +1,306 @@
+"""Materialized rollups of the `ArticleSearch` facets.
+
+The rollup index holds one document per (source, day) with its number of articles, and one
+per (source, day, entity) with its number of `texta_facts`. The facets of a query without
+full-text search are sums over a few rollup documents, instead of aggregations over every
+article. The rollups of a day are recomputed from the articles index whenever the ingest
+(or the NER enrichment) touches that day, so they always match the live aggregations:
+
+- `source_name`: top 10 sources by number of articles, ties broken by name, like `terms`;
+- `publishing_frequency`: number of articles per week, including empty weeks, like
+  `date_histogram` with `min_doc_count: 0`;
+- `related_entities`: top entities by number of facts, like a `terms` aggregation on
+  `texta_facts.str_val` nested in the articles.
+"""
+
+from collections import Counter
+import datetime
+from hashlib import md5
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from elasticsearch.helpers import scan
+from elasticsearch_dsl import connections, Q
+from elasticsearch_dsl.utils import AttrDict
+import pandas as pd
+import typer
+
+from station import instrument
+from station.bulk import BulkIndexer
+from station.constants import (
+    ES_INDEX,
+    ES_ROLLUP_INDEX,
+    ES_ROLLUP_MAPPING,
+    ES_SETTINGS,
+)
+from station.search import ArticleSearch
+
+DAY_MS = 24 * 3600 * 1000
+ARTICLES, ENTITIES = "articles", "entities"
+
+
+def get_day(published_at: Any) -> Optional[int]:
+    """UTC day of a `published_at` value (epoch ms or ISO string), as epoch ms."""
+    if published_at is None:
+        return None
+    if isinstance(published_at, (int, float)):
+        epoch_ms = int(published_at)
+    else:
+        timestamp = pd.Timestamp(published_at)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+        epoch_ms = timestamp.value // 10**6
+    return epoch_ms - epoch_ms % DAY_MS
+
+
+def _day_ranges(days: Iterable[int]) -> List[Tuple[int, int]]:
+    """Consecutive days merged into [start, end) ranges of epoch ms."""
+    ranges: List[List[int]] = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + DAY_MS
+        else:
+            ranges.append([day, day + DAY_MS])
+    return [tuple(r) for r in ranges]
+
+
+def _days_query(field: str, days: Optional[Iterable[Optional[int]]]) -> Q:
+    """Query of the documents of `days`, where the day None matches a missing `field`."""
+    if days is None:
+        return Q("match_all")
+    should = [
+        Q("range", **{field: {"gte": start, "lt": end, "format": "epoch_millis"}})
+        for start, end in _day_ranges(day for day in days if day is not None)
+    ]
+    if None in days:
+        should.append(Q("bool", must_not=[Q("exists", field=field)]))
+    return Q("bool", should=should, minimum_should_match=1)
+
+
+def _count(hits: Iterable[Dict]) -> Counter:
+    counts = Counter()
+    for hit in hits:
+        source = hit["_source"]
+        source_name, day = source.get("source_name"), get_day(
+            source.get("published_at")
+        )
+        counts[(ARTICLES, source_name, day, None, None)] += 1
+        for fact in source.get("texta_facts") or []:
+            if fact.get("str_val") is not None:
+                counts[
+                    (ENTITIES, source_name, day, fact.get("fact"), fact["str_val"])
+                ] += 1
+    return counts
+
+
+def update(
+    connection, days: Optional[Set[Optional[int]]] = None, index: str = ES_INDEX
+) -> Dict[str, int]:
+    """Recomputes the rollups of `days` (epoch ms), or of every day if None.
+
+    The new rollups are written with a new `generation` before the previous ones are
+    deleted, so that the rollups of a day are never missing.
+    """
+    if days is not None and not days:
+        return {"days": 0, "rollups": 0}
+    if not connection.indices.exists(index=ES_ROLLUP_INDEX):
+        connection.indices.create(
+            # a single shard keeps the terms aggregations ordered by sums exact
+            index=ES_ROLLUP_INDEX,
+            body={"settings": ES_SETTINGS, "mappings": ES_ROLLUP_MAPPING},
+        )
+    connection.indices.refresh(index=index)
+    hits = scan(
+        connection,
+        index=index,
+        query={"query": _days_query("published_at", days).to_dict()},
+        _source=[
+            "source_name",
+            "published_at",
+            "texta_facts.fact",
+            "texta_facts.str_val",
+        ],
+        size=1000,
+    )
+    counts = _count(hits)
+
+    generation = str(time.time_ns())
+
+    def _actions():
+        for (kind, source_name, day, fact, str_val), count in counts.items():
+            key = "|".join(map(str, [kind, source_name, day, fact, str_val]))
+            yield {
+                "_id": md5(key.encode("utf-8")).hexdigest(),
+                "kind": kind,
+                "source_name": source_name,
+                "day": day,
+                "fact": fact,
+                "str_val": str_val,
+                "count": count,
+                "generation": generation,
+            }
+
+    BulkIndexer(connection, index=ES_ROLLUP_INDEX).bulk(_actions())
+    connection.indices.refresh(index=ES_ROLLUP_INDEX)
+    stale = Q(
+        "bool",
+        filter=[_days_query("day", days)],
+        must_not=[Q("term", generation=generation)],
+    )
+    connection.delete_by_query(
+        index=ES_ROLLUP_INDEX, body={"query": stale.to_dict()}, refresh=True
+    )
+    n_days = len(days) if days is not None else len({key[2] for key in counts})
+    return {"days": n_days, "rollups": len(counts)}
+
+
+def _filters_query(filters: Dict[str, Any], skip: str = None) -> List[Q]:
+    """Rollup filters equivalent to the `ArticleSearch` filters, except `skip`'s."""
+    queries = []
+    sources = filters.get("source_name")
+    if sources and skip != "source_name":
+        sources = [sources] if isinstance(sources, str) else sources
+        queries.append(Q("terms", source_name=list(sources)))
+    weeks = filters.get("publishing_frequency")
+    if weeks and skip != "publishing_frequency":
+        weeks = [weeks] if isinstance(weeks, datetime.datetime) else weeks
+        queries.append(
+            Q(
+                "bool",
+                should=[
+                    Q(
+                        "range",
+                        day={"gte": week, "lt": week + datetime.timedelta(days=7)},
+                    )
+                    for week in weeks
+                ],
+                minimum_should_match=1,
+            )
+        )
+    return queries
+
+
+def facets_body(filters: Dict[str, Any]) -> Dict:
+    """Search body of the rollups answering the `ArticleSearch` facets of `filters`.
+
+    Like `FacetedSearch`, each facet is filtered by the other facets' filters only.
+    """
+    total = {"sum": {"field": "count"}}
+    return {
+        "size": 0,
+        "query": {"term": {"kind": ARTICLES}},
+        "aggs": {
+            "_filter_source_name": {
+                "filter": Q(
+                    "bool", filter=_filters_query(filters, skip="source_name")
+                ).to_dict(),
+                "aggs": {
+                    "source_name": {
+                        "terms": {
+                            "field": "source_name",
+                            "size": 10,
+                            "order": [{"total": "desc"}, {"_key": "asc"}],
+                        },
+                        "aggs": {"total": total},
+                    }
+                },
+            },
+            "_filter_publishing_frequency": {
+                "filter": Q(
+                    "bool", filter=_filters_query(filters, skip="publishing_frequency")
+                ).to_dict(),
+                "aggs": {
+                    "publishing_frequency": {
+                        "date_histogram": {
+                            "field": "day",
+                            "calendar_interval": "week",
+                            "min_doc_count": 0,
+                        },
+                        "aggs": {"total": total},
+                    }
+                },
+            },
+            "_total": {
+                "filter": Q("bool", filter=_filters_query(filters)).to_dict(),
+                "aggs": {"total": total},
+            },
+        },
+    }
+
+
+def parse_facets(raw: Dict, filters: Dict[str, Any]) -> Dict[str, Any]:
+    """`total` and `facets` of a rollup response, as `FacetedResponse.facets` would list them."""
+    aggregations = raw["aggregations"]
+    facets = {}
+    for name, facet in ArticleSearch.facets.items():
+        buckets = [
+            # the number of articles is the sum of the rollups, not their number
+            dict(bucket, doc_count=int(bucket["total"]["value"]))
+            for bucket in aggregations[f"_filter_{name}"][name]["buckets"]
+        ]
+        values = filters.get(name, ())
+        values = [values] if not isinstance(values, (list, tuple)) else values
+        facets[name] = facet.get_values(AttrDict({"buckets": buckets}), values)
+    return {
+        "total": int(aggregations["_total"]["total"]["value"]),
+        "facets": facets,
+    }
+
+
+def entities_body(filters: Dict[str, Any], fact: str = None, size: int = 5) -> Dict:
+    """Search body of the top `size` entities (of type `fact`) of the articles of `filters`."""
+    queries = [Q("term", kind=ENTITIES), *_filters_query(filters)]
+    if fact:
+        queries.append(Q("term", fact=fact))
+    return {
+        "size": 0,
+        "query": Q("bool", filter=queries).to_dict(),
+        "aggs": {
+            "related_entities": {
+                "terms": {
+                    "field": "str_val",
+                    "size": size,
+                    "order": [{"total": "desc"}, {"_key": "asc"}],
+                },
+                "aggs": {"total": {"sum": {"field": "count"}}},
+            }
+        },
+    }
+
+
+def parse_entities(raw: Dict) -> List[Tuple[str, int]]:
+    return [
+        (bucket["key"], int(bucket["total"]["value"]))
+        for bucket in raw["aggregations"]["related_entities"]["buckets"]
+    ]
+
+
+def facets(connection, filters: Dict[str, Any] = {}) -> Dict[str, Any]:
+    """Facets of `ArticleSearch(filters=filters)`, answered from the rollups."""
+    raw = connection.search(index=ES_ROLLUP_INDEX, body=facets_body(filters))
+    return parse_facets(raw, filters)
+
+
+def entities(
+    connection, filters: Dict[str, Any] = {}, fact: str = None, size: int = 5
+) -> List[Tuple[str, int]]:
+    raw = connection.search(
+        index=ES_ROLLUP_INDEX, body=entities_body(filters, fact, size)
+    )
+    return parse_entities(raw)
+
+
+def main(start_date: datetime.datetime = None, end_date: datetime.datetime = None):
+    """Recomputes the rollups of the days from --start-date to --end-date, or of every day."""
+    connection = connections.create_connection(hosts=["localhost:9200"])
+    days = None
+    if start_date or end_date:
+        start = get_day((start_date or end_date).isoformat())
+        end = get_day((end_date or start_date).isoformat())
+        days = set(range(start, end + DAY_MS, DAY_MS))
+    stats = update(connection, days)
+    typer.echo(f"Recomputed {stats['rollups']} rollups of {stats['days']} days")
+
+
+if __name__ == "__main__":
+    instrument.run(main)
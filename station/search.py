@@ -2,8 +2,10 @@ from elasticsearch_dsl import (
     connections,
     Document,
     Date,
+    InnerDoc,
     Integer,
     Keyword,
+    Nested,
     Text,
     FacetedSearch,
     TermsFacet,
@@ -11,6 +13,13 @@ from elasticsearch_dsl import (
 )
 
 
+class Fact(InnerDoc):
+    doc_path = Keyword()
+    fact = Keyword()
+    str_val = Keyword()
+    spans = Keyword(index=False)
+
+
 class Article(Document):
     title = Text()
     description = Text()
@@ -20,7 +29,11 @@ class Article(Document):
     published_at = Date()
     url = Keyword()
     url_to_image = Keyword()
+    duplicate_of = Keyword()
+    content_hash = Keyword(index=False)
     all_text = Text()
+    texta_facts = Nested(Fact)
+    ner_model = Keyword()
 
     class Index:
         name = "articles"
@@ -0,0 +1,401 @@
+"""Local "similar articles" engine, a fast alternative to `MLTDataset`.
+
+Documents are embedded with TF-IDF + truncated SVD (latent semantic analysis) on top of the
+hashed term counts of `station.vectorize`, so no model has to be downloaded. Vectors are
+l2-normalized float32 rows appended to a memory-mapped matrix, and top-k cosine similarity
+is served either by brute force (a chunked matrix product) or by an inverted file (IVF)
+index: rows are assigned to the nearest of `n_lists` k-means centroids, and a query only
+scans the rows of its `n_probe` nearest lists.
+
+The SVD, idf weights and centroids are frozen when the index is fitted, so that new shards
+of `station.vectorize` can be appended without recomputing the existing vectors.
+
+Reference:
+    - [Latent semantic analysis with sklearn](https://scikit-learn.org/stable/modules/decomposition.html#lsa)
+    - [Faiss IVF indexes](https://github.com/facebookresearch/faiss/wiki/Faiss-indexes)
+"""
+
+import json
+import os
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from elasticsearch_dsl import Q
+import numpy as np
+import scipy.sparse as sp
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+import typer
+
+from station import instrument
+from station.cache import ResultCache
+from station.dataset import DatasetBase
+from station.vectorize import ShardedVectorizer
+
+Like = Union[str, List[Union[str, Dict[str, str]]]]
+
+
+class SimilarityIndex:
+    """Dense vectors of the documents vectorized in `vectors`, stored in `directory`.
+
+    Arguments:
+        directory: where the model, the vectors and their ids are stored.
+        vectors: directory of the `ShardedVectorizer` shards.
+        n_components: dimension of the dense vectors.
+        max_features: only the most frequent hashed terms are kept for the SVD.
+        n_lists: number of IVF lists, defaults to 4 * sqrt(number of documents).
+        seed: random state of the SVD and of the k-means.
+    """
+
+    def __init__(
+        self,
+        directory: str = "data/similarity",
+        vectors: str = "data/vectors",
+        n_components: int = 128,
+        max_features: int = 50_000,
+        n_lists: int = None,
+        seed: int = 1,
+    ):
+        self.directory = directory
+        self.vectors = vectors
+        self.n_components = n_components
+        self.max_features = max_features
+        self.n_lists = n_lists
+        self.seed = seed
+        self.n_shards = 0
+        self.n_documents = 0
+        os.makedirs(directory, exist_ok=True)
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._model: Optional[Dict[str, np.ndarray]] = None
+        self._matrix: Optional[np.ndarray] = None
+        self._ids: Optional[np.ndarray] = None
+        self._rows: Optional[Dict[str, int]] = None
+        self._stale: Optional[np.ndarray] = None
+        self._lists: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r") as fh:
+                meta = json.load(fh)
+            for name, value in meta.items():
+                setattr(self, name, value)
+
+    @property
+    def fitted(self) -> bool:
+        return os.path.exists(os.path.join(self.directory, "components.npy"))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.npy")
+
+    @property
+    def model(self) -> Dict[str, np.ndarray]:
+        if self._model is None:
+            self._model = {
+                name: np.load(self._path(name), mmap_mode="r")
+                for name in ["features", "idf", "components", "centroids"]
+            }
+        return self._model
+
+    def fit(self, sample_size: int = 100_000) -> "SimilarityIndex":
+        """Fits the SVD and the IVF centroids on the first `sample_size` documents.
+
+        This resets the index: call `update` to (re-)embed the documents.
+        """
+        vectorizer = ShardedVectorizer(self.vectors)
+        features = np.sort(
+            np.argsort(-vectorizer.document_frequencies, kind="stable")[
+                : self.max_features
+            ]
+        )
+        idf = vectorizer.idf()[features].astype(np.float32)
+
+        sample, n_sampled = [], 0
+        for _, X in vectorizer.iter_shards():
+            sample.append(X[: sample_size - n_sampled])
+            n_sampled += sample[-1].shape[0]
+            if n_sampled >= sample_size:
+                break
+        X = normalize(sp.vstack(sample).tocsr()[:, features] @ sp.diags(idf))
+
+        n_components = min(self.n_components, X.shape[0] - 1, X.shape[1] - 1)
+        svd = TruncatedSVD(n_components, random_state=self.seed).fit(X)
+        components = svd.components_.astype(np.float32)
+        embeddings = normalize(X @ components.T)
+
+        n_lists = self.n_lists or int(4 * np.sqrt(n_sampled))
+        n_lists = max(1, min(n_lists, n_sampled))
+        kmeans = MiniBatchKMeans(n_lists, random_state=self.seed, n_init=3)
+        centroids = normalize(kmeans.fit(embeddings).cluster_centers_)
+
+        for name, values in [
+            ("features", features),
+            ("idf", idf),
+            ("components", components),
+            ("centroids", centroids.astype(np.float32)),
+        ]:
+            np.save(self._path(name), values)
+        for path in [self._vectors_path, self._path("ids"), self._path("lists")]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.n_components, self.n_lists = n_components, n_lists
+        self.n_shards, self.n_documents = 0, 0
+        self._save_meta()
+        self._reset()
+        return self
+
+    def transform(self, X: sp.csr_matrix) -> np.ndarray:
+        """Embeds hashed term counts into l2-normalized dense vectors."""
+        model = self.model
+        X = normalize(X.tocsr()[:, model["features"]] @ sp.diags(model["idf"]))
+        return normalize(X @ model["components"].T).astype(np.float32)
+
+    def _assign(self, embeddings: np.ndarray) -> np.ndarray:
+        return np.argmax(embeddings @ self.model["centroids"].T, axis=1).astype(
+            np.int32
+        )
+
+    def update(self) -> int:
+        """Appends the vectors of the shards written since the last update.
+
+        Returns:
+            the number of documents appended.
+        """
+        vectorizer = ShardedVectorizer(self.vectors)
+        shards, appended = vectorizer.shards[self.n_shards :], 0
+        ids = [np.load(self._path("ids"))] if os.path.exists(self._path("ids")) else []
+        lists = (
+            [np.load(self._path("lists"))]
+            if os.path.exists(self._path("lists"))
+            else []
+        )
+        with open(self._vectors_path, "ab") as fh:
+            for shard in shards:
+                embeddings = self.transform(sp.load_npz(shard))
+                fh.write(embeddings.tobytes())
+                ids.append(np.load(shard.replace(".npz", ".ids.npy")))
+                lists.append(self._assign(embeddings))
+                appended += embeddings.shape[0]
+        if appended:
+            np.save(self._path("ids"), np.concatenate(ids))
+            np.save(self._path("lists"), np.concatenate(lists))
+        self.n_shards += len(shards)
+        self.n_documents += appended
+        self._save_meta()
+        self._reset()
+        return appended
+
+    def _save_meta(self) -> None:
+        with open(self._meta_path, "w") as fh:
+            json.dump(
+                {
+                    "vectors": self.vectors,
+                    "n_components": self.n_components,
+                    "max_features": self.max_features,
+                    "n_lists": self.n_lists,
+                    "seed": self.seed,
+                    "n_shards": self.n_shards,
+                    "n_documents": self.n_documents,
+                },
+                fh,
+            )
+
+    def _reset(self) -> None:
+        self._model = self._matrix = self._ids = self._rows = self._lists = None
+        self._stale = None
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """The (n_documents, n_components) memory-mapped vectors."""
+        if self._matrix is None:
+            self._matrix = np.memmap(
+                self._vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.n_documents, self.n_components),
+            )
+        return self._matrix
+
+    @property
+    def ids(self) -> np.ndarray:
+        if self._ids is None:
+            self._ids = np.load(self._path("ids"))
+        return self._ids
+
+    def _row_of(self, article_id: str) -> Optional[int]:
+        if self._rows is None:
+            self._rows = {article_id: row for row, article_id in enumerate(self.ids)}
+        return self._rows.get(article_id)
+
+    @property
+    def stale(self) -> np.ndarray:
+        """Whether each row is superseded by a later row of the same id, re-vectorized."""
+        if self._stale is None:
+            _, last = np.unique(self.ids[::-1], return_index=True)
+            self._stale = np.ones(len(self.ids), dtype=bool)
+            self._stale[len(self.ids) - 1 - last] = False
+        return self._stale
+
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows sorted by list, and the offset of each list in them."""
+        if self._lists is None:
+            lists = np.load(self._path("lists"))
+            rows = np.argsort(lists, kind="stable")
+            offsets = np.searchsorted(lists[rows], np.arange(self.n_lists + 1))
+            self._lists = rows, offsets
+        return self._lists
+
+    def embed(self, like: Like) -> Optional[np.ndarray]:
+        """Query vector of a `MoreLikeThis`-style `like`: texts and/or {"_id": ...} documents."""
+        like = [like] if isinstance(like, (str, dict)) else like
+        texts = [item for item in like if isinstance(item, str)]
+        rows = [self._row_of(item["_id"]) for item in like if isinstance(item, dict)]
+        vectors = [self.matrix[[row for row in rows if row is not None]]]
+        if texts:
+            vectorizer = ShardedVectorizer(self.vectors).vectorizer
+            vectors.append(self.transform(vectorizer.transform(texts)))
+        vectors = np.concatenate(vectors)
+        if not len(vectors):
+            return None
+        query = normalize(vectors.mean(axis=0, keepdims=True))[0]
+        # no known document, or no term of the texts in the vocabulary
+        return query if np.any(query) else None
+
+    def _iter_candidates(
+        self, query: np.ndarray, approximate: bool, n_probe: int, chunk_size: int
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        if not approximate:
+            for start in range(0, self.n_documents, chunk_size):
+                rows = np.arange(start, min(start + chunk_size, self.n_documents))
+                yield rows, self.matrix[start : rows[-1] + 1] @ query
+            return
+        rows, offsets = self._inverted_lists()
+        probes = np.argsort(-(self.model["centroids"] @ query))[:n_probe]
+        candidates = np.concatenate(
+            [rows[offsets[probe] : offsets[probe + 1]] for probe in probes]
+        )
+        candidates.sort()
+        for start in range(0, len(candidates), chunk_size):
+            chunk = candidates[start : start + chunk_size]
+            yield chunk, self.matrix[chunk] @ query
+
+    def search(
+        self,
+        like: Like,
+        k: int = 10,
+        exclude: List[str] = [],
+        approximate: bool = True,
+        n_probe: int = 8,
+        chunk_size: int = 100_000,
+    ) -> List[Tuple[str, float]]:
+        """Top-k (article id, cosine similarity) most similar to `like`.
+
+        The documents of `like` and `exclude` are not returned.
+        """
+        query = self.embed(like)
+        if query is None:
+            return []
+        like = [like] if isinstance(like, (str, dict)) else like
+        excluded = set(exclude) | {
+            item["_id"] for item in like if isinstance(item, dict)
+        }
+        excluded_rows = [self._row_of(article_id) for article_id in excluded]
+        excluded_rows = np.array([row for row in excluded_rows if row is not None])
+
+        best_rows, best_scores = np.empty(0, dtype=int), np.empty(0, dtype=np.float32)
+        for rows, scores in self._iter_candidates(
+            query, approximate, n_probe, chunk_size
+        ):
+            keep = ~np.isin(rows, excluded_rows) & ~self.stale[rows]
+            rows, scores = rows[keep], scores[keep]
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+                rows, scores = rows[top], scores[top]
+            best_rows = np.concatenate([best_rows, rows])
+            best_scores = np.concatenate([best_scores, scores])
+        order = np.argsort(-best_scores, kind="stable")[:k]
+        return [
+            (self.ids[row], float(score))
+            for row, score in zip(best_rows[order], best_scores[order])
+        ]
+
+
+class SimilarDataset(DatasetBase):
+    """Same interface as `MLTDataset`, ranked by the local `SimilarityIndex`.
+
+    The `k` most similar articles are fetched from ElasticSearch, in similarity order
+    (or `date_field` order), with their cosine similarity as `_score`.
+    """
+
+    def __init__(
+        self,
+        like: Like,
+        exclude: List[str] = [],
+        k: int = 100,
+        index: SimilarityIndex = None,
+        approximate: bool = True,
+        n_probe: int = 8,
+        date_field: str = None,
+        stored_fields: str = None,
+        cache: ResultCache = None,
+        pagination: str = "scroll",
+        slices: int = 4,
+        page_size: int = 1000,
+    ):
+        self.index = index or SimilarityIndex()
+        self.similar = dict(
+            self.index.search(
+                like, k=k, exclude=exclude, approximate=approximate, n_probe=n_probe
+            )
+        )
+        self.date_field = date_field
+        super().__init__(
+            Q("ids", values=list(self.similar)),
+            date_field=date_field,
+            stored_fields=stored_fields,
+            cache=cache,
+            pagination=pagination,
+            slices=slices,
+            page_size=page_size,
+        )
+
+    def _fetch_hits(self) -> Iterator[Dict]:
+        hits = list(super()._fetch_hits())
+        for hit in hits:
+            hit["_score"] = self.similar[hit["_id"]]
+        if not self.date_field:
+            hits.sort(key=lambda hit: -hit["_score"])
+        return iter(hits)
+
+
+def main(
+    directory: str = "data/similarity",
+    vectors: str = "data/vectors",
+    n_components: int = 128,
+    max_features: int = 50_000,
+    n_lists: int = None,
+    sample_size: int = 100_000,
+    refit: bool = False,
+):
+    """Embeds the shards of `station.vectorize` that are not in the index yet.
+
+    The SVD and the IVF centroids are fitted on the first run, or with --refit.
+    """
+    index = SimilarityIndex(
+        directory,
+        vectors=vectors,
+        n_components=n_components,
+        max_features=max_features,
+        n_lists=n_lists,
+    )
+    if refit or not index.fitted:
+        index.n_components, index.max_features = n_components, max_features
+        index.n_lists = n_lists
+        index.fit(sample_size=sample_size)
+        typer.echo(f"Fitted {index.n_components} components and {index.n_lists} lists")
+    appended = index.update()
+    typer.echo(
+        f'Appended {appended} vectors to "{directory}" ({index.n_documents} total)'
+    )
+
+
+if __name__ == "__main__":
+    instrument.run(main)
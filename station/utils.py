@@ -1,8 +1,27 @@
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import glob
+import gzip
 from hashlib import md5
-from typing import List
+import io
+import os
+from typing import Dict, IO, Iterator, List, Tuple, Union
 
+import dask
 import dask.dataframe as dd
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
+import zstandard
+
+from station.instrument import stage
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# extensions of the compressed partitions, the preferred copy first
+PARTITION_SUFFIXES = [".zst", ".gz"]
+PARQUET_PARTITIONING = pa.schema([("date", pa.string()), ("hour", pa.string())])
 
 
 def _get_surrogate_key(row: pd.Series, cols: List[str]) -> str:
@@ -11,32 +30,285 @@ def _get_surrogate_key(row: pd.Series, cols: List[str]) -> str:
     return surrogate_key
 
 
-def load_data(filepath: str = "data/newsapi/*/*/articles.json") -> pd.DataFrame:
-    # load data
-    df = dd.read_json(
-        # 's3://articles-louisguitton/newsapi/2021-03-15/09/articles.json' fails, the issue is with s3
-        filepath
-    )
+def _hash_strings(strings: List[str]) -> List[str]:
+    return [md5(s.encode("utf-8")).hexdigest() for s in strings]
 
-    # generate unique id and deduplicate
-    articles_df = (
-        df.compute()
-        .assign(publishedAt=lambda d: pd.to_datetime(d.publishedAt))
-        .reset_index(drop=True)
-        .pipe(
-            lambda d: d.join(
-                pd.json_normalize(d.source, meta_prefix="source_").rename(
-                    columns={"id": "source_id", "name": "source_name"}
+
+def _get_surrogate_keys(
+    df: pd.DataFrame,
+    cols: List[str],
+    n_jobs: int = 1,
+    chunksize: int = 100_000,
+) -> pd.Series:
+    """Vectorized version of `_get_surrogate_key`.
+
+    The surrogate strings are built column-wise with `str()` semantics (so `None` and `NaN`
+    give "None" and "nan" like before) and hashed in bulk, which avoids building a `pd.Series`
+    per row with `DataFrame.apply(axis=1)`. Keys are identical to the row-wise version.
+
+    Arguments:
+        df: dataframe to generate keys for.
+        cols: columns joined with "|" to form the surrogate string.
+        n_jobs: number of processes used to hash; 1 hashes in the current process.
+        chunksize: number of rows sent to a worker at once when `n_jobs` > 1.
+
+    Returns:
+        a series of md5 hex digests aligned on `df.index`.
+    """
+    surrogate_strings = df[cols[0]].map(str)
+    for col in cols[1:]:
+        surrogate_strings = surrogate_strings + "|" + df[col].map(str)
+    surrogate_strings = surrogate_strings.tolist()
+
+    if n_jobs == 1 or len(surrogate_strings) <= chunksize:
+        keys = _hash_strings(surrogate_strings)
+    else:
+        chunks = [
+            surrogate_strings[i : i + chunksize]
+            for i in range(0, len(surrogate_strings), chunksize)
+        ]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            keys = [
+                key for chunk in executor.map(_hash_strings, chunks) for key in chunk
+            ]
+    return pd.Series(keys, index=df.index, dtype=object)
+
+
+def _clean_articles(df: pd.DataFrame, n_jobs: int = 1) -> pd.DataFrame:
+    """Parse dates, flatten `source` and generate the `article_id` surrogate key."""
+    with stage("clean_articles.normalize", rows=len(df)):
+        df = (
+            df.assign(publishedAt=lambda d: pd.to_datetime(d.publishedAt))
+            .reset_index(drop=True)
+            .pipe(
+                lambda d: d.join(
+                    pd.json_normalize(d.source, meta_prefix="source_").rename(
+                        columns={"id": "source_id", "name": "source_name"}
+                    )
                 )
             )
+            .drop(columns="source")
         )
-        .drop(columns="source")
+    with stage("clean_articles.surrogate_keys", rows=len(df)):
         # Here we use ('title', 'source_name'), we could use 'url' but we would get more duplicates that just changed url.
-        .assign(
-            article_id=lambda d: d.apply(
-                _get_surrogate_key, args=(["title", "source_name"],), axis=1
-            )
+        return df.assign(
+            article_id=_get_surrogate_keys(df, ["title", "source_name"], n_jobs=n_jobs)
         )
-        .drop_duplicates(subset="article_id", keep="last")
+
+
+def records_from_frame(df: pd.DataFrame) -> List[Dict]:
+    """Convert a dataframe to records, like `json.loads(df.to_json(orient="records"))`.
+
+    Dates become epoch milliseconds and missing values become `None`, but the frame is not
+    serialized and re-parsed.
+    """
+    with stage("records_from_frame", rows=len(df)):
+        df = df.copy()
+        for col in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
+                epoch_ms = df[col].astype("int64") // 10**6
+                df[col] = epoch_ms.astype(object).where(df[col].notna(), None)
+        return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+
+def open_partition(path: str) -> IO[str]:
+    """Open a JSONL partition as text.
+
+    gzip and zstd partitions (e.g. `articles.json.gz`) are detected by their magic number
+    and decompressed on the fly, plain partitions are read as is.
+    """
+    with open(path, "rb") as fh:
+        magic = fh.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if magic == ZSTD_MAGIC:
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def _read_json(path: str) -> pd.DataFrame:
+    with open_partition(path) as fh:
+        return pd.read_json(fh, orient="records", lines=True)
+
+
+def _get_partition_date(path: str) -> str:
+    # partitions are laid out as <root>/<YYYY-MM-DD>/<HH>/articles.json[.gz|.zst]
+    return os.path.basename(os.path.dirname(os.path.dirname(path)))
+
+
+def _dedup_partitions(paths: List[str]) -> List[str]:
+    """Keeps one copy of each partition, the compressed one, e.g. when `aws s3 sync` left the
+    plain `articles.json` next to its `articles.json.zst`."""
+
+    def _rank(path: str) -> int:
+        suffix = os.path.splitext(path)[1]
+        if suffix in PARTITION_SUFFIXES:
+            return PARTITION_SUFFIXES.index(suffix)
+        return len(PARTITION_SUFFIXES)
+
+    best: Dict[str, str] = {}
+    for path in paths:
+        stem, suffix = os.path.splitext(path)
+        key = stem if suffix in PARTITION_SUFFIXES else path
+        best[key] = min(best.get(key, path), path, key=_rank)
+    kept = set(best.values())
+    return [path for path in paths if path in kept]
+
+
+def list_partitions(
+    filepath: Union[str, List[str]] = "data/newsapi/*/*/articles.json*",
+    start_date: Union[str, datetime.date] = None,
+    end_date: Union[str, datetime.date] = None,
+) -> List[str]:
+    """List the partition files matching `filepath`, in the order `load_data` reads them.
+
+    Arguments:
+        filepath: glob, or list of paths, of the JSONL partitions, plain or compressed;
+            only the compressed copy of a partition stored both ways is kept.
+        start_date: only keep the partitions of that date or later (inclusive).
+        end_date: only keep the partitions of that date or earlier (inclusive).
+    """
+    paths = (
+        sorted(glob.glob(filepath)) if isinstance(filepath, str) else sorted(filepath)
+    )
+    paths = _dedup_partitions(paths)
+    if start_date:
+        paths = [p for p in paths if _get_partition_date(p) >= str(start_date)]
+    if end_date:
+        paths = [p for p in paths if _get_partition_date(p) <= str(end_date)]
+    return paths
+
+
+def _read_partition(path: str, n_jobs: int = 1) -> pd.DataFrame:
+    # each file is read on its own like dd.read_json does, so that dtypes (hence keys) match
+    with stage("read_json") as span:
+        df = _read_json(path)
+        span.rows = len(df)
+    return _clean_articles(df, n_jobs=n_jobs)
+
+
+def _read_partitions(
+    paths: List[str], n_jobs: int = 1
+) -> Iterator[Tuple[int, pd.DataFrame]]:
+    offset = 0
+    for path in paths:
+        partition_df = _read_partition(path, n_jobs=n_jobs)
+        yield offset, partition_df
+        offset += len(partition_df)
+
+
+def _load_parquet(
+    path: str,
+    start_date: Union[str, datetime.date] = None,
+    end_date: Union[str, datetime.date] = None,
+    sources: List[str] = None,
+) -> pd.DataFrame:
+    expression = ds.scalar(True)
+    if start_date:
+        expression &= ds.field("date") >= str(start_date)
+    if end_date:
+        expression &= ds.field("date") <= str(end_date)
+    if sources:
+        expression &= ds.field("source_name").isin(sources)
+    dataset = ds.dataset(
+        path,
+        format="parquet",
+        partitioning=ds.partitioning(PARQUET_PARTITIONING, flavor="hive"),
+        filesystem=fs.LocalFileSystem(use_mmap=True),
+    )
+    columns = [name for name in dataset.schema.names if name not in ("date", "hour")]
+    # date and hour filters prune whole partitions, source filters use row groups statistics;
+    # fragments are read in the order of the JSON partitions ("date=.../hour=..." paths sort
+    # by date then hour), which "keep last" deduplication relies on, without copying rows
+    fragments = sorted(
+        dataset.get_fragments(filter=expression), key=lambda fragment: fragment.path
     )
+    tables = [
+        fragment.to_table(schema=dataset.schema, columns=columns, filter=expression)
+        for fragment in fragments
+    ]
+    if not tables:
+        return dataset.schema.empty_table().select(columns).to_pandas()
+    table = pa.concat_tables(tables)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def load_data(
+    filepath: Union[str, List[str]] = "data/newsapi/*/*/articles.json*",
+    n_jobs: int = 1,
+    start_date: Union[str, datetime.date] = None,
+    end_date: Union[str, datetime.date] = None,
+    sources: List[str] = None,
+) -> pd.DataFrame:
+    """Load the deduplicated articles.
+
+    Arguments:
+        filepath: glob, or list of paths, of the JSONL partitions to read,
+            or the directory of the Parquet dataset written by `station.compact`.
+        n_jobs: number of processes used to hash the surrogate keys.
+        start_date: only read the partitions of that date or later (inclusive).
+        end_date: only read the partitions of that date or earlier (inclusive).
+        sources: only keep the articles of these `source_name`.
+    """
+    if isinstance(filepath, str) and os.path.isdir(filepath):
+        df = _load_parquet(filepath, start_date, end_date, sources)
+        return df.drop_duplicates(subset="article_id", keep="last")
+
+    # load data, one dask partition per file, like dd.read_json but decompressing files
+    # 's3://articles-louisguitton/newsapi/2021-03-15/09/articles.json' fails, the issue is with s3
+    paths = list_partitions(filepath, start_date, end_date)
+    df = dd.from_delayed([dask.delayed(_read_json)(path) for path in paths])
+    with stage("read_json") as span:
+        df = df.compute()
+        span.rows = len(df)
+
+    # generate unique id and deduplicate
+    articles_df = _clean_articles(df, n_jobs=n_jobs)
+    with stage("deduplicate", rows=len(articles_df)):
+        articles_df = articles_df.drop_duplicates(subset="article_id", keep="last")
+    if sources:
+        articles_df = articles_df[articles_df.source_name.isin(sources)]
     return articles_df
+
+
+def iter_data(
+    filepath: Union[str, List[str]] = "data/newsapi/*/*/articles.json*",
+    batch_size: int = None,
+    n_jobs: int = 1,
+    start_date: Union[str, datetime.date] = None,
+    end_date: Union[str, datetime.date] = None,
+) -> Iterator[pd.DataFrame]:
+    """Stream the articles of `load_data` one partition at a time.
+
+    Deduplication matches `load_data(...).drop_duplicates(keep="last")` across partitions:
+    a first pass over the partitions records, for each `article_id`, the position of its last
+    occurrence in a compact store (16 bytes digest -> int), and the second pass only yields
+    the rows sitting at that position.
+    Only one partition (an hour of articles) is held in memory at a time.
+
+    Arguments:
+        filepath: glob, or list of paths, of the JSONL partitions to read.
+        batch_size: maximum number of rows per yielded batch; defaults to one batch per partition.
+        n_jobs: number of processes used to hash the surrogate keys.
+        start_date: only read the partitions of that date or later (inclusive).
+        end_date: only read the partitions of that date or earlier (inclusive).
+
+    Yields:
+        cleaned and deduplicated dataframes, with the same columns as `load_data`.
+    """
+    paths = list_partitions(filepath, start_date, end_date)
+    last_seen: Dict[bytes, int] = {}
+    for offset, partition_df in _read_partitions(paths, n_jobs=n_jobs):
+        for position, article_id in enumerate(partition_df.article_id, start=offset):
+            last_seen[bytes.fromhex(article_id)] = position
+
+    for offset, partition_df in _read_partitions(paths, n_jobs=n_jobs):
+        is_last = [
+            last_seen[bytes.fromhex(article_id)] == position
+            for position, article_id in enumerate(partition_df.article_id, start=offset)
+        ]
+        partition_df = partition_df[is_last]
+        step = batch_size or max(len(partition_df), 1)
+        for start in range(0, len(partition_df), step):
+            yield partition_df.iloc[start : start + step]
@@ -0,0 +1,279 @@
+"""Out-of-core vectorization of the corpus into sparse document-term matrix shards.
+
+Documents are hashed with a `HashingVectorizer`, so there is no vocabulary to fit and a new
+batch of documents (e.g. a new day of partitions) is appended as new shards without refitting.
+Document frequencies are updated incrementally to compute TF-IDF weights. A document
+vectorized again with another text supersedes its previous row, through an on-disk index of
+the ids.
+
+Reference:
+    - [Out-of-core text classification with sklearn](https://scikit-learn.org/stable/auto_examples/applications/plot_out_of_core_classification.html)
+"""
+
+import glob
+from hashlib import md5
+import json
+import os
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from elasticsearch_dsl import connections
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+import typer
+
+from station import instrument
+from station.constants import ES_ALL_FIELD
+from station.dataset import Dataset, DatasetBase
+from station.manifest import PartitionManifest
+from station.utils import iter_data, list_partitions
+
+Batch = Tuple[List[str], List[str]]
+# the default limit of the parameters of a statement of SQLite < 3.32
+SQLITE_MAX_VARIABLES = 999
+
+
+def batches_from_partitions(
+    partitions: List[str], batch_size: int = 10_000
+) -> Iterator[Batch]:
+    """(article ids, texts) batches read from the raw partitions."""
+    for articles_df in iter_data(partitions, batch_size=batch_size):
+        texts = (
+            articles_df.title.fillna("")
+            + "\n"
+            + articles_df.description.fillna("")
+            + "\n"
+            + articles_df.content.fillna("")
+        )
+        yield articles_df.article_id.tolist(), texts.tolist()
+
+
+def batches_from_dataset(
+    dataset: DatasetBase, batch_size: int = 10_000
+) -> Iterator[Batch]:
+    """(article ids, texts) batches streamed from the index."""
+    for batch in dataset.to_batches(batch_size, stored_fields=[ES_ALL_FIELD]):
+        yield batch["_id"].tolist(), [text or "" for text in batch[ES_ALL_FIELD]]
+
+
+class ShardedVectorizer:
+    """Writes hashed term counts as `shard-<n>.npz` files, with their ids, in `directory`.
+
+    The `ids.sqlite` index maps each id to its current (shard, row) and to the hash of its
+    text: a document vectorized again with another text is written to a new shard, and its
+    previous row is superseded, i.e. skipped by `iter_shards`.
+    """
+
+    def __init__(
+        self,
+        directory: str = "data/vectors",
+        n_features: int = 2**20,
+        **vectorizer_params,
+    ):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r") as fh:
+                meta = json.load(fh)
+            n_features = meta["n_features"]
+            vectorizer_params = meta["vectorizer_params"]
+        self.n_features = n_features
+        self.vectorizer_params = vectorizer_params
+        # raw counts, so that shards can be re-weighted with the up-to-date idf
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features, alternate_sign=False, norm=None, **vectorizer_params
+        )
+        df_path = os.path.join(directory, "document_frequencies.npy")
+        self.document_frequencies = (
+            np.load(df_path) if os.path.exists(df_path) else np.zeros(n_features)
+        )
+        self._index = self._open_index()
+
+    def _open_index(self) -> sqlite3.Connection:
+        path = os.path.join(self.directory, "ids.sqlite")
+        exists = os.path.exists(path)
+        index = sqlite3.connect(path)
+        index.execute(
+            "CREATE TABLE IF NOT EXISTS rows"
+            " (id TEXT PRIMARY KEY, shard INTEGER, row INTEGER, hash TEXT)"
+        )
+        index.execute("CREATE INDEX IF NOT EXISTS rows_shard ON rows (shard)")
+        if not exists:
+            # shards written before the index: the last row of an id is the current one
+            for shard, ids in enumerate(self.iter_ids()):
+                index.executemany(
+                    "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, NULL)",
+                    ((article_id, shard, row) for row, article_id in enumerate(ids)),
+                )
+        index.commit()
+        return index
+
+    @property
+    def shards(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "shard-*.npz")))
+
+    @property
+    def n_documents(self) -> int:
+        return self._index.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+    def iter_ids(self) -> Iterator[np.ndarray]:
+        """All the ids of each shard, superseded rows included."""
+        for shard in self.shards:
+            yield np.load(shard.replace(".npz", ".ids.npy"), allow_pickle=False)
+
+    def _lookup(self, ids: List[str]) -> Dict[str, Tuple[int, int, str]]:
+        """(shard, row, hash) of the `ids` already vectorized."""
+        found = {}
+        for start in range(0, len(ids), SQLITE_MAX_VARIABLES):
+            chunk = ids[start : start + SQLITE_MAX_VARIABLES]
+            found.update(
+                (article_id, (shard, row, text_hash))
+                for article_id, shard, row, text_hash in self._index.execute(
+                    "SELECT id, shard, row, hash FROM rows"
+                    f" WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        return found
+
+    def _supersede(self, rows: Dict[int, List[int]]) -> None:
+        """Removes the superseded `rows` of each shard from the document frequencies."""
+        for shard, shard_rows in rows.items():
+            X = sp.load_npz(self.shards[shard]).tocsr()[shard_rows]
+            self.document_frequencies -= np.bincount(
+                X.indices, minlength=self.n_features
+            )
+
+    def partial_fit(self, batches: Iterable[Batch]) -> int:
+        """Vectorize and append `batches`.
+
+        Documents already vectorized with the same text are skipped, those whose text
+        changed supersede their previous row.
+
+        Returns:
+            the number of documents appended.
+        """
+        n_shards, appended = len(self.shards), 0
+        for ids, texts in batches:
+            # the last text of an id repeated in the batch wins
+            documents = {
+                article_id: (text, md5(text.encode("utf-8")).hexdigest())
+                for article_id, text in zip(ids, texts)
+            }
+            previous = self._lookup(list(documents))
+            documents = {
+                article_id: document
+                for article_id, document in documents.items()
+                if article_id not in previous or previous[article_id][2] != document[1]
+            }
+            if not documents:
+                continue
+            superseded: Dict[int, List[int]] = {}
+            for article_id in documents:
+                if article_id in previous:
+                    shard, row, _ = previous[article_id]
+                    superseded.setdefault(shard, []).append(row)
+            self._supersede(superseded)
+
+            ids = list(documents)
+            X = self.vectorizer.transform([text for text, _ in documents.values()])
+            X = X.tocsr()
+            self.document_frequencies += np.bincount(
+                X.indices, minlength=self.n_features
+            )
+            path = os.path.join(self.directory, f"shard-{n_shards:06d}")
+            sp.save_npz(f"{path}.npz", X)
+            np.save(f"{path}.ids.npy", np.array(ids, dtype=str))
+            self._index.executemany(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)",
+                (
+                    (article_id, n_shards, row, text_hash)
+                    for row, (article_id, (_, text_hash)) in enumerate(
+                        documents.items()
+                    )
+                ),
+            )
+            self._index.commit()
+            n_shards += 1
+            appended += len(ids)
+        self._save_meta()
+        return appended
+
+    def _save_meta(self) -> None:
+        np.save(
+            os.path.join(self.directory, "document_frequencies.npy"),
+            self.document_frequencies,
+        )
+        with open(self._meta_path, "w") as fh:
+            json.dump(
+                {
+                    "n_features": self.n_features,
+                    "vectorizer_params": self.vectorizer_params,
+                    "n_shards": len(self.shards),
+                },
+                fh,
+            )
+
+    def idf(self) -> np.ndarray:
+        """Smoothed idf, like `TfidfTransformer(smooth_idf=True)`."""
+        n_documents = self.n_documents
+        return np.log((1 + n_documents) / (1 + self.document_frequencies)) + 1
+
+    def iter_shards(
+        self, tfidf: bool = False
+    ) -> Iterator[Tuple[np.ndarray, sp.csr_matrix]]:
+        """(ids, matrix) of the current rows of each shard, raw counts or l2-normalized TF-IDF."""
+        idf = sp.diags(self.idf()) if tfidf else None
+        for n, (shard, ids) in enumerate(zip(self.shards, self.iter_ids())):
+            X = sp.load_npz(shard)
+            rows = [
+                row
+                for row, in self._index.execute(
+                    "SELECT row FROM rows WHERE shard = ? ORDER BY row", (n,)
+                )
+            ]
+            if len(rows) < len(ids):
+                ids, X = ids[rows], X.tocsr()[rows]
+            if tfidf:
+                X = X @ idf
+                norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+                X = sp.diags(np.where(norms > 0, 1 / norms, 0)) @ X
+            yield ids, X.tocsr()
+
+
+def main(
+    source: str = "data/newsapi/*/*/articles.json*",
+    directory: str = "data/vectors",
+    n_features: int = 2**20,
+    batch_size: int = 10_000,
+    query: str = None,
+):
+    """Vectorizes the partitions that are new or changed since the last run.
+
+    Use --query to vectorize the documents of an ElasticSearch query instead.
+    """
+    vectorizer = ShardedVectorizer(directory, n_features=n_features)
+    if query:
+        connections.create_connection(hosts=["localhost:9200"])
+        appended = vectorizer.partial_fit(
+            batches_from_dataset(Dataset(query=query), batch_size=batch_size)
+        )
+        typer.echo(f'Appended {appended} documents to "{directory}"')
+        return
+
+    manifest = PartitionManifest(os.path.join(directory, "manifest.json"))
+    partitions = manifest.changed(list_partitions(source))
+    typer.echo(f"Found {len(partitions)} new or changed partitions")
+    if partitions:
+        appended = vectorizer.partial_fit(
+            batches_from_partitions(partitions, batch_size=batch_size)
+        )
+        typer.echo(f'Appended {appended} documents to "{directory}"')
+    manifest.update(partitions)
+    manifest.save()
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -0,0 +1,52 @@
+import asyncio
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch_dsl import Q
+import pytest
+
+from station.aio import execute_batch
+from station.dataset import DatasetBase
+
+
+class FakeAsyncClient:
+    def __init__(self, responses):
+        self.responses = responses
+        self.bodies = []
+
+    async def msearch(self, body):
+        self.bodies.append(body)
+        return {"responses": self.responses}
+
+
+def _datasets():
+    dataset = DatasetBase(query=Q("match_all"), stored_fields="all_text")
+    dataset.search = dataset.search.index("articles").params(routing="a")
+    return [dataset, DatasetBase(query=Q("match_all"))]
+
+
+OK = {"hits": {"total": {"value": 0, "relation": "eq"}, "hits": []}}
+ERROR = {"error": {"type": "search_phase_execution_exception"}, "status": 400}
+
+
+def test_execute_batch_sends_the_search_params():
+    client = FakeAsyncClient([OK, OK])
+
+    responses = asyncio.run(execute_batch(_datasets(), client=client))
+
+    assert [response.hits.total.value for response in responses] == [0, 0]
+    headers, bodies = client.bodies[0][::2], client.bodies[0][1::2]
+    assert headers == [{"index": ["articles"], "routing": "a"}, {}]
+    assert bodies[0]["stored_fields"] == "all_text"
+    assert "stored_fields" not in bodies[1]
+
+
+def test_execute_batch_errors():
+    with pytest.raises(TransportError):
+        asyncio.run(execute_batch(_datasets(), client=FakeAsyncClient([OK, ERROR])))
+
+    responses = asyncio.run(
+        execute_batch(
+            _datasets(), client=FakeAsyncClient([OK, ERROR]), raise_on_error=False
+        )
+    )
+    assert responses[1] is None
@@ -0,0 +1,17 @@
+from station.api import ResponseCache
+
+
+def test_make_key_folds_the_query_only():
+    assert ResponseCache.make_key(
+        "search", q="  Vaccin   COVID ", filters={"source_name": ["Le Monde", "BFMTV"]}
+    ) == ResponseCache.make_key(
+        "search", q="vaccin covid", filters={"source_name": ["BFMTV", "Le Monde"]}
+    )
+    assert ResponseCache.make_key(
+        "search", q="vaccin", filters={"source_name": ["Le Monde"]}
+    ) != ResponseCache.make_key(
+        "search", q="vaccin", filters={"source_name": ["le monde"]}
+    )
+    assert ResponseCache.make_key("similar", article_id="ABC") != (
+        ResponseCache.make_key("similar", article_id="abc")
+    )
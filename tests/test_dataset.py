@@ -0,0 +1,124 @@
+import itertools
+import threading
+import time
+
+from elasticsearch_dsl import Q
+import pyarrow as pa
+import pytest
+
+from benchmarks.fakes import get_stub_client, StubStore
+from station.dataset import DatasetBase, DatasetBatch
+
+
+def _dataset(monkeypatch, batches, field_types):
+    dataset = DatasetBase(query=Q("match_all"))
+    monkeypatch.setattr(
+        dataset, "_iter_columns", lambda batch_size, fields, stored_fields: batches
+    )
+    monkeypatch.setattr(dataset, "_field_types", lambda fields: field_types)
+    return dataset
+
+
+def test_to_arrow_column_null_in_a_whole_batch(monkeypatch):
+    batches = [
+        {"_id": ["a", "b"], "author": ["Jean", "Anne"], "published_at": [1, 2]},
+        {"_id": ["c"], "author": [None], "published_at": [None]},
+    ]
+    dataset = _dataset(monkeypatch, batches, {"author": pa.string()})
+
+    table = dataset.to_arrow(fields=["author", "published_at"])
+
+    assert table.schema.field("author").type == pa.string()
+    assert table.schema.field("published_at").type == pa.int64()
+    assert table.column("author").to_pylist() == ["Jean", "Anne", None]
+    df = dataset.to_pandas(fields=["author", "published_at"])
+    assert df["_id"].tolist() == ["a", "b", "c"]
+
+
+def test_to_arrow_unmapped_column_null_in_the_first_batch(monkeypatch):
+    batches = [
+        {"_id": ["a"], "all_text": [None], "author": [None]},
+        {"_id": ["b"], "all_text": ["text"], "author": ["Jean"]},
+    ]
+    dataset = _dataset(monkeypatch, batches, {})
+
+    table = dataset.to_arrow(fields=["author"], stored_fields=["all_text"])
+
+    assert table.schema.field("all_text").type == pa.string()
+    assert table.schema.field("author").type == pa.string()
+    assert table.column("author").to_pylist() == [None, "Jean"]
+
+
+def test_to_arrow_without_hits(monkeypatch):
+    dataset = _dataset(monkeypatch, [], {})
+
+    table = dataset.to_arrow(fields=["author"], stored_fields=["all_text"])
+
+    assert table.num_rows == 0
+    assert table.column_names == ["_id", "author", "all_text"]
+
+
+def _stub_dataset(n_documents, **kwargs):
+    store = StubStore()
+    store.indices["articles"] = {str(i): {"title": f"t{i}"} for i in range(n_documents)}
+    dataset = DatasetBase(query=Q("match_all"), **kwargs)
+    dataset.search = dataset.search.using(get_stub_client(store)).index("articles")
+    return dataset, store
+
+
+def test_sliced_scroll_returns_every_hit():
+    dataset, store = _stub_dataset(1000, pagination="sliced", slices=4, page_size=10)
+
+    assert sorted(int(hit.meta.id) for hit in dataset) == list(range(1000))
+    assert store.scrolls == {}
+
+
+def test_sliced_scroll_with_one_slice_is_a_plain_scroll():
+    dataset, store = _stub_dataset(100, pagination="sliced", slices=1, page_size=10)
+
+    assert sorted(int(hit.meta.id) for hit in dataset) == list(range(100))
+    assert store.scrolls == {}
+
+
+def test_slices_must_be_positive():
+    with pytest.raises(ValueError):
+        DatasetBase(query=Q("match_all"), pagination="sliced", slices=0)
+
+
+def test_sliced_scroll_stops_the_workers_when_the_consumer_stops():
+    dataset, store = _stub_dataset(1000, pagination="sliced", slices=4, page_size=10)
+    threads = threading.active_count()
+
+    hits = iter(dataset)
+    assert len(list(itertools.islice(hits, 5))) == 5
+    hits.close()
+
+    deadline = time.monotonic() + 5
+    while threading.active_count() > threads and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert threading.active_count() == threads
+    assert store.scrolls == {}
+
+
+class FakeClient:
+    def __init__(self, responses):
+        self.responses = responses
+        self.bodies = []
+
+    def msearch(self, body):
+        self.bodies.append(body)
+        return {"responses": self.responses}
+
+
+def test_dataset_batch_puts_stored_fields_in_the_body():
+    client = FakeClient([{"hits": {"total": {"value": 0}, "hits": []}}])
+    dataset = DatasetBase(query=Q("match_all"), stored_fields="all_text")
+    dataset.search = dataset.search.using(client).index("articles")
+
+    (response,) = DatasetBatch([dataset], size=5).execute()
+
+    header, body = client.bodies[0]
+    assert header == {"index": ["articles"]}
+    assert body["stored_fields"] == "all_text"
+    assert body["size"] == 5
+    assert response.hits.total.value == 0
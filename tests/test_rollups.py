@@ -0,0 +1,127 @@
+import datetime
+import os
+import random
+
+from elasticsearch import Elasticsearch
+import pytest
+
+from benchmarks.fakes import get_stub_client, StubStore
+from station import rollups
+from station.constants import ES_MAPPING, ES_SETTINGS
+from station.management import es
+from station.search import ArticleSearch
+
+DAY_MS = rollups.DAY_MS
+# a disposable cluster (e.g. `docker-compose up`), the tests create and delete their indices
+ES_URL = os.environ.get("STATION_TEST_ES_URL")
+TEST_INDEX = "test_articles"
+
+
+def _index_documents(connection, documents, monkeypatch, **kwargs):
+    monkeypatch.setattr(
+        es, "_document_generator", lambda partitions, **params: iter(documents)
+    )
+    params = dict(
+        partitions=[],
+        document_params={},
+        skip_unchanged=True,
+        update_existing=True,
+        thread_count=1,
+        chunk_size=100,
+        max_chunk_bytes=1 << 20,
+        verbose=False,
+    )
+    return es._index_documents(connection, es.ES_INDEX, **dict(params, **kwargs))
+
+
+@pytest.mark.parametrize("skip_unchanged", [True, False])
+def test_index_documents_returns_the_previous_day(monkeypatch, skip_unchanged):
+    store = StubStore()
+    store.indices[es.ES_INDEX] = {
+        "a": {"published_at": 10 * DAY_MS + 5, "content_hash": "old"},
+        "b": {"published_at": 20 * DAY_MS, "content_hash": "same"},
+    }
+    documents = [
+        {"_id": "a", "published_at": 12 * DAY_MS, "content_hash": "new"},
+        {"_id": "b", "published_at": 20 * DAY_MS, "content_hash": "same"},
+        {"_id": "c", "published_at": 30 * DAY_MS, "content_hash": "new"},
+    ]
+
+    days = _index_documents(
+        get_stub_client(store), documents, monkeypatch, skip_unchanged=skip_unchanged
+    )
+
+    assert days >= {10 * DAY_MS, 12 * DAY_MS, 30 * DAY_MS}
+    assert store.indices[es.ES_INDEX]["a"]["published_at"] == 12 * DAY_MS
+
+
+class _TestArticleSearch(ArticleSearch):
+    index = TEST_INDEX
+
+
+def _article(rng: random.Random, i: int) -> dict:
+    published_at = datetime.datetime(2021, 3, 1) + datetime.timedelta(
+        hours=rng.randrange(24 * 40)
+    )
+    return {
+        "_id": str(i),
+        "title": f"article {i}",
+        "source_name": rng.choice(["Le Monde", "BFMTV", "Libération", "Le Figaro"]),
+        "published_at": int(published_at.timestamp() * 1000),
+        "content_hash": str(i),
+        "texta_facts": [
+            {"doc_path": "title", "fact": "PER", "str_val": rng.choice("ABCDE")}
+            for _ in range(rng.randrange(3))
+        ],
+    }
+
+
+def _assert_facets_match(connection, filters):
+    live = _TestArticleSearch(filters=filters).execute()
+    answered = rollups.facets(connection, filters)
+    assert answered["total"] == live.hits.total.value
+    for name in ArticleSearch.facets:
+        assert answered["facets"][name] == list(live.facets[name])
+
+
+@pytest.mark.skipif(ES_URL is None, reason="STATION_TEST_ES_URL is not set")
+def test_facets_match_the_live_aggregations(monkeypatch):
+    connection = Elasticsearch(hosts=[ES_URL])
+    monkeypatch.setattr(es, "ES_INDEX", TEST_INDEX)
+    monkeypatch.setattr(rollups, "ES_ROLLUP_INDEX", f"{TEST_INDEX}_rollups")
+    monkeypatch.setattr(
+        "elasticsearch_dsl.connections.connections._conns", {"default": connection}
+    )
+    connection.indices.delete(index=f"{TEST_INDEX}*", ignore=[404])
+    connection.indices.create(
+        index=TEST_INDEX, body={"settings": ES_SETTINGS, "mappings": ES_MAPPING}
+    )
+    try:
+        rng = random.Random(0)
+        documents = [_article(rng, i) for i in range(300)]
+        _index_documents(connection, documents, monkeypatch)
+        rollups.update(connection, None, index=TEST_INDEX)
+        week = datetime.datetime(2021, 3, 8)
+        for filters in [
+            {},
+            {"source_name": ["Le Monde", "BFMTV"]},
+            {"publishing_frequency": [week]},
+            {"source_name": ["Le Monde"], "publishing_frequency": [week]},
+        ]:
+            _assert_facets_match(connection, filters)
+
+        # re-crawled articles published at another date keep the same `_id`
+        moved = [
+            dict(
+                document,
+                published_at=document["published_at"] + 9 * DAY_MS,
+                content_hash=f"{document['_id']}-moved",
+            )
+            for document in documents[:50]
+        ]
+        days = _index_documents(connection, moved, monkeypatch)
+        rollups.update(connection, days, index=TEST_INDEX)
+        for filters in [{}, {"publishing_frequency": [week]}]:
+            _assert_facets_match(connection, filters)
+    finally:
+        connection.indices.delete(index=f"{TEST_INDEX}*", ignore=[404])
@@ -0,0 +1,20 @@
+from station.utils import list_partitions
+
+
+def test_list_partitions_keeps_the_compressed_copy(tmp_path):
+    for path in [
+        "2021-03-01/00/articles.json",
+        "2021-03-01/00/articles.json.zst",
+        "2021-03-01/01/articles.json",
+        "2021-03-01/02/articles.json.gz",
+    ]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).touch()
+
+    partitions = list_partitions(str(tmp_path / "*/*/articles.json*"))
+
+    assert [p[len(str(tmp_path)) + 1 :] for p in partitions] == [
+        "2021-03-01/00/articles.json.zst",
+        "2021-03-01/01/articles.json",
+        "2021-03-01/02/articles.json.gz",
+    ]
@@ -0,0 +1,40 @@
+import numpy as np
+
+from station.vectorize import ShardedVectorizer
+
+
+def _current(vectorizer):
+    ids = np.concatenate([ids for ids, _ in vectorizer.iter_shards()])
+    return ids.tolist()
+
+
+def test_partial_fit_supersedes_the_changed_documents(tmp_path):
+    vectorizer = ShardedVectorizer(str(tmp_path), n_features=2**10)
+    assert vectorizer.partial_fit([(["a", "b"], ["red apple", "green pear"])]) == 2
+
+    vectorizer = ShardedVectorizer(str(tmp_path))
+    appended = vectorizer.partial_fit(
+        [(["a", "b", "c"], ["red apple", "yellow banana", "blue plum"])]
+    )
+
+    assert appended == 2
+    assert vectorizer.n_documents == 3
+    assert sorted(_current(vectorizer)) == ["a", "b", "c"]
+    ids, X = list(vectorizer.iter_shards())[-1]
+    assert ids.tolist() == ["b", "c"]
+    expected = vectorizer.vectorizer.transform(["yellow banana", "blue plum"])
+    assert (X != expected).nnz == 0
+    # "green pear" is not counted anymore, "red apple" only once
+    texts = ["red apple", "yellow banana", "blue plum"]
+    frequencies = np.bincount(
+        vectorizer.vectorizer.transform(texts).indices, minlength=2**10
+    )
+    np.testing.assert_array_equal(vectorizer.document_frequencies, frequencies)
+
+
+def test_the_id_index_is_built_from_existing_shards(tmp_path):
+    vectorizer = ShardedVectorizer(str(tmp_path), n_features=2**10)
+    vectorizer.partial_fit([(["a"], ["red apple"]), (["b"], ["green pear"])])
+    (tmp_path / "ids.sqlite").unlink()
+
+    assert ShardedVectorizer(str(tmp_path)).n_documents == 2